@@ -0,0 +1,52 @@
+"""
+Сравнение Interpreter.run с пошаговым Interpreter.step.
+Запуск: python bench.py
+"""
+import io
+import time
+
+from bytecode import ByteCode as B
+from executor import Interpreter
+from test_all import MACRO_PROGRAM
+from test_utils import compile_source
+
+
+def _by_step(bytecode) -> float:
+    interpreter = Interpreter(bytecode, output=io.StringIO())
+    start = time.perf_counter()
+    try:
+        while True:
+            interpreter.step()
+    except EOFError:
+        pass
+    return time.perf_counter() - start
+
+
+def _by_run(bytecode) -> float:
+    interpreter = Interpreter(bytecode, output=io.StringIO())
+    start = time.perf_counter()
+    interpreter.run()
+    return time.perf_counter() - start
+
+
+def bench(name: str, bytecode, repeat: int = 5):
+    # Лучшее время из нескольких запусков, чтобы не мерить шум
+    step = min(_by_step(bytecode) for _ in range(repeat))
+    run = min(_by_run(bytecode) for _ in range(repeat))
+    print("{:<10} {:>6} instructions  step {:.4f}s  run {:.4f}s  x{:.1f}"
+          .format(name, len(bytecode), step, run, step / run))
+
+
+def main():
+    head, _ = MACRO_PROGRAM.split("reg ZERO")
+    registers = "reg ZERO\nreg A\nreg B\nreg C\n"
+    body = "_add A 200\n_mov2 B C A\n_mov2 A B C\n_add C -200\n_print A\n"
+
+    bench("macro", compile_source(MACRO_PROGRAM))
+    bench("macro x30", compile_source(head + registers + body * 30))
+    bench("nested", [B(ch, 1) if ch in "+-<>" else B(ch) for ch in
+                     "++++++++++[>++++++++++[>++++++++++[>+>+<<-]<-]<-]"])
+
+
+if __name__ == '__main__':
+    main()
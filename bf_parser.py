@@ -0,0 +1,102 @@
+import mmap
+import re
+from array import array
+from typing import BinaryIO, List, TextIO, Tuple
+
+from br_exceptions.bytecode import BracketError
+from bytecode import ByteCode as B, Program
+
+
+class BfParser:
+    """
+    Потоковый разбор текста Brainfuck прямо в упакованный Program.
+    Текст подаётся кусками через feed, подряд идущие `+-` и `<>`
+    сразу сворачиваются в одну инструкцию, остальные символы - комментарии.
+    Серии, разрезанные границей куска, склеиваются. Ошибки скобок
+    сообщают смещение байта в исходном тексте
+    """
+    _token = re.compile(rb'[+\-]+|[<>]+|[.,\[\]]')
+    _single = {
+        ord("."): B.PRINT,
+        ord(","): B.READ,
+        ord("["): B.CYCLE_IN,
+        ord("]"): B.CYCLE_OUT,
+    }
+
+    def __init__(self):
+        self.ops = array('b')
+        self.args = array('i')
+        # (индекс инструкции, смещение байта) открытых `[`
+        self.opened = []  # type: List[Tuple[int, int]]
+        self.position = 0
+
+    def feed(self, chunk: bytes or str):
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        ops = self.ops
+        args = self.args
+        single = self._single
+        for match in self._token.finditer(chunk):
+            text = match.group()
+            first = text[0]
+            if 43 == first or 45 == first:  # `+` `-`
+                op = B.PLUS
+                arg = 2 * text.count(b"+") - len(text)
+            elif 60 == first or 62 == first:  # `<` `>`
+                op = B.MOVE
+                arg = 2 * text.count(b">") - len(text)
+            else:
+                op = single[first]
+                if B.CYCLE_IN == op:
+                    self.opened.append(
+                        (len(ops), self.position + match.start()))
+                elif B.CYCLE_OUT == op:
+                    if not self.opened:
+                        raise BracketError(self.position + match.start(), "]")
+                    self.opened.pop()
+                ops.append(op)
+                args.append(0)
+                continue
+            # Серия продолжает предыдущую, в том числе из прошлого куска
+            if ops and ops[-1] == op:
+                arg += args.pop()
+                ops.pop()
+            if B.PLUS == op:
+                arg = B._wrap(arg)
+            if arg:
+                ops.append(op)
+                args.append(arg)
+        self.position += len(chunk)
+
+    def finish(self) -> Program:
+        if self.opened:
+            raise BracketError(self.opened[-1][1], "[")
+        return Program(self.ops, self.args)
+
+
+def parse_bf(source: str or bytes or BinaryIO or TextIO,
+             chunk_size: int = 1 << 20) -> Program:
+    """
+    Разбирает Brainfuck из пути к файлу, открытого файла или bytes.
+    Файл по пути отображается через mmap и не читается в память целиком
+    """
+    parser = BfParser()
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Пустой файл отобразить нельзя
+                return parser.finish()
+        with data:
+            for start in range(0, len(data), chunk_size):
+                parser.feed(data[start:start + chunk_size])
+    elif isinstance(source, (bytes, bytearray, memoryview)):
+        parser.feed(source)
+    else:
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+            parser.feed(chunk)
+    return parser.finish()
@@ -8,9 +8,13 @@ from br_parser import Token, Line, NameSpace, FunctionType
 from br_exceptions import lexer as lexer_e
 from br_exceptions import compiler as compiler_e
 from br_parser import Variable
+from br_types import AddressBrType
 from builtin_functions import builtin_functions
 from builtin_variables import builtin_variables
 from bytecode import ByteCode
+from macro_cache import MacroCache
+from optimizer.analysis import tape_size
+from source_map import SourceMap
 
 
 class Lexer:
@@ -68,7 +72,10 @@ class Lexer:
 class Context:
     def __init__(self, parent: 'Context' or None,
                  expr: Expression,
-                 namespace: NameSpace or None = None
+                 namespace: NameSpace or None = None,
+                 source_map: SourceMap or None = None,
+                 release: bool = False,
+                 macro_cache: MacroCache or None = None
                  ):
         self.parent = parent
         self.childs = []  # type: List[Context]
@@ -79,21 +86,41 @@ class Context:
         # оторого выполняется данное выражение находится на уровень выше
         # Предназначен только для ДОБАВЛЕНИЯ В НЕГО НОВЫХ ПЕРЕМЕННЫХ
         # предназначен для БЛОКОВЫХ ФУНКЦИЙ, ПЕРЕДАЁТСЯ В НЕГО
-        self.ch_ns = namespace or NameSpace()
+        # Создаётся при первом обращении: встроенным функциям он не нужен
+        self._ch_ns = namespace
         self.bytecode = []  # type: List[ByteCode]
+        self.source_map = source_map
+        # Release-режим: встроенные функции не форматируют комментарии NONE
+        self.release = release
+        self.macro_cache = macro_cache
+        # Импортированные файлы (путь -> sha256), общие для всего дерева
+        self.imports = parent.imports if parent is not None else {}
 
     @property
-    def ns(self):
-        return self.ch_ns.parent
+    def ch_ns(self) -> NameSpace:
+        if self._ch_ns is None:
+            self._ch_ns = NameSpace(
+                self.parent.ch_ns if self.parent is not None else None)
+        return self._ch_ns
+
+    @property
+    def ns(self) -> NameSpace or None:
+        return self.parent.ch_ns if self.parent is not None else None
 
     def create_child(self, expr: Expression) -> 'Context':
-        cntx = Context(parent=self,
-                       expr=expr,
-                       namespace=self.ch_ns.create_namespace()
-                       )
+        cntx = self._spawn(expr)
         self.childs.append(cntx)
         return cntx
 
+    def _spawn(self, expr: Expression) -> 'Context':
+        """ Потомок, которого родитель не запоминает в childs """
+        return Context(parent=self,
+                       expr=expr,
+                       source_map=self.source_map,
+                       release=self.release,
+                       macro_cache=self.macro_cache
+                       )
+
     def _determine_function(self):
         try:
             self.func = self.ns.get_func(self.expr.func_token)
@@ -101,7 +128,32 @@ class Context:
             e.context = self
             raise e
 
-    def compile(self):
+    def _mark_sources(self):
+        """ Связывает выданные инструкции с записью в SourceMap """
+        if self.source_map is None or not self.bytecode:
+            return
+        src = self.source_map.add_context(self)
+        for b in self.bytecode:
+            b.src = src
+
+    def _push_vars(self):
+        """ Аргументы макроса - в его NameSpace, их ячейки заняты до конца """
+        self.ch_ns.symbols_push(self.vars.values())
+        for var in self.vars.values():
+            if isinstance(var.value_type, AddressBrType):
+                self.ch_ns.hold(var)
+
+    def _close(self):
+        """ Раскрытие закончилось: освобождает ячейки его NameSpace """
+        if self._ch_ns is not None:
+            self._ch_ns.close()
+
+    def _expand(self) -> List[Expression]:
+        """
+        Выполняет выражение: встроенная функция выдаёт self.bytecode,
+        а для макроса возвращаются выражения его тела, которые надо
+        выполнить потомками этого контекста
+        """
         # found function
         self._determine_function()
         if isinstance(self.expr, Line):
@@ -109,42 +161,85 @@ class Context:
                 # Builtin, NoBlock
                 self.vars = self.func.check_args(self)
                 self.bytecode = self.func.compile(self)
-            else:
-                # No builtin, NoBlock
-                if FunctionType.NO_BLOCK != self.func.type:
-                    raise compiler_e.BlockFunctionError(
-                        context=self, function=self.func)
-                    # raise Error
-                self.vars = self.func.check_args(self)
-                self.ch_ns.symbols_push(self.vars.values())
+                self._mark_sources()
+                return []
+            # No builtin, NoBlock
+            if FunctionType.NO_BLOCK != self.func.type:
+                raise compiler_e.BlockFunctionError(
+                    context=self, function=self.func)
+                # raise Error
+            self.vars = self.func.check_args(self)
+            self._push_vars()
+            return self.func.code
+
+        if self.func.builtin:
+            # Builtin, Block
+            self.vars = self.func.check_args(self)
+            self.bytecode = self.func.compile_block(self)
+            self._mark_sources()
+            return []
+        # not builtin block
+        if FunctionType.BLOCK != self.func.type:
+            raise compiler_e.NoBlockFunctionError(
+                context=self, function=self.func)
+            # raise Error
+        self.vars = self.func.check_args(self)
+        code = []
+        for part in self.func.code[:-1]:
+            code += part
+            code += self.expr.block_lines
+        code += self.func.code[-1]
+
+        self._push_vars()
+        return code
+
+    def _cached(self) -> bool:
+        """
+        Берёт код раскрытия макроса из кэша, если он там есть; иначе
+        начинает записывать, что раскрытие читает снаружи
+        """
+        if self.macro_cache is None:
+            return False
+        bytecode = self.macro_cache.get(self)
+        if bytecode is None:
+            self.macro_cache.start(self)
+            return False
+        self.bytecode = bytecode
+        return True
 
-                for expr in self.func.code:
-                    cntx = self.create_child(expr)
-                    cntx.compile()
-
-        elif isinstance(self.expr, Block):
-            if self.func.builtin:
-                # Builtin, Block
-                self.vars = self.func.check_args(self)
-                self.bytecode = self.func.compile_block(self)
-            else:
-                # not builtin block
-                if FunctionType.BLOCK != self.func.type:
-                    raise compiler_e.NoBlockFunctionError(
-                        context=self, function=self.func)
-                    # raise Error
-                self.vars = self.func.check_args(self)
-                code = []
-                for part in self.func.code[:-1]:
-                    code += part
-                    code += self.expr.block_lines
-                code += self.func.code[-1]
-
-                self.ch_ns.symbols_push(self.vars.values())
-
-                for expr in code:
-                    cntx = self.create_child(expr)
-                    cntx.compile()
+    def compile(self):
+        code = self._expand()
+        if code and not self._cached():
+            for expr in code:
+                cntx = self.create_child(expr)
+                cntx.compile()
+            if self.macro_cache is not None:
+                self.macro_cache.put(self, list(self.iter_bytecode()))
+        self._close()
+
+    def stream(self) -> Iterator[ByteCode]:
+        """
+        Как compile, но bytecode отдаётся по мере выполнения, а дерево
+        контекстов не строится: родитель не хранит потомков, и каждый
+        потомок вместе со своим NameSpace освобождается, как только
+        выдаст свой код. Остаётся только цепочка родителей текущего
+        выражения - её достаточно для error_info и SourceMap
+        """
+        code = self._expand()
+        if code and self._cached():
+            code = []
+        bytecode, self.bytecode = self.bytecode, []
+        yield from bytecode
+        if code and self.macro_cache is None:
+            for expr in code:
+                yield from self._spawn(expr).stream()
+        elif code:
+            for expr in code:
+                for b in self._spawn(expr).stream():
+                    bytecode.append(b)
+                    yield b
+            self.macro_cache.put(self, bytecode)
+        self._close()
 
     def __str__(self):
         btcode = " ".join([str(b) for b in self.bytecode])
@@ -211,29 +306,76 @@ class Context:
 
         return s
 
-    def full_bytecode(self):
-        bytecode = self.bytecode[:]
-        for cntx in self.childs:
-            bytecode += cntx.full_bytecode()
-        return bytecode
+    def iter_bytecode(self) -> Iterator[ByteCode]:
+        """ Код дерева в порядке выполнения, без промежуточных списков """
+        stack = [self]
+        while stack:
+            cntx = stack.pop()
+            yield from cntx.bytecode
+            stack.extend(reversed(cntx.childs))
+
+    def full_bytecode(self) -> List[ByteCode]:
+        return list(self.iter_bytecode())
 
 
 class FileCompiler:
-    def __init__(self, file_name: str, block: Block):
+    def __init__(self, file_name: str, block: Block, release: bool = False,
+                 macro_cache_size: int = MacroCache.SIZE):
+        """
+        release - компилировать без комментариев NONE во встроенных функциях,
+        macro_cache_size - сколько раскрытий макросов помнить (0 - не помнить)
+        """
         self.file_name = file_name
         self.block = block
+        self.release = release
+        self.macro_cache_size = macro_cache_size
         self.context = None  # type: Context or None
+        self.source_map = None  # type: SourceMap or None
+        self.macro_cache = None  # type: MacroCache or None
+        self._bytecode = None  # type: List[ByteCode] or None
         self._init_context()
 
     def _init_context(self):
         """ Создаёт первичный Context"""
-        context = Context(None, self.block)
+        self.source_map = SourceMap(self.file_name)
+        # Функции макросов создаются заново при каждой компиляции,
+        # поэтому и кэш их раскрытий - тоже
+        self.macro_cache = MacroCache(self.macro_cache_size) \
+            if self.macro_cache_size else None
+        context = Context(None, self.block, source_map=self.source_map,
+                          release=self.release,
+                          macro_cache=self.macro_cache)
         context.ch_ns.symbols_push(builtin_functions)
         context.ch_ns.symbols_push(builtin_variables)
         self.context = context
+        self._bytecode = None
 
     def compile(self):
         self._init_context()
         for expr in self.block.block_lines:
             cntx = self.context.create_child(expr)
             cntx.compile()
+
+    def stream(self) -> Iterator[ByteCode]:
+        """
+        Компилирует файл, отдавая bytecode генератором (см. Context.stream).
+        Дерево контекстов не сохраняется, поэтому debug_print, bytecode и
+        tape_size после stream недоступны - tape_size можно посчитать
+        по собранному из генератора коду
+        """
+        self._init_context()
+        for expr in self.block.block_lines:
+            yield from self.context._spawn(expr).stream()
+
+    def bytecode(self) -> List[ByteCode]:
+        """ Код скомпилированного дерева; собирается один раз """
+        if self._bytecode is None:
+            self._bytecode = self.context.full_bytecode()
+        return self._bytecode
+
+    def tape_size(self) -> int or None:
+        """
+        Размер ленты, если его удаётся доказать по скомпилированному коду:
+        адреса `reg` и AddressBrType известны, а __move сбалансированы
+        """
+        return tape_size(self.bytecode())
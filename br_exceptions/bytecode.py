@@ -0,0 +1,24 @@
+from br_exceptions.base import Base
+
+
+class _BaseBytecode(Base):
+    pass
+
+
+class CycleBalanceError(_BaseBytecode):
+    def __init__(self, index: int):
+        self.index = index
+
+    def __str__(self):
+        return "Несбалансированный цикл: у инструкции `{self.index}` " \
+               "нет парной скобки".format(self=self)
+
+
+class BracketError(_BaseBytecode):
+    def __init__(self, offset: int, bracket: str):
+        self.offset = offset
+        self.bracket = bracket
+
+    def __str__(self):
+        return "Непарная скобка `{self.bracket}` в тексте Brainfuck: " \
+               "байт `{self.offset}`".format(self=self)
@@ -20,3 +20,20 @@ class NoBlockFunctionError(Base):
 class BlockFunctionError(Base):
     def __repr__(self):
         return "В блоковую функицю обязательно нужно что-то передать"
+
+
+class ImportCodeError(Base):
+    def __repr__(self):
+        return "Импортируемый файл `{}` выдаёт код, " \
+               "а может только определять макросы".format(self.path)
+
+
+class ImportCycleError(Base):
+    def __repr__(self):
+        return "Циклический импорт файла `{}`".format(self.path)
+
+
+class ImportFileError(Base):
+    def __repr__(self):
+        return "Не удалось прочитать импортируемый файл `{}`: {}".format(
+            self.path, self.reason)
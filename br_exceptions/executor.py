@@ -0,0 +1,36 @@
+from br_exceptions.base import Base
+
+
+class _BaseExecutor(Base):
+    pass
+
+
+class MemoryBoundsError(_BaseExecutor):
+    def __init__(self, address: int, limit: int or None = None):
+        self.address = address
+        self.limit = limit
+
+    def __str__(self):
+        if self.address < 0:
+            return "Выход за левую границу памяти: адрес `{}`".format(
+                self.address)
+        return "Выход за правую границу памяти: адрес `{}`, " \
+               "доступно `{}` ячеек".format(self.address, self.limit)
+
+
+class NativeBuildError(_BaseExecutor):
+    def __init__(self, compiler: str, message: str):
+        self.compiler = compiler
+        self.message = message
+
+    def __str__(self):
+        return "Ошибка нативной сборки (`{self.compiler}`): " \
+               "{self.message}".format(self=self)
+
+
+class SnapshotError(_BaseExecutor):
+    def __init__(self, message: str):
+        self.message = message
+
+    def __str__(self):
+        return "Ошибка снимка состояния: {self.message}".format(self=self)
@@ -1,12 +1,13 @@
 import abc
 from enum import Enum
-from typing import List, Dict, Type, TypeVar, Tuple, Any, Iterator, Iterable, T
+from typing import List, Dict, Set, Type, TypeVar, Tuple, Any, Iterator, Iterable, T
 
 from br_exceptions import parser as parser_e
 
 from br_exceptions.types import BaseTypesError, IdentifierNameError
 from br_lexer import Line, Token, Expression
 from bytecode import ByteCode
+from registers import Registers
 
 
 class Symbol(metaclass=abc.ABCMeta):
@@ -167,9 +168,30 @@ class Function(Symbol):
 
 
 class NameSpace:
+    """
+    Область видимости. Корень помнит имена, которые добавлялись во
+    вложенные NameSpace (_shadowed): остальные имена могут лежать только
+    в корне и ищутся там сразу, без обхода цепочки родителей
+    """
     def __init__(self, parent: 'NameSpace' or None = None):
         self.parent = parent  # type: NameSpace
         self.symbols = {}
+        self.root = parent.root if parent is not None else self
+        # Только у корня: имена символов вложенных NameSpace
+        self._shadowed = set()  # type: Set[str]
+        # Запись обращений наружу для кэша макросов (macro_cache.Recording)
+        self.recording = None
+        # Предки, которые записывали обращения, когда создавался этот
+        self._recorders = ()  # type: Tuple[NameSpace, ...]
+        if parent is not None:
+            self._recorders = parent._recorders
+            if parent.recording is not None:
+                self._recorders += (parent,)
+        # Ячейки ленты общие для всей компиляции; этот NameSpace держит
+        # адреса своих переменных (имя -> адрес) до close
+        self.registers = parent.registers if parent is not None \
+            else Registers()
+        self._held = {}  # type: Dict[str, int]
 
     def symbol_lifetime_push(self,
                              lifetime: FunctionLifeTime,
@@ -183,28 +205,55 @@ class NameSpace:
             self.symbol_parent_push(symbol)
 
     def symbol_push(self, symbol: Symbol):
+        address = self._held.pop(symbol.name, None)
+        if address is not None:
+            # Перекрытая переменная больше не видна - ячейка свободна
+            self.registers.release(address)
         self.symbols[symbol.name] = symbol
+        if self.root is not self:
+            self.root._shadowed.add(symbol.name)
 
     def symbol_global_push(self, symbol: Symbol):
         if self.parent:
+            if self.recording is not None:
+                self.recording.escaped = True
             self.parent.symbol_global_push(symbol)
         else:
             self.symbol_push(symbol)
 
     def symbol_parent_push(self, symbol: Symbol):
+        if self.recording is not None:
+            self.recording.escaped = True
         self.parent.symbol_push(symbol)
 
     def symbols_push(self, symbols: Iterable[Symbol]):
         for symbol in symbols:
             self.symbol_push(symbol)
 
-    def get(self, item: Token, default=None) -> Symbol:
-        if item.text in self.symbols:
-            return self.symbols[item.text]
-        elif self.parent:
-            return self.parent.get(item, default)
-        else:
+    def find(self, name: str, default=None) -> Symbol:
+        symbol = self.symbols.get(name)
+        if symbol is not None:
+            return symbol
+        if self.parent is None:
             return default
+        if name in self.root._shadowed:
+            symbol = self.parent.find(name)
+            if self.recording is not None:
+                self.recording.reads.setdefault(name, symbol)
+            return default if symbol is None else symbol
+
+        # Имя есть только в корне: все записывающие предки прочитали бы
+        # при обходе то же самое
+        symbol = self.root.symbols.get(name)
+        if self.recording is not None:
+            self.recording.reads.setdefault(name, symbol)
+        for ns in self._recorders:
+            if ns.recording is not None:
+                ns.recording.reads.setdefault(name, symbol)
+        return default if symbol is None else symbol
+
+    def get(self, item: Token, default=None) -> Symbol:
+        return self.find(item.text, default)
 
     def __getitem__(self, item: Token) -> Symbol:
         symbol = self.get(item, None)
@@ -218,8 +267,31 @@ class NameSpace:
             if isinstance(symbol, Variable):
                 yield symbol
         if self.parent:
+            if self.recording is not None:
+                self.recording.vars = True
             yield from self.parent.get_vars()
 
+    def hold(self, variable: Variable):
+        """ Занимает ячейку переменной с адресом до close """
+        self.registers.hold(variable.value)
+        self._held[variable.name] = variable.value
+
+    def free_register(self) -> int:
+        """
+        Первая свободная ячейка для `reg`. Ответ зависит от всех занятых
+        ячеек, поэтому записывающие обращения предки это запоминают
+        """
+        for ns in self._recorders + (self,):
+            if ns.recording is not None:
+                ns.recording.vars = True
+        return self.registers.first_free()
+
+    def close(self):
+        """ Область видимости закончилась: её ячейки можно переиспользовать """
+        for address in self._held.values():
+            self.registers.release(address)
+        self._held.clear()
+
     def get_func(self, token: Token) -> Function:
         func = self.get(token)
         if not isinstance(func, Function):
@@ -0,0 +1,224 @@
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Iterable, List
+
+from bytecode import Program
+from compile_cache import CompileCache, compile_file, compiler_version
+from optimizer import Optimizer
+
+# Что можно записать для каждого файла
+BF = "bf"
+BYTECODE = "bytecode"
+FORMATS = (BF, BYTECODE)
+
+# Состояние процесса сборки, создаётся один раз в _init_worker
+_cache = None  # type: CompileCache or None
+
+
+class BuildResult:
+    """ Итог сборки одного файла: артефакты, ошибка и время стадий """
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.artefacts = []  # type: List[str]
+        self.error = None  # type: str or None
+        self.cached = False
+        self.instructions = 0
+        self.compile_time = 0.0
+        self.optimize_time = 0.0
+        self.write_time = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    @property
+    def total_time(self) -> float:
+        return self.compile_time + self.optimize_time + self.write_time
+
+    def __repr__(self):
+        return "BuildResult<{}: {}>".format(
+            self.file_name, "ok" if self.ok else self.error)
+
+
+def _init_worker(cache_directory: str or None):
+    """
+    Прогревает процесс сборки: модули компилятора уже импортированы,
+    хэш компилятора для ключей кэша считается здесь один раз
+    """
+    global _cache
+    compiler_version()
+    _cache = CompileCache(cache_directory) if cache_directory else None
+
+
+def _cores() -> int:
+    """ Доступные процессу ядра: в контейнере их меньше, чем cpu_count """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _artefact(out_dir: str, file_name: str, ext: str) -> str:
+    """ Путь артефакта: структура каталогов исходников сохраняется """
+    rel = os.path.relpath(file_name)
+    if rel.startswith(os.pardir):
+        rel = os.path.basename(file_name)
+    return os.path.join(out_dir, os.path.splitext(rel)[0] + ext)
+
+
+def build_file(file_name: str, out_dir: str, level: int = 3,
+               formats: Iterable[str] = FORMATS) -> BuildResult:
+    """ Компилирует, оптимизирует и записывает артефакты одного файла """
+    result = BuildResult(file_name)
+    try:
+        start = time.perf_counter()
+        compiled = compile_file(file_name, _cache, release=True)
+        result.cached = compiled.cached
+        result.compile_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        program = Program.from_bytecode(
+            Optimizer(level=level).optimize(compiled.program))
+        result.instructions = len(program)
+        result.optimize_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for fmt in formats:
+            if BF == fmt:
+                path = _artefact(out_dir, file_name, ".bf")
+                text = program.compile()
+            else:
+                path = _artefact(out_dir, file_name, ".bc")
+                text = "".join(str(b) + "\n" for b in program)
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, "wt") as f:
+                f.write(text)
+            result.artefacts.append(path)
+        result.write_time = time.perf_counter() - start
+    except Exception as e:
+        # Исключения компилятора держат контексты и не всегда
+        # переносятся между процессами - передаётся только текст
+        result.error = "{}: {}".format(type(e).__name__, e)
+    return result
+
+
+def find_files(patterns: Iterable[str]) -> List[str]:
+    """ Файлы и маски (с `**`) в порядке появления, без повторов """
+    files = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "**", "*.br")
+        matches = sorted(glob.glob(pattern, recursive=True))
+        if not matches and not glob.has_magic(pattern):
+            matches = [pattern]
+        for name in matches:
+            if name not in files:
+                files.append(name)
+    return files
+
+
+def build(patterns: Iterable[str], out_dir: str,
+          jobs: int or None = None,
+          fail_fast: bool = False,
+          level: int = 3,
+          formats: Iterable[str] = FORMATS,
+          cache_directory: str or None = None) -> List[BuildResult]:
+    """
+    Собирает файлы в пуле процессов; результаты - в порядке файлов.
+    С fail_fast после первой ошибки ещё не начатые файлы не собираются
+    и в результат не попадают. jobs=1 собирает в текущем процессе
+    """
+    files = find_files(patterns)
+    formats = tuple(formats)
+    jobs = jobs or _cores()
+
+    if 1 == jobs:
+        _init_worker(cache_directory)
+        results = []
+        for file_name in files:
+            results.append(build_file(file_name, out_dir, level, formats))
+            if fail_fast and not results[-1].ok:
+                break
+        return results
+
+    done = {}
+    with ProcessPoolExecutor(max_workers=min(jobs, len(files) or 1),
+                             initializer=_init_worker,
+                             initargs=(cache_directory,)) as pool:
+        pending = {pool.submit(build_file, name, out_dir, level, formats)
+                   for name in files}
+        while pending:
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            failed = False
+            for future in finished:
+                result = future.result()
+                done[result.file_name] = result
+                failed = failed or not result.ok
+            if fail_fast and failed:
+                for future in pending:
+                    future.cancel()
+                # Уже запущенные дорабатывают, их результаты тоже нужны
+                for future in wait(pending).done:
+                    if not future.cancelled():
+                        result = future.result()
+                        done[result.file_name] = result
+                break
+    return [done[name] for name in files if name in done]
+
+
+def summary(results: List[BuildResult], wall: float) -> List[str]:
+    """ Время стадий по файлам (мс), самые долгие сверху, и итог """
+    lines = ["{:<40} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+        "file", "compile", "optimize", "write", "total", "instr")]
+    for r in sorted(results, key=lambda r: -r.total_time):
+        name = r.file_name if len(r.file_name) <= 40 \
+            else "..." + r.file_name[-37:]
+        if not r.ok:
+            lines.append("{:<40} FAILED {}".format(
+                name, r.error.splitlines()[0]))
+            continue
+        lines.append("{:<40} {:>9} {:>9.1f} {:>9.1f} {:>9.1f} {:>9}".format(
+            name,
+            "cached" if r.cached else "{:.1f}".format(1000 * r.compile_time),
+            1000 * r.optimize_time, 1000 * r.write_time,
+            1000 * r.total_time, r.instructions))
+    busy = sum(r.total_time for r in results)
+    failed = sum(1 for r in results if not r.ok)
+    lines.append("{} files, {} failed, {:.2f}s wall, {:.2f}s in workers "
+                 "({:.1f}x)".format(len(results), failed, wall, busy,
+                                    busy / wall if wall else 0))
+    return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Собирает файлы .br в Brainfuck и bytecode")
+    parser.add_argument("patterns", nargs="+",
+                        help="файлы, каталоги или маски вида src/**/*.br")
+    parser.add_argument("-o", "--out", default="build",
+                        help="каталог артефактов")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="число процессов (по умолчанию - по ядрам)")
+    parser.add_argument("-O", "--level", type=int, default=3,
+                        choices=sorted(Optimizer.levels))
+    parser.add_argument("--format", action="append", choices=FORMATS,
+                        help="что записывать (по умолчанию всё)")
+    parser.add_argument("--fail-fast", action="store_true",
+                        help="остановиться на первой ошибке")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="не использовать кэш компиляции")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    results = build(args.patterns, args.out,
+                    jobs=args.jobs,
+                    fail_fast=args.fail_fast,
+                    level=args.level,
+                    formats=args.format or FORMATS,
+                    cache_directory=None if args.no_cache
+                    else CompileCache().directory)
+    print("\n".join(summary(results, time.perf_counter() - start)))
+    sys.exit(1 if any(not r.ok for r in results) else 0)
@@ -1,3 +1,4 @@
+import os
 from typing import Dict, List
 
 from br_exceptions.parser import *
@@ -5,8 +6,16 @@ from br_lexer import Token, Expression
 from br_parser import Function, Argument, FunctionLifeTime, FunctionType, NameSpace, \
     Variable
 from br_types import IntBrType, IdentifierBrType, BrTypeBrType, \
-    FunctionLifeTimeBrType, AddressBrType
+    FunctionLifeTimeBrType, AddressBrType, StrBrType
 from bytecode import ByteCode as B
+import module_cache
+
+
+def _comment(context: 'Context', text: str, *args) -> B:
+    """ NONE с пояснением; в release-режиме строка не форматируется """
+    if context.release:
+        return B(B.NONE)
+    return B(B.NONE, text.format(*args))
 
 
 class _Nope(Function):
@@ -227,9 +236,8 @@ class _Macro(Function):
         context.ns.symbol_lifetime_push(lifetime, func)
 
         return [
-            B(B.NONE,
-              "Add function `{}` to current namespace".format(function_name)
-              ),
+            _comment(context, "Add function `{}` to current namespace",
+                     function_name),
         ]
 
 macro = _Macro(
@@ -272,9 +280,8 @@ class _MacroBlock(_Macro):
         context.ns.symbol_lifetime_push(lifetime, func)
 
         return [
-            B(B.NONE,
-              "Add macro function `{}` to current namespace".format(function_name)
-              ),
+            _comment(context, "Add macro function `{}` to current namespace",
+                     function_name),
         ]
 
 
@@ -287,34 +294,52 @@ macroblock = _MacroBlock(
 )
 
 
-def _get_first_empty(busy: list) -> int:
-    busy = sorted(busy)
-    for i, v in zip(range(len(busy)), busy):
-        if i != v:
-            return i
-    return len(busy)
+class _Import(Function):
+    """
+    `import "путь"` - добавляет в корневой NameSpace макросы библиотеки.
+    Путь считается от каталога компилируемого файла. Библиотека
+    компилируется один раз и берётся из module_cache.modules
+    """
+    def compile(self, context: 'Context') -> List[B]:
+        path = context.vars['path'].value
+        base = context.source_map.file_name \
+            if context.source_map is not None else ""
+        path = os.path.abspath(os.path.join(os.path.dirname(base), path))
+        module = module_cache.modules.load(path, context)
+        for func in module.functions:
+            context.ns.symbol_global_push(func)
+        context.imports.update(module.files)
+        return [
+            _comment(context, "Import {} functions from `{}`",
+                     len(module.functions), path)
+        ]
+
+
+_import = _Import(
+    'import',
+    [
+        Argument('path', StrBrType)
+    ],
+    FunctionType.NO_BLOCK,
+    FunctionLifeTime.GLOBAL,
+    builtin=True
+)
 
 
 class _Reg(Function):
     def compile(self, context: 'Context') -> List[B]:
         register_name = context.vars['name'].value
-        busy = set()
-        vars = context.ch_ns.get_vars()
-        for var in vars:
-            if isinstance(var.value_type, AddressBrType):
-                busy.add(var.value)
-        empty = _get_first_empty(sorted(list(busy)))
-        context.ns.symbol_push(
-            Variable(register_name, AddressBrType(None, value=empty))
-        )
+        empty = context.ns.free_register()
+        variable = Variable(register_name, AddressBrType(None, value=empty))
+        context.ns.symbol_push(variable)
+        context.ns.hold(variable)
         return [
-            B("#",
-              "Added new variable `{}` "
-              "with address `{}` to local namespace".format(
-                  register_name,
-                  empty
-              )
-              )
+            _comment(context,
+                     "Added new variable `{}` "
+                     "with address `{}` to local namespace",
+                     register_name,
+                     empty
+                     )
         ]
 
 
@@ -341,5 +366,6 @@ builtin_functions = [
     cycle_end,
     macro,
     reg,
-    macroblock
+    macroblock,
+    _import
 ]
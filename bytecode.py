@@ -1,3 +1,10 @@
+import hashlib
+from array import array
+from typing import Dict, Iterable, Iterator, List
+
+from br_exceptions.bytecode import CycleBalanceError
+
+
 class ByteCode:
     NONE = -1
     PLUS = 0
@@ -6,6 +13,10 @@ class ByteCode:
     READ = 3
     CYCLE_IN = 4
     CYCLE_OUT = 5
+    # Операции оптимизатора, в исходном Brainfuck им соответствуют циклы
+    SET = 6  # ячейка = arg
+    MUL = 7  # ячейка[offset] += ячейка * arg
+    SCAN = 8  # пока ячейка не 0: указатель += arg
 
     _associate = {
         "#": (NONE, 1),
@@ -19,61 +30,331 @@ class ByteCode:
         "]": (CYCLE_OUT, 1)
     }
 
-    def __init__(self, op: int or str, arg=None):
+    def __init__(self, op: int or str, arg=None, offset: int = 0,
+                 src: int or None = None):
         assert type(op) is int or type(op) is str
         self.op = op
         self.arg = arg
+        # Смещение ячейки относительно указателя, с которой работает операция
+        self.offset = offset
+        # Номер записи в SourceMap, из которой получена инструкция.
+        # В сравнении не участвует
+        self.src = src
         if isinstance(self.op, str):
             assoc = self._associate[self.op]
             self.op = assoc[0]
             if isinstance(self.arg, int):
                 self.arg *= assoc[1]
 
+    @staticmethod
+    def _wrap(value: int) -> int:
+        """ Значение ячейки по модулю 256 с наименьшим по модулю числом """
+        value %= 256
+        if value > 128:
+            value -= 256
+        return value
+
+    @staticmethod
+    def _plus(value: int) -> str:
+        if value >= 0:
+            return "+" * value
+        else:
+            return "-" * -value
+
+    @staticmethod
+    def _move(value: int) -> str:
+        if value >= 0:
+            return ">" * value
+        else:
+            return "<" * -value
+
     def compile(self) -> str:
+        """
+        MUL отдельно в Brainfuck не выражается: здесь выдаётся только его
+        вклад в тело цикла, сам цикл собирает compile_bytecode
+        """
         if self.PLUS == self.op:
-            if self.arg >= 0:
-                return "+" * self.arg
-            else:
-                return "-" * (-self.arg)
+            code = self._plus(self.arg)
         elif self.MOVE == self.op:
-            if self.arg >= 0:
-                return ">" * self.arg
-            else:
-                return "<" * -self.arg
+            return self._move(self.arg)
         elif self.PRINT == self.op:
-            return "."
+            code = "."
         elif self.READ == self.op:
-            return ","
+            code = ","
         elif self.CYCLE_IN == self.op:
             return "["
         elif self.CYCLE_OUT == self.op:
             return "]"
+        elif self.SET == self.op:
+            code = "[-]" + self._plus(self._wrap(self.arg))
+        elif self.MUL == self.op:
+            code = self._plus(self.arg)
+        elif self.SCAN == self.op:
+            return "[" + self._move(self.arg) + "]"
         else:
             return ""
+        if self.offset:
+            code = self._move(self.offset) + code + self._move(-self.offset)
+        return code
+
+    def __eq__(self, other: 'ByteCode'):
+        if not isinstance(other, ByteCode):
+            return NotImplemented
+        return self.op == other.op and self.arg == other.arg \
+            and self.offset == other.offset
+
+    def __hash__(self):
+        return hash((self.op, self.arg, self.offset))
 
     def __str__(self):
         return repr(self)[2:]
 
     def __repr__(self):
+        at = " @{}".format(self.offset) if self.offset else ""
         if self.PLUS == self.op:
             if self.arg >= 0:
-                return "BC(+, {})".format(self.arg)
+                return "BC(+, {}{})".format(self.arg, at)
             else:
-                return "BC(-, {})".format(-self.arg)
+                return "BC(-, {}{})".format(-self.arg, at)
         elif self.MOVE == self.op:
             if self.arg >= 0:
                 return "BC(>, {})".format(self.arg)
             else:
                 return "BC(<, {})".format(-self.arg)
         elif self.PRINT == self.op:
-            return "BC(.)"
+            return "BC(.{})".format(at)
         elif self.READ == self.op:
-            return "BC(,)"
+            return "BC(,{})".format(at)
         elif self.CYCLE_IN == self.op:
             return "BC([)"
         elif self.CYCLE_OUT == self.op:
             return "BC(])"
+        elif self.SET == self.op:
+            return "BC(=, {}{})".format(self.arg, at)
+        elif self.MUL == self.op:
+            return "BC(*, {}{})".format(self.arg, at)
+        elif self.SCAN == self.op:
+            return "BC(scan, {})".format(self.arg)
         elif self.NONE == self.op:
             return "BC(#, {})".format(self.arg)
         else:
             return "BC(UNKNOWN)"
+
+
+def compile_bytecode(bytecode: Iterable[ByteCode]) -> str:
+    """
+    Переводит bytecode в текст Brainfuck.
+    Смещения операций не оборачиваются в `>...<` по отдельности: указатель
+    Brainfuck сдвигается лениво и возвращается на место только перед
+    операциями, которым нужна ячейка под указателем.
+    Подряд идущие MUL должны заканчиваться SET без смещения - вместе они
+    снова собираются в цикл `[-...]`
+    """
+    parts = []  # type: List[str]
+    muls = []  # type: List[ByteCode]
+    # Где стоит указатель Brainfuck относительно указателя bytecode
+    pos = 0
+
+    def at(offset: int, code: str):
+        nonlocal pos
+        parts.append(ByteCode._move(offset - pos))
+        parts.append(code)
+        pos = offset
+
+    for b in bytecode:
+        if ByteCode.MUL == b.op:
+            if not muls:
+                at(0, "")
+            muls.append(b)
+            continue
+        if muls:
+            if ByteCode.SET != b.op or b.offset:
+                raise ValueError(
+                    "MUL must be followed by SET, got {!r}".format(b))
+            parts.append("[-" + "".join(m.compile() for m in muls) + "]")
+            parts.append(ByteCode._plus(ByteCode._wrap(b.arg)))
+            muls = []
+            continue
+        if ByteCode.MOVE == b.op:
+            pos -= b.arg
+        elif b.op in (ByteCode.PLUS, ByteCode.PRINT, ByteCode.READ,
+                      ByteCode.SET):
+            at(b.offset, ByteCode(b.op, b.arg).compile())
+        else:
+            at(0, b.compile())
+    if muls:
+        raise ValueError("MUL must be followed by SET")
+    at(0, "")
+    return "".join(parts)
+
+
+class Program:
+    """
+    Упакованная программа: параллельные массивы кодов операций,
+    аргументов и смещений.
+    Парные скобки циклов вычисляются один раз при создании и хранятся
+    в отдельном массиве jumps, сами ByteCode при этом не изменяются.
+    Комментарии (ByteCode.NONE) хранятся отдельно, по индексу инструкции.
+    sources - номера записей SourceMap, -1 если источник неизвестен
+    """
+    # Операции, у которых аргумент не используется и всегда None
+    _no_arg = (ByteCode.PRINT, ByteCode.READ,
+               ByteCode.CYCLE_IN, ByteCode.CYCLE_OUT)
+
+    def __init__(self, ops: array = None,
+                 args: array = None,
+                 comments: Dict[int, str] or None = None,
+                 offsets: array = None,
+                 sources: array = None
+                 ):
+        self.ops = ops if ops is not None else array('b')
+        self.args = args if args is not None else array('i')
+        if offsets is None:
+            offsets = array('i', bytes(4 * len(self.ops)))
+        self.offsets = offsets
+        if sources is None:
+            sources = array('i', [-1]) * len(self.ops)
+        self.sources = sources
+        assert len(self.ops) == len(self.args) == len(self.offsets) \
+            == len(self.sources)
+        self.comments = comments or {}  # type: Dict[int, str]
+        self.jumps = None  # type: array
+        self._digest = None  # type: str or None
+        self._calc_jumps()
+
+    @classmethod
+    def from_bytecode(cls, bytecode: Iterable[ByteCode]) -> 'Program':
+        ops = array('b')
+        args = array('i')
+        offsets = array('i')
+        sources = array('i')
+        comments = {}
+        for i, b in enumerate(bytecode):
+            ops.append(b.op)
+            offsets.append(b.offset)
+            sources.append(-1 if b.src is None else b.src)
+            if isinstance(b.arg, int):
+                args.append(b.arg)
+            else:
+                if ByteCode.NONE == b.op:
+                    comments[i] = b.arg
+                args.append(0)
+        return cls(ops, args, comments, offsets, sources)
+
+    def _calc_jumps(self):
+        """ Находит парные скобки циклов """
+        jumps = array('i', bytes(4 * len(self.ops)))
+        stack = []  # type: List[int]
+        cycle_in = ByteCode.CYCLE_IN
+        cycle_out = ByteCode.CYCLE_OUT
+        for i, op in enumerate(self.ops):
+            if cycle_in == op:
+                stack.append(i)
+            elif cycle_out == op:
+                if not stack:
+                    raise CycleBalanceError(i)
+                ip = stack.pop()
+                jumps[ip] = i
+                jumps[i] = ip
+        if stack:
+            raise CycleBalanceError(stack[-1])
+        self.jumps = jumps
+
+    def digest(self) -> str:
+        """ sha256 кодов, аргументов и смещений; считается один раз """
+        if self._digest is None:
+            digest = hashlib.sha256()
+            digest.update(self.ops.tobytes())
+            digest.update(self.args.tobytes())
+            digest.update(self.offsets.tobytes())
+            self._digest = digest.hexdigest()
+        return self._digest
+
+    def to_bytecode(self) -> List[ByteCode]:
+        return list(self)
+
+    def compile(self) -> str:
+        return compile_bytecode(self)
+
+    def __len__(self):
+        return len(self.ops)
+
+    def __getitem__(self, item: int) -> ByteCode:
+        if item < 0:
+            item += len(self.ops)
+        op = self.ops[item]
+        if op in self._no_arg:
+            arg = None
+        elif ByteCode.NONE == op and item in self.comments:
+            arg = self.comments[item]
+        else:
+            arg = self.args[item]
+        src = self.sources[item]
+        return ByteCode(op, arg, self.offsets[item], None if src < 0 else src)
+
+    def __iter__(self) -> Iterator[ByteCode]:
+        for i in range(len(self.ops)):
+            yield self[i]
+
+    def __eq__(self, other: 'Program'):
+        if not isinstance(other, Program):
+            return NotImplemented
+        return self.ops == other.ops \
+            and self.args == other.args \
+            and self.offsets == other.offsets \
+            and self.comments == other.comments
+
+    def __repr__(self):
+        return "Program<{} instructions>".format(len(self))
+
+
+class Preamble:
+    """
+    Состояние после части программы, которая не зависит от ввода
+    (см. optimizer.prefix): лента, ещё не выведенные байты и указатель.
+    Исполнители загружают его сразу (load), а в тексте программы
+    его заменяет setup
+    """
+    def __init__(self, tape: bytes, output: bytes, pointer: int):
+        self.tape = tape
+        self.output = output
+        self.pointer = pointer
+
+    def load(self, memory: 'Memory', channel: 'OutputChannel') -> int:
+        """ Заполняет ленту, отдаёт вывод в канал; возвращает указатель """
+        if self.tape:
+            memory.fit(0, len(self.tape) - 1)
+            memory.data[:len(self.tape)] = self.tape
+        channel.write(self.output)
+        return self.pointer
+
+    def setup(self) -> List[ByteCode]:
+        """
+        bytecode, который строит то же состояние на пустой ленте:
+        вывод печатается через ячейку 0, остальные ячейки набираются
+        прибавками по смещению, в конце указатель встаёт на место
+        """
+        code = []  # type: List[ByteCode]
+        cell = 0
+        for value in self.output:
+            if ByteCode._wrap(value - cell):
+                code.append(ByteCode(ByteCode.PLUS,
+                                     ByteCode._wrap(value - cell)))
+            code.append(ByteCode(ByteCode.PRINT))
+            cell = value
+        for address, value in enumerate(self.tape):
+            if address:
+                cell = 0
+            if ByteCode._wrap(value - cell):
+                code.append(ByteCode(ByteCode.PLUS,
+                                     ByteCode._wrap(value - cell),
+                                     offset=address))
+        if not self.tape and cell:
+            code.append(ByteCode(ByteCode.PLUS, ByteCode._wrap(-cell)))
+        if self.pointer:
+            code.append(ByteCode(ByteCode.MOVE, self.pointer))
+        return code
+
+    def __repr__(self):
+        return "Preamble<{} cells, {} bytes of output, pointer {}>".format(
+            len(self.tape), len(self.output), self.pointer)
@@ -0,0 +1,216 @@
+import hashlib
+import json
+import os
+import sys
+import tempfile
+from array import array
+from typing import Dict, List
+
+from br_compiler import FileCompiler, Lexer
+from builtin_functions import builtin_functions
+from builtin_variables import builtin_variables
+from bytecode import ByteCode, Program
+from module_cache import file_digest
+from source_map import SourceMap
+
+_MAGIC = b"BRCC1\n"
+
+# Модули, от которых зависит результат компиляции
+_COMPILER_MODULES = ("br_lexer", "br_parser", "br_types", "br_compiler",
+                     "builtin_functions", "builtin_variables", "bytecode",
+                     "macro_cache", "module_cache", "registers", "source_map")
+
+_version = None  # type: str or None
+
+
+def compiler_version() -> str:
+    """
+    Хэш исходников компилятора и набора встроенных символов:
+    любое их изменение делает старые записи кэша недействительными
+    """
+    global _version
+    if _version is None:
+        digest = hashlib.sha256()
+        for name in _COMPILER_MODULES:
+            with open(sys.modules[name].__file__, "rb") as f:
+                digest.update(f.read())
+        for symbol in builtin_functions + builtin_variables:
+            digest.update("{}:{}\n".format(
+                type(symbol).__name__, symbol.name).encode())
+        _version = digest.hexdigest()
+    return _version
+
+
+def cache_dir() -> str:
+    """ Каталог кэша компиляции; переопределяется BR_COMPILE_CACHE """
+    path = os.environ.get("BR_COMPILE_CACHE")
+    if not path:
+        path = os.path.join(os.path.expanduser("~"), ".cache",
+                            "brain_rape", "compile")
+    return path
+
+
+class CompiledFile:
+    """ Результат компиляции .br: программа, карта исходника и размер ленты """
+    def __init__(self, program: Program, source_map: SourceMap,
+                 tape_size: int or None, cached: bool = False,
+                 imports: Dict[str, str] or None = None):
+        self.program = program
+        self.source_map = source_map
+        self._tape_size = tape_size
+        # Взят из кэша, компилятор не запускался
+        self.cached = cached
+        # Импортированные файлы: путь -> sha256
+        self.imports = imports or {}
+
+    @classmethod
+    def from_compiler(cls, compiler: FileCompiler) -> 'CompiledFile':
+        return cls(Program.from_bytecode(compiler.bytecode()),
+                   compiler.source_map, compiler.tape_size(),
+                   imports=dict(compiler.context.imports))
+
+    def bytecode(self) -> List[ByteCode]:
+        return self.program.to_bytecode()
+
+    def tape_size(self) -> int or None:
+        return self._tape_size
+
+
+class CompileCache:
+    """
+    Кэш скомпилированных файлов на диске. Ключ - sha256 текста исходника,
+    режима компиляции и compiler_version(), запись хранит Program,
+    SourceMap и tape_size.
+    Запись проверяется по sha256 при загрузке; повреждённая или
+    собранная с изменившимися с тех пор библиотеками `import` считается
+    промахом и удаляется. Ошибки компиляции не кэшируются
+    """
+    def __init__(self, directory: str or None = None):
+        self.directory = directory or cache_dir()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(source: str, release: bool = False) -> str:
+        digest = hashlib.sha256(compiler_version().encode())
+        digest.update(b"release\n" if release else b"debug\n")
+        digest.update(source.encode())
+        return digest.hexdigest()[:40]
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def load(self, key: str, file_name: str = "<main>") -> CompiledFile or None:
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        compiled = self._decode(data, file_name)
+        if compiled is None:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+        return compiled
+
+    @staticmethod
+    def _decode(data: bytes, file_name: str) -> CompiledFile or None:
+        if not data.startswith(_MAGIC):
+            return None
+        try:
+            end = data.index(b"\n", len(_MAGIC))
+            header = json.loads(data[len(_MAGIC):end].decode())
+            payload = data[end + 1:]
+            if hashlib.sha256(payload).hexdigest() != header["digest"]:
+                return None
+            n = header["length"]
+            arrays = []
+            for code in ("b", "i", "i", "i"):
+                arr = array(code)
+                arr.frombytes(payload[:n * arr.itemsize])
+                payload = payload[n * arr.itemsize:]
+                arrays.append(arr)
+            if payload or any(len(arr) != n for arr in arrays):
+                return None
+            ops, args, offsets, sources = arrays
+            comments = {int(i): text
+                        for i, text in header["comments"].items()}
+            program = Program(ops, args, comments, offsets, sources)
+            source_map = SourceMap(file_name)
+            for line, func, chain in header["sources"]:
+                source_map.add(line, func,
+                               tuple((name, call) for name, call in chain))
+            imports = header["imports"]
+        except (ValueError, KeyError, TypeError):
+            return None
+        # Библиотеки, изменившиеся после компиляции, делают запись устаревшей
+        if any(file_digest(path) != digest
+               for path, digest in imports.items()):
+            return None
+        return CompiledFile(program, source_map, header["tape_size"],
+                            cached=True, imports=imports)
+
+    def store(self, key: str, compiled: CompiledFile):
+        program = compiled.program
+        payload = b"".join(arr.tobytes() for arr in (
+            program.ops, program.args, program.offsets, program.sources))
+        header = {
+            "length": len(program),
+            "tape_size": compiled.tape_size(),
+            "comments": {str(i): text
+                         for i, text in program.comments.items()},
+            "sources": [[e.line, e.func, [list(f) for f in e.chain]]
+                        for e in compiled.source_map.entries],
+            "imports": compiled.imports,
+            "digest": hashlib.sha256(payload).hexdigest(),
+        }
+        os.makedirs(self.directory, exist_ok=True)
+        # Запись появляется атомарно: параллельные сборки не мешают
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, "wb") as f:
+            f.write(_MAGIC)
+            f.write(json.dumps(header).encode() + b"\n")
+            f.write(payload)
+        os.replace(tmp, self._path(key))
+
+    def clear(self) -> int:
+        """ Удаляет все записи; возвращает, сколько удалено """
+        removed = 0
+        if not os.path.isdir(self.directory):
+            return removed
+        for name in os.listdir(self.directory):
+            try:
+                os.remove(os.path.join(self.directory, name))
+                removed += 1
+            except OSError:
+                pass
+        return removed
+
+
+def compile_file(file_name: str,
+                 cache: CompileCache or None = None,
+                 release: bool = False) -> CompiledFile:
+    """
+    Компилирует .br или берёт результат из cache, не запуская
+    ни лексер, ни компилятор
+    """
+    with open(file_name, "rt") as f:
+        source = f.read()
+    key = None
+    if cache is not None:
+        key = cache.key(source, release)
+        compiled = cache.load(key, file_name)
+        if compiled is not None:
+            cache.hits += 1
+            return compiled
+        cache.misses += 1
+
+    compiler = FileCompiler(file_name,
+                            Lexer(source.splitlines(True)).block,
+                            release=release)
+    compiler.compile()
+    compiled = CompiledFile.from_compiler(compiler)
+    if cache is not None:
+        cache.store(key, compiled)
+    return compiled
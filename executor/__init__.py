@@ -1 +1,4 @@
-from .main import Interpreter
+from .main import Interpreter, RunResult
+from .pysource import PyInterpreter
+from .native import NativeInterpreter
+from .scheduler import Scheduler
@@ -0,0 +1,171 @@
+from typing import List
+
+import numpy as np
+
+from br_exceptions.executor import MemoryBoundsError
+from bytecode import ByteCode as B, Program
+from executor.channels import EOF_UNCHANGED, _to_bytes
+from executor.main import Memory, RunResult
+
+
+class BatchInterpreter:
+    """
+    Исполняет одну программу сразу на многих вводах.
+    Ленты всех дорожек - двумерный массив uint8 (дорожка x ячейка),
+    каждая инструкция применяется ко всем активным дорожкам одной
+    векторной операцией. Ветвление на циклах решается масками:
+    дорожки, у которых цикл уже кончился, ждут на выходе из него, пока
+    остальные крутятся, и возвращаются в работу после `]`.
+    Лучше всего работает на bytecode после Optimizer
+    """
+    def __init__(self, bytecode: List[B] or Program,
+                 inputs: List[bytes or str],
+                 memory_size: int = 0,
+                 memory_limit: int or None = None,
+                 eof=EOF_UNCHANGED
+                 ):
+        if not isinstance(bytecode, Program):
+            bytecode = Program.from_bytecode(bytecode)
+        self.bytecode = bytecode  # type: Program
+        lanes = len(inputs)
+        self.limit = memory_limit
+        size = max(memory_size, Memory.CHUNK)
+        if memory_limit is not None:
+            size = min(size, memory_limit)
+        self.tapes = np.zeros((lanes, size), dtype=np.uint8)
+        self.MP = np.zeros(lanes, dtype=np.int64)
+        self.steps = np.zeros(lanes, dtype=np.int64)
+
+        data = [_to_bytes(i) if isinstance(i, str) else bytes(i)
+                for i in inputs]
+        width = max([len(i) for i in data] + [0]) + 1
+        self._input = np.zeros((lanes, width), dtype=np.int16)
+        for lane, i in enumerate(data):
+            self._input[lane, :len(i)] = np.frombuffer(i, dtype=np.uint8)
+        self._input_len = np.array([len(i) for i in data], dtype=np.int64)
+        self._input_pos = np.zeros(lanes, dtype=np.int64)
+        self._eof = -1 if EOF_UNCHANGED == eof else eof
+        # Вывод собирается событиями (дорожки, значения) и разбирается в конце
+        self._events = []  # type: List[tuple]
+        self.outputs = [b""] * lanes  # type: List[bytes]
+
+    def _fit(self, cells: np.ndarray):
+        """ Проверяет адреса и расширяет ленты всех дорожек """
+        if not len(cells):
+            return
+        low = int(cells.min())
+        if low < 0:
+            raise MemoryBoundsError(low, self.limit)
+        high = int(cells.max())
+        size = self.tapes.shape[1]
+        if high < size:
+            return
+        if self.limit is not None and high >= self.limit:
+            raise MemoryBoundsError(high, self.limit)
+        new = max(high + 1, 2 * size)
+        if self.limit is not None:
+            new = min(new, self.limit)
+        grown = np.zeros((self.tapes.shape[0], new), dtype=np.uint8)
+        grown[:, :size] = self.tapes
+        self.tapes = grown
+
+    def run(self) -> List[RunResult]:
+        program = self.bytecode
+        ops = program.ops
+        args = program.args
+        offsets = program.offsets
+        jumps = program.jumps
+        end = len(ops)
+        mp = self.MP
+        steps = self.steps
+
+        idx = np.arange(self.tapes.shape[0])
+        # Активные дорожки до входа в каждый из открытых циклов
+        stack = []  # type: List[np.ndarray]
+        # Сколько инструкций подряд выполнил текущий набор дорожек
+        streak = 0
+        pc = 0
+        while pc < end and len(idx):
+            op = ops[pc]
+            streak += 1
+            if B.CYCLE_IN == op or B.CYCLE_OUT == op:
+                active = self.tapes[idx, mp[idx]] != 0
+                steps[idx] += streak
+                streak = 0
+                if B.CYCLE_IN == op:
+                    if not active.any():
+                        pc = jumps[pc] + 1
+                        continue
+                    stack.append(idx)
+                    idx = idx[active]
+                elif active.any():
+                    idx = idx[active]
+                    pc = jumps[pc]
+                else:
+                    idx = stack.pop()
+            elif B.MOVE == op:
+                mp[idx] += args[pc]
+                self._fit(mp[idx])
+            elif B.PLUS == op:
+                cells = mp[idx] + offsets[pc]
+                self._fit(cells)
+                self.tapes[idx, cells] += np.uint8(args[pc] & 255)
+            elif B.SET == op:
+                cells = mp[idx] + offsets[pc]
+                self._fit(cells)
+                self.tapes[idx, cells] = args[pc] & 255
+            elif B.MUL == op:
+                # Как и заменённый цикл, MUL не трогает дорожки с нулём
+                source = self.tapes[idx, mp[idx]].astype(np.int64)
+                lanes = idx[source != 0]
+                cells = mp[lanes] + offsets[pc]
+                self._fit(cells)
+                self.tapes[lanes, cells] += \
+                    ((source[source != 0] * args[pc]) & 255).astype(np.uint8)
+            elif B.PRINT == op:
+                cells = mp[idx] + offsets[pc]
+                self._fit(cells)
+                self._events.append((idx, self.tapes[idx, cells]))
+            elif B.READ == op:
+                cells = mp[idx] + offsets[pc]
+                self._fit(cells)
+                pos = self._input_pos[idx]
+                values = np.where(pos < self._input_len[idx],
+                                  self._input[idx, np.minimum(
+                                      pos, self._input.shape[1] - 1)],
+                                  self._eof)
+                self._input_pos[idx] = pos + 1
+                got = values >= 0
+                self.tapes[idx[got], cells[got]] = values[got]
+            elif B.SCAN == op:
+                # Каждая дорожка ищет свой ноль, пока не найдут все
+                moving = idx
+                while len(moving):
+                    moving = moving[self.tapes[moving, mp[moving]] != 0]
+                    mp[moving] += args[pc]
+                    self._fit(mp[moving])
+            pc += 1
+        steps[idx] += streak
+
+        self._collect()
+        return [RunResult(int(n), RunResult.HALT) for n in steps]
+
+    def _collect(self):
+        """ Раскладывает события вывода по дорожкам в порядке появления """
+        if not self._events:
+            return
+        lanes = np.concatenate([lanes for lanes, _ in self._events])
+        values = np.concatenate([values for _, values in self._events])
+        order = np.argsort(lanes, kind="stable")
+        lanes = lanes[order]
+        values = values[order]
+        bounds = np.searchsorted(lanes, np.arange(len(self.outputs) + 1))
+        self.outputs = [values[bounds[i]:bounds[i + 1]].tobytes()
+                        for i in range(len(self.outputs))]
+        self._events = []
+
+    def memory(self, lane: int) -> Memory:
+        """ Лента одной дорожки в виде Memory, как у Interpreter """
+        memory = Memory(0, self.limit)
+        memory.data = bytearray(self.tapes[lane].tobytes())
+        return memory
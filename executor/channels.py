@@ -0,0 +1,242 @@
+import asyncio
+import io
+import mmap
+from typing import BinaryIO, TextIO
+
+# Что получает `,` после конца ввода
+EOF_UNCHANGED = "unchanged"  # ячейка не меняется
+EOF_ZERO = 0
+EOF_MAX = 255
+
+# read_byte асинхронного канала: ввода пока нет, но он ещё будет
+WOULD_BLOCK = -2
+
+TEXT = "text"
+BYTES = "bytes"
+
+
+def _to_bytes(data: str) -> bytes:
+    """
+    Текст переводится в байты по младшему байту кода символа -
+    так же, как раньше `ord(ch)` записывался в ячейку по модулю 256
+    """
+    return data.encode("utf-32-le")[::4]
+
+
+class InputChannel:
+    """
+    Ввод для `,`: читает источник крупными кусками и отдаёт по байту.
+    Источник - текстовый или бинарный поток, bytes или mmap (без копирования).
+    В конце ввода read_byte возвращает значение по политике eof, а для
+    EOF_UNCHANGED - -1
+    """
+    CHUNK = 1 << 16
+
+    def __init__(self, source=None, eof=EOF_UNCHANGED, chunk_size: int = CHUNK):
+        if eof not in (EOF_UNCHANGED, EOF_ZERO, EOF_MAX):
+            raise ValueError("Unknown EOF policy {!r}".format(eof))
+        self.eof = eof
+        self.chunk_size = chunk_size
+        self._stream = None
+        self._buffer = b""
+        self._pos = 0
+        # Смещение начала _buffer от начала ввода
+        self._base = 0
+        if isinstance(source, (bytes, bytearray, memoryview, mmap.mmap)):
+            self._buffer = source
+        elif isinstance(source, str):
+            self._buffer = _to_bytes(source)
+        elif source is not None:
+            self._stream = source
+
+    @classmethod
+    def of(cls, source, eof=EOF_UNCHANGED) -> 'InputChannel':
+        """ Канал как есть или новый канал поверх источника """
+        if isinstance(source, InputChannel):
+            return source
+        return cls(source, eof)
+
+    @classmethod
+    def from_file(cls, path: str, eof=EOF_UNCHANGED) -> 'InputChannel':
+        """ Ввод из файла через mmap: файл не читается в память целиком """
+        with open(path, "rb") as f:
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Пустой файл отобразить нельзя
+                data = b""
+        return cls(data, eof)
+
+    @property
+    def eof_value(self) -> int:
+        return -1 if EOF_UNCHANGED == self.eof else self.eof
+
+    def _fill(self) -> bool:
+        """ Подчитывает следующий кусок потока; False - ввод кончился """
+        if self._stream is None:
+            return False
+        data = self._stream.read(self.chunk_size)
+        if not data:
+            self._stream = None
+            return False
+        if isinstance(data, str):
+            data = _to_bytes(data)
+        self._base += len(self._buffer)
+        self._buffer = data
+        self._pos = 0
+        return True
+
+    def read_byte(self) -> int:
+        if self._pos >= len(self._buffer) and not self._fill():
+            return self.eof_value
+        value = self._buffer[self._pos]
+        self._pos += 1
+        return value
+
+    def tell(self) -> int:
+        """ Сколько байт ввода уже прочитано """
+        return self._base + self._pos
+
+    def seek(self, position: int) -> bool:
+        """
+        Возвращается к позиции ввода, если она ещё в буфере.
+        Для bytes и mmap это любая позиция; False - вернуться нельзя
+        """
+        if not self._base <= position <= self._base + len(self._buffer):
+            return False
+        self._pos = position - self._base
+        return True
+
+    def read_all(self) -> bytes:
+        """ Весь оставшийся ввод """
+        parts = [bytes(self._buffer[self._pos:])]
+        self._pos = len(self._buffer)
+        while self._fill():
+            parts.append(bytes(self._buffer))
+            self._pos = len(self._buffer)
+        return b"".join(parts)
+
+
+class OutputChannel:
+    """
+    Вывод для `.`: байты копятся в bytearray и сбрасываются в поток, когда
+    их набирается buffer_size, перед чтением ввода и в конце работы.
+    В режиме TEXT байты пишутся символами chr(byte), в режиме BYTES - как
+    есть. Без явного режима он выбирается по типу потока
+    """
+    SIZE = 1 << 13
+
+    def __init__(self, stream: TextIO or BinaryIO or None = None,
+                 mode: str or None = None,
+                 buffer_size: int = SIZE):
+        if mode is None:
+            mode = TEXT if isinstance(stream, io.TextIOBase) \
+                or hasattr(stream, "encoding") else BYTES
+        if mode not in (TEXT, BYTES):
+            raise ValueError("Unknown output mode {!r}".format(mode))
+        self.stream = stream
+        self.mode = mode
+        self.buffer_size = buffer_size
+        self.buffer = bytearray()
+
+    @classmethod
+    def of(cls, stream) -> 'OutputChannel':
+        if isinstance(stream, OutputChannel):
+            return stream
+        return cls(stream)
+
+    def put(self, value: int):
+        buffer = self.buffer
+        buffer.append(value)
+        if len(buffer) >= self.buffer_size:
+            self.flush()
+
+    def write(self, data: bytes):
+        self.buffer += data
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        if self.stream is not None:
+            if TEXT == self.mode:
+                self.stream.write(self.buffer.decode("latin-1"))
+            else:
+                self.stream.write(bytes(self.buffer))
+        self.buffer.clear()
+
+
+class AsyncInputChannel(InputChannel):
+    """
+    Ввод, который приходит по частям из event loop: feed добавляет данные,
+    close отмечает конец ввода. Пока данных нет, read_byte возвращает
+    WOULD_BLOCK, и Interpreter.run останавливается перед `,`, а
+    run_async ждёт wait()
+    """
+    def __init__(self, eof=EOF_UNCHANGED):
+        super().__init__(b"", eof)
+        self.closed = False
+        self._ready = asyncio.Event()
+
+    def feed(self, data: bytes or str):
+        if self.closed:
+            raise ValueError("Input channel is closed")
+        if isinstance(data, str):
+            data = _to_bytes(data)
+        # Прочитанное отбрасываем, tell продолжает считать от начала ввода
+        self._base += self._pos
+        self._buffer = self._buffer[self._pos:] + data
+        self._pos = 0
+        self._ready.set()
+
+    def close(self):
+        self.closed = True
+        self._ready.set()
+
+    def read_byte(self) -> int:
+        if self._pos >= len(self._buffer):
+            return self.eof_value if self.closed else WOULD_BLOCK
+        value = self._buffer[self._pos]
+        self._pos += 1
+        return value
+
+    async def wait(self):
+        """ Ждёт, пока появятся данные или ввод закроют """
+        while self._pos >= len(self._buffer) and not self.closed:
+            self._ready.clear()
+            await self._ready.wait()
+
+
+class AsyncOutputChannel(OutputChannel):
+    """
+    Вывод для async for: каждый сброс буфера становится куском bytes
+    в очереди, итерация кончается после close
+    """
+    def __init__(self, buffer_size: int = OutputChannel.SIZE):
+        super().__init__(None, BYTES, buffer_size)
+        self._queue = asyncio.Queue()
+        self.closed = False
+
+    def flush(self):
+        if not self.buffer:
+            return
+        self._queue.put_nowait(bytes(self.buffer))
+        self.buffer.clear()
+
+    def close(self):
+        if not self.closed:
+            self.flush()
+            self.closed = True
+            self._queue.put_nowait(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        chunk = await self._queue.get()
+        if chunk is None:
+            # Повторные итерации тоже должны кончаться
+            self._queue.put_nowait(None)
+            raise StopAsyncIteration
+        return chunk
@@ -1,110 +1,652 @@
-from typing import List
-from typing import Tuple
+import asyncio
+import itertools
+import operator
+import re
+from array import array
+from typing import Dict, Iterator, List, Tuple
 
 import sys
 
-from bytecode import ByteCode as B
+from br_exceptions.executor import MemoryBoundsError, SnapshotError
+from bytecode import ByteCode as B, Preamble, Program
+from executor.channels import EOF_UNCHANGED, WOULD_BLOCK, \
+    AsyncOutputChannel, InputChannel, OutputChannel
+from executor.profile import Profile
+from executor.snapshot import Snapshot
 
 
 class Memory:
+    """
+    Лента на bytearray. Растёт удвоением, но не больше limit ячеек.
+    Обращение по отрицательному адресу или за limit - MemoryBoundsError
+    """
     CHUNK = 64
     DEFAULT = 0
 
-    class MemoryIterator:
-        def __init__(self, memory: 'Memory'):
-            self.cur = 0
-            self.memory = memory
+    _nonzero = re.compile(b'[^\\x00]+')
 
-        def __next__(self):
-            val = self.memory[self.cur]
-            self.cur += 1
-            return val
+    def __init__(self, size: int = 0, limit: int or None = None):
+        if limit is not None and size > limit:
+            raise MemoryBoundsError(size - 1, limit)
+        self.data = bytearray(size)
+        self.limit = limit
 
-    def __init__(self):
-        self.cur_len = 0
-        self.data = []
+    @property
+    def cur_len(self) -> int:
+        return len(self.data)
 
-    def __iter__(self):
-        return self.MemoryIterator(self)
+    def __iter__(self) -> Iterator[int]:
+        return itertools.chain(self.data, itertools.repeat(self.DEFAULT))
 
     def __getitem__(self, item: int) -> int:
-        if item >= self.cur_len:
+        if item < 0:
+            raise MemoryBoundsError(item, self.limit)
+        if item >= len(self.data):
             return self.DEFAULT
         return self.data[item]
 
     def __setitem__(self, key: int, value: int):
-        while key >= self.cur_len:
-            self.cur_len += self.CHUNK
-            self.data += [self.DEFAULT] * self.CHUNK
-        self.data[key] = value % 256
+        if not 0 <= key < len(self.data):
+            self.grow(key)
+        self.data[key] = value & 255
 
-    def __eq__(self, other: dict):
-        for k, v in other.items():
-            assert self[k] == v
-        return True
+    def grow(self, key: int):
+        """ Расширяет память так, чтобы key в неё попадал """
+        if key < 0 or (self.limit is not None and key >= self.limit):
+            raise MemoryBoundsError(key, self.limit)
+        if key < len(self.data):
+            return
+        size = max(key + 1, 2 * len(self.data), self.CHUNK)
+        if self.limit is not None:
+            size = min(size, self.limit)
+        self.data.extend(bytes(size - len(self.data)))
 
-    def get_items(self):
+    def fit(self, low: int, high: int):
+        """ Проверяет, что адреса low..high допустимы, и дорастает до high """
+        if low < 0:
+            raise MemoryBoundsError(low, self.limit)
+        self.grow(high)
+
+    def __eq__(self, other: Dict[int, int] or 'Memory' or bytes):
+        if isinstance(other, Memory):
+            other = other.data
+        if isinstance(other, (bytes, bytearray)):
+            return self.data.rstrip(b'\0') == other.rstrip(b'\0')
+        if not other:
+            return True
+        keys = list(other.keys())
+        if min(keys) < 0:
+            return False
+        # Сравниваем одним срезом ленты, дополненной нулями
+        top = max(keys) + 1
+        data = self.data[:top]
+        if len(data) < top:
+            data.extend(bytes(top - len(data)))
+        try:
+            values = bytes(other.values())
+        except ValueError:
+            return False
+        if 1 == len(keys):
+            return data[keys[0]] == values[0]
+        return bytes(operator.itemgetter(*keys)(data)) == values
+
+    def get_items(self) -> Dict[int, int]:
         d = {}
-        for k in range(self.cur_len):
-            v = self[k]
-            if v != 0:
+        for match in self._nonzero.finditer(self.data):
+            for k, v in enumerate(match.group(), match.start()):
                 d[k] = v
         return d
 
     def __str__(self):
-        return str(self.data)
+        return str(list(self.data))
+
+
+class RunResult:
+    """ Итог Interpreter.run: сколько инструкций выполнено и почему остановились """
+    HALT = "halt"  # программа закончилась
+    BUDGET = "budget"  # исчерпан max_steps
+    INPUT = "input"  # `,` ждёт ввода из AsyncInputChannel
+
+    def __init__(self, steps: int, reason: str):
+        self.steps = steps
+        self.reason = reason
+
+    @property
+    def halted(self) -> bool:
+        return self.HALT == self.reason
+
+    def __repr__(self):
+        return "RunResult<{self.reason}, {self.steps} steps>".format(
+            self=self
+        )
 
 
 class Interpreter:
-    def __init__(self, bytecode: List[B],
+    # Виды записей в таблице диспетчеризации; 0 - середина участка
+    _K_ADD = 1
+    _K_MOVE = 2
+    _K_SEG = 3
+    _K_NOP = 4
+    _K_IN = 5
+    _K_OUT = 6
+    _K_PRINT = 7
+    _K_READ = 8
+    _K_LOOP = 9
+    _K_SET = 10
+    _K_MUL = 11
+    _K_SCAN = 12
+    _K_OPS = {
+        B.CYCLE_IN: _K_IN,
+        B.CYCLE_OUT: _K_OUT,
+        B.PRINT: _K_PRINT,
+        B.READ: _K_READ,
+        B.SET: _K_SET,
+        B.SCAN: _K_SCAN,
+    }
+
+    def __init__(self, bytecode: List[B] or Program,
                  output=sys.stdout,
-                 inp=sys.stdin
+                 inp=sys.stdin,
+                 memory_size: int = 0,
+                 memory_limit: int or None = None,
+                 eof=EOF_UNCHANGED,
+                 preamble: Preamble or None = None
                  ):
-        self.memory = Memory()
-        self.bytecode = bytecode
-        self._pre_calc()
+        """
+        memory_size - сколько ячеек выделить сразу (см. FileCompiler.tape_size),
+        memory_limit - больше скольких ячеек лента расти не может,
+        eof - что читает `,` после конца ввода (см. executor.channels).
+        output и inp - потоки или уже готовые OutputChannel/InputChannel.
+        preamble - состояние, с которого начинается bytecode
+        (см. optimizer.prefix), загружается сразу
+        """
+        self.memory = Memory(memory_size, memory_limit)
+        if not isinstance(bytecode, Program):
+            bytecode = Program.from_bytecode(bytecode)
+        self.bytecode = bytecode  # type: Program
         self.output = output
         self.input = inp
+        self.out_channel = OutputChannel.of(output)
+        self.in_channel = InputChannel.of(inp, eof)
         self.MP = 0
+        if preamble is not None:
+            self.MP = preamble.load(self.memory, self.out_channel)
         self.PC = 0
-
-    def _pre_calc(self):
-        stack = []  # type: List[Tuple[int, B]]
-        bytecode = []
-        for i, b in zip(
-                range(len(self.bytecode)),
-                self.bytecode
-        ):
-            if B.CYCLE_IN == b.op:
-                stack.append((i, b))
-            elif B.CYCLE_OUT == b.op:
-                ip, bp = stack.pop()
-                bp.arg = i
-                b.arg = ip
-
-            bytecode.append(b)
-        self.bytecode = bytecode
+        self._table = None  # type: Tuple[array, ...]
+        self._snapshot = None  # type: Snapshot or None
 
     def step(self):
-        b = self.bytecode[self.PC]
-
-        if b.PLUS == b.op:
-            self.memory[self.MP] += b.arg
-        elif b.MOVE == b.op:
-            self.MP += b.arg
-        elif b.PRINT == b.op:
-            print(chr(self.memory[self.MP]), end='', file=self.output)
-        elif b.READ == b.op:
-            cache = self.input.read(1)
-            self.memory[self.MP] = ord(cache[0])
-        elif b.CYCLE_IN == b.op:
+        program = self.bytecode
+        pc = self.PC
+        op = program.ops[pc]
+
+        if B.PLUS == op:
+            self.memory[self.MP + program.offsets[pc]] += program.args[pc]
+        elif B.MOVE == op:
+            self.MP += program.args[pc]
+            if self.MP < 0:
+                raise MemoryBoundsError(self.MP, self.memory.limit)
+        elif B.PRINT == op:
+            self.out_channel.put(self.memory[self.MP + program.offsets[pc]])
+        elif B.READ == op:
+            self.out_channel.flush()
+            value = self.in_channel.read_byte()
+            if WOULD_BLOCK == value:
+                # Ввода ещё нет - инструкция не выполнена
+                return
+            if value >= 0:
+                self.memory[self.MP + program.offsets[pc]] = value
+        elif B.CYCLE_IN == op:
             if 0 == self.memory[self.MP]:
-                self.PC = b.arg
-        elif b.CYCLE_OUT == b.op:
+                pc = program.jumps[pc]
+        elif B.CYCLE_OUT == op:
             if 0 != self.memory[self.MP]:
-                self.PC = b.arg
+                pc = program.jumps[pc]
+        elif B.SET == op:
+            self.memory[self.MP + program.offsets[pc]] = program.args[pc]
+        elif B.MUL == op:
+            value = self.memory[self.MP]
+            if value:
+                self.memory[self.MP + program.offsets[pc]] += \
+                    value * program.args[pc]
+        elif B.SCAN == op:
+            while self.memory[self.MP]:
+                self.MP += program.args[pc]
 
-        self.PC += 1
+        self.PC = pc + 1
 
-        if self.PC >= len(self.bytecode):
+        if self.PC >= len(program.ops):
+            self.out_channel.flush()
             raise EOFError()
+
+    def _decode(self):
+        """
+        Строит таблицу диспетчеризации для run.
+        Прямолинейные участки из PLUS/MOVE/NONE сворачиваются в одну запись:
+        набор пар (смещение, прибавка) и итоговый сдвиг указателя. Запись
+        лежит по индексу первой инструкции участка, nxt указывает на первую
+        инструкцию после него, поэтому счёт шагов ведётся по исходным pc.
+        """
+        program = self.bytecode
+        ops = program.ops
+        args = program.args
+        offsets = program.offsets
+        end = len(ops)
+
+        kind = array('b', bytes(end))
+        off = array('i', bytes(4 * end))
+        val = array('i', bytes(4 * end))
+        shift = array('i', bytes(4 * end))
+        # Крайние адреса (относительно указателя), которых касается запись,
+        # включая итоговое положение указателя
+        low = array('i', bytes(4 * end))
+        reach = array('i', bytes(4 * end))
+        nxt = array('i', bytes(4 * end))
+        pairs = {}  # type: Dict[int, Tuple[Tuple[int, int], ...]]
+        loops = {}  # type: Dict[int, Tuple[tuple, int, int, int]]
+
+        straight = (B.PLUS, B.MOVE, B.NONE)
+        pc = 0
+        while pc < end:
+            op = ops[pc]
+            if B.MUL == op:
+                # Подряд идущие MUL читают одну исходную ячейку
+                seg_start = pc
+                seg = []
+                while pc < end and B.MUL == ops[pc]:
+                    seg.append((offsets[pc], args[pc]))
+                    pc += 1
+                kind[seg_start] = self._K_MUL
+                pairs[seg_start] = tuple(seg)
+                low[seg_start] = min(0, min(o for o, _ in seg))
+                reach[seg_start] = max(0, max(o for o, _ in seg))
+                nxt[seg_start] = pc
+                continue
+            if op not in straight:
+                kind[pc] = self._K_OPS[op]
+                off[pc] = offsets[pc]
+                low[pc] = min(0, offsets[pc])
+                reach[pc] = max(0, offsets[pc])
+                val[pc] = args[pc] & 255
+                shift[pc] = args[pc]
+                nxt[pc] = pc + 1
+                pc += 1
+                continue
+
+            seg_start = pc
+            cur = 0
+            deltas = {}  # type: Dict[int, int]
+            while pc < end and ops[pc] in straight:
+                if B.PLUS == ops[pc]:
+                    o = cur + offsets[pc]
+                    deltas[o] = deltas.get(o, 0) + args[pc]
+                elif B.MOVE == ops[pc]:
+                    cur += args[pc]
+                pc += 1
+            seg = tuple((o, d & 255) for o, d in sorted(deltas.items())
+                        if d & 255)
+
+            nxt[seg_start] = pc
+            shift[seg_start] = cur
+            low[seg_start] = min([cur] + [o for o, _ in seg])
+            reach[seg_start] = max([cur] + [o for o, _ in seg])
+            if not seg:
+                kind[seg_start] = self._K_MOVE if cur else self._K_NOP
+            elif 1 == len(seg):
+                kind[seg_start] = self._K_ADD
+                off[seg_start], val[seg_start] = seg[0]
+            else:
+                kind[seg_start] = self._K_SEG
+                pairs[seg_start] = seg
+
+        # Циклы, тело которых - один прямолинейный участок, крутятся
+        # во внутреннем цикле run без диспетчеризации
+        jumps = program.jumps
+        for pc in range(end):
+            if self._K_IN != kind[pc]:
+                continue
+            body = pc + 1
+            out = jumps[pc]
+            if body == out or nxt[body] != out or kind[body] not in (
+                    self._K_ADD, self._K_SEG, self._K_MOVE, self._K_NOP):
+                continue
+            if self._K_SEG == kind[body]:
+                seg = pairs[body]
+            elif self._K_ADD == kind[body]:
+                seg = ((off[body], val[body]),)
+            else:
+                seg = ()
+            # Цикл без сдвига с нечётным шагом по своей ячейке - счётный:
+            # число итераций находится через обратный по модулю 256 шаг
+            step = dict(seg).get(0, 0)
+            inv = pow(step, -1, 256) if not shift[body] and step % 2 else 0
+            kind[pc] = self._K_LOOP
+            loops[pc] = (seg, shift[body], low[body], reach[body], out - pc,
+                         inv)
+
+        self._table = (kind, off, val, shift, low, reach, nxt, pairs, loops)
+
+    def run(self, max_steps: int or None = None) -> RunResult:
+        """
+        Выполняет программу до конца или до исчерпания max_steps инструкций.
+        Всё состояние на время работы держится в локальных переменных,
+        а в self сохраняется при выходе, так что run можно продолжать
+        и чередовать со step.
+        """
+        if self._table is None:
+            self._decode()
+        kind, off, val, shift, low, reach, nxt, pairs, loops = self._table
+        jumps = self.bytecode.jumps
+        end = len(kind)
+        budget = -1 if max_steps is None else max_steps
+
+        steps = 0
+        # Если step остановился посреди свёрнутого участка - дошагиваем
+        while self.PC < end and not kind[self.PC] and steps != budget:
+            steps += 1
+            try:
+                self.step()
+            except EOFError:
+                pass
+
+        memory = self.memory
+        data = memory.data
+        channel = self.out_channel
+        out = channel.buffer
+        flush_at = channel.buffer_size
+        read_byte = self.in_channel.read_byte
+        starved = False
+
+        k_add = self._K_ADD
+        k_move = self._K_MOVE
+        k_seg = self._K_SEG
+        k_in = self._K_IN
+        k_out = self._K_OUT
+        k_print = self._K_PRINT
+        k_read = self._K_READ
+        k_loop = self._K_LOOP
+        k_set = self._K_SET
+        k_mul = self._K_MUL
+        k_scan = self._K_SCAN
+
+        mp = self.MP
+        pc = self.PC
+        if not 0 <= mp < memory.cur_len:
+            memory.fit(mp, mp)
+        size = memory.cur_len
+
+        # Выполненные инструкции считаются по прямому ходу pc: start - начало
+        # текущего непрерывного участка, переход по циклу закрывает участок
+        start = pc
+        limit = end if budget < 0 else min(end, pc + budget - steps)
+
+        while pc < limit:
+            k = kind[pc]
+            if k_add == k:
+                n = nxt[pc]
+                if n > limit:
+                    break
+                if mp + low[pc] < 0 or mp + reach[pc] >= size:
+                    memory.fit(mp + low[pc], mp + reach[pc])
+                    size = memory.cur_len
+                p = mp + off[pc]
+                data[p] = (data[p] + val[pc]) & 255
+                mp += shift[pc]
+                pc = n
+            elif k_out == k:
+                if data[mp]:
+                    steps += pc + 1 - start
+                    pc = jumps[pc] + 1
+                    start = pc
+                    if budget >= 0:
+                        limit = min(end, pc + budget - steps)
+                else:
+                    pc += 1
+            elif k_in == k:
+                if data[mp]:
+                    pc += 1
+                else:
+                    steps += pc + 1 - start
+                    pc = jumps[pc] + 1
+                    start = pc
+                    if budget >= 0:
+                        limit = min(end, pc + budget - steps)
+            elif k_loop == k:
+                # cost - тело и закрывающая скобка, выполняемые за итерацию
+                seg, sh, lo, rc, cost, inv = loops[pc]
+                cap = (limit - pc - 1) // cost if budget >= 0 else -1
+                it = 0
+                v = data[mp]
+                if inv and v and (cap < 0 or (-v * inv) & 255 <= cap):
+                    it = (-v * inv) & 255
+                    if mp + lo < 0 or mp + rc >= size:
+                        memory.fit(mp + lo, mp + rc)
+                        size = memory.cur_len
+                    for o, d in seg:
+                        p = mp + o
+                        data[p] = (data[p] + d * it) & 255
+                while data[mp] and it != cap:
+                    if mp + lo < 0 or mp + rc >= size:
+                        memory.fit(mp + lo, mp + rc)
+                        size = memory.cur_len
+                    for o, d in seg:
+                        p = mp + o
+                        data[p] = (data[p] + d) & 255
+                    mp += sh
+                    it += 1
+                steps += pc - start + 1 + it * cost
+                if data[mp]:
+                    # бюджет кончился посреди цикла - стоим в начале тела
+                    pc += 1
+                else:
+                    pc = jumps[pc] + 1
+                start = pc
+                if budget >= 0:
+                    limit = min(end, pc + budget - steps)
+            elif k_set == k:
+                p = mp + off[pc]
+                if not 0 <= p < size:
+                    memory.fit(p, p)
+                    size = memory.cur_len
+                data[p] = val[pc]
+                pc += 1
+            elif k_mul == k:
+                n = nxt[pc]
+                if n > limit:
+                    break
+                v = data[mp]
+                if v:
+                    if mp + low[pc] < 0 or mp + reach[pc] >= size:
+                        memory.fit(mp + low[pc], mp + reach[pc])
+                        size = memory.cur_len
+                    for o, f in pairs[pc]:
+                        p = mp + o
+                        data[p] = (data[p] + v * f) & 255
+                pc = n
+            elif k_scan == k:
+                stride = shift[pc]
+                if 1 == stride:
+                    mp = data.find(0, mp)
+                    if mp < 0:
+                        # За концом выделенной памяти всё нули
+                        mp = size
+                elif -1 == stride:
+                    mp = data.rfind(0, 0, mp + 1)
+                    if mp < 0:
+                        raise MemoryBoundsError(-1, memory.limit)
+                else:
+                    while 0 <= mp < size and data[mp]:
+                        mp += stride
+                if not 0 <= mp < size:
+                    memory.fit(mp, mp)
+                    size = memory.cur_len
+                pc += 1
+            elif k_move == k:
+                n = nxt[pc]
+                if n > limit:
+                    break
+                mp += shift[pc]
+                if not 0 <= mp < size:
+                    memory.fit(mp, mp)
+                    size = memory.cur_len
+                pc = n
+            elif k_seg == k:
+                n = nxt[pc]
+                if n > limit:
+                    break
+                if mp + low[pc] < 0 or mp + reach[pc] >= size:
+                    memory.fit(mp + low[pc], mp + reach[pc])
+                    size = memory.cur_len
+                for o, d in pairs[pc]:
+                    p = mp + o
+                    data[p] = (data[p] + d) & 255
+                mp += shift[pc]
+                pc = n
+            elif k_print == k:
+                p = mp + off[pc]
+                if not 0 <= p < size:
+                    memory.fit(p, p)
+                    size = memory.cur_len
+                out.append(data[p])
+                if len(out) >= flush_at:
+                    channel.flush()
+                pc += 1
+            elif k_read == k:
+                channel.flush()
+                p = mp + off[pc]
+                if not 0 <= p < size:
+                    memory.fit(p, p)
+                    size = memory.cur_len
+                v = read_byte()
+                if v >= 0:
+                    data[p] = v
+                elif WOULD_BLOCK == v:
+                    starved = True
+                    break
+                pc += 1
+            else:
+                n = nxt[pc]
+                if n > limit:
+                    break
+                pc = n
+
+        steps += pc - start
+
+        self.MP = mp
+        self.PC = pc
+
+        # Свёрнутый участок пересекает границу бюджета - остаток по одной
+        while self.PC < limit and not starved:
+            self.step()
+            steps += 1
+        channel.flush()
+
+        if self.PC >= end:
+            return RunResult(steps, RunResult.HALT)
+        if starved:
+            return RunResult(steps, RunResult.INPUT)
+        return RunResult(steps, RunResult.BUDGET)
+
+    async def run_async(self, slice_size: int = 10000) -> RunResult:
+        """
+        Выполняет программу в event loop кусками по slice_size инструкций,
+        отдавая управление другим задачам между кусками. С AsyncInputChannel
+        `,` без данных ждёт их, не блокируя loop; AsyncOutputChannel
+        закрывается в конце, и его async for завершается
+        """
+        steps = 0
+        try:
+            while True:
+                result = self.run(slice_size)
+                steps += result.steps
+                if result.halted:
+                    return RunResult(steps, RunResult.HALT)
+                if RunResult.INPUT == result.reason:
+                    await self.in_channel.wait()
+                else:
+                    await asyncio.sleep(0)
+        finally:
+            if isinstance(self.out_channel, AsyncOutputChannel):
+                self.out_channel.close()
+
+    def checkpoint(self) -> Snapshot:
+        """
+        Снимок ленты, MP, PC и позиции ввода. Неизменившиеся с прошлого
+        снимка или restore страницы ленты не копируются, а берутся оттуда
+        """
+        self.out_channel.flush()
+        self._snapshot = Snapshot.take(
+            self.memory.data, self.MP, self.PC, self.in_channel.tell(),
+            self.bytecode.digest(), self._snapshot)
+        return self._snapshot
+
+    def restore(self, snapshot: Snapshot, inp=None):
+        """
+        Возвращает состояние из снимка. С inp исполнение продолжится
+        с новым вводом, иначе ввод возвращается к позиции снимка
+        """
+        if snapshot.program != self.bytecode.digest():
+            raise SnapshotError("снимок сделан для другой программы")
+        if inp is not None:
+            self.input = inp
+            self.in_channel = InputChannel.of(inp, self.in_channel.eof)
+        elif not self.in_channel.seek(snapshot.input_position):
+            raise SnapshotError("ввод нельзя вернуть к позиции `{}`".format(
+                snapshot.input_position))
+        limit = self.memory.limit
+        if limit is not None and snapshot.size > limit:
+            raise MemoryBoundsError(snapshot.size - 1, limit)
+        self.out_channel.flush()
+        self.memory.data[:] = snapshot.tape()
+        self.MP = snapshot.MP
+        self.PC = snapshot.PC
+        self._snapshot = snapshot
+
+    def profile(self) -> Profile:
+        """
+        Выполняет программу до конца по одной инструкции и считает
+        выполнения инструкций, итерации циклов и обращения к ячейкам.
+        Гораздо медленнее run; отчёт по строкам .br строится через
+        Program.sources и SourceMap компилятора
+        """
+        program = self.bytecode
+        ops = program.ops
+        offsets = program.offsets
+        jumps = program.jumps
+        memory = self.memory
+        result = Profile(program)
+        hits = result.hits
+        loops = result.loops
+        cells = result.cells
+        addressed = (B.PLUS, B.PRINT, B.READ, B.SET)
+        high = result.high_water
+        end = len(ops)
+
+        while self.PC < end:
+            pc = self.PC
+            mp = self.MP
+            op = ops[pc]
+            hits[pc] += 1
+            if op in addressed:
+                cell = mp + offsets[pc]
+                cells[cell] += 1
+            elif B.MOVE != op and B.NONE != op:
+                cell = mp
+                cells[mp] += 1
+                if B.MUL == op:
+                    cell = mp + offsets[pc]
+                    cells[cell] += 1
+                elif B.CYCLE_IN == op and memory[mp]:
+                    loops[pc] += 1
+                elif B.CYCLE_OUT == op and memory[mp]:
+                    loops[jumps[pc]] += 1
+            else:
+                cell = mp
+            try:
+                self.step()
+            except EOFError:
+                pass
+            high = max(high, cell, self.MP)
+
+        result.high_water = high
+        return result
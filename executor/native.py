@@ -0,0 +1,355 @@
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from typing import Dict, List, Tuple
+
+from br_exceptions.executor import MemoryBoundsError, NativeBuildError
+from bytecode import ByteCode as B, Preamble, Program
+from executor.channels import EOF_UNCHANGED, InputChannel, OutputChannel
+from executor.main import Memory, RunResult
+from executor.pysource import program_hash
+
+# Код возврата программы при выходе за границы памяти
+_EXIT_BOUNDS = 3
+
+_PRELUDE = """
+#define EXIT_BOUNDS {bounds}
+""".format(bounds=_EXIT_BOUNDS) + r"""
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+
+static unsigned char *tape;
+static long n, limit;
+static int eof;
+
+static void bounds(long address)
+{
+    fflush(stdout);
+    fprintf(stderr, "%ld\n", address);
+    exit(EXIT_BOUNDS);
+}
+
+static void fit(long low, long high)
+{
+    long size;
+    if (low < 0)
+        bounds(low);
+    if (high < n)
+        return;
+    if (limit >= 0 && high >= limit)
+        bounds(high);
+    size = 2 * n > high + 1 ? 2 * n : high + 1;
+    if (size < 64)
+        size = 64;
+    if (limit >= 0 && size > limit)
+        size = limit;
+    tape = realloc(tape, size);
+    memset(tape + n, 0, size - n);
+    n = size;
+}
+
+static void dump(const char *path, long p)
+{
+    FILE *f = fopen(path, "wb");
+    fprintf(f, "%ld\n", p);
+    fwrite(tape, 1, n, f);
+    fclose(f);
+}
+
+static long load(const char *path)
+{
+    FILE *f = fopen(path, "rb");
+    long p = 0, i = 0;
+    int c;
+    if (!f)
+        return 0;
+    if (1 == fscanf(f, "%ld", &p) && '\n' == fgetc(f))
+        while (EOF != (c = fgetc(f))) {
+            fit(0, i);
+            tape[i++] = (unsigned char)c;
+        }
+    fclose(f);
+    return p;
+}
+
+static int get(void)
+{
+    int c = getchar();
+    return EOF == c ? eof : c;
+}
+
+int main(int argc, char **argv)
+{
+    long p = 0;
+    unsigned char v;
+    int c;
+    (void)v;
+    (void)c;
+    n = atol(argv[2]);
+    limit = atol(argv[3]);
+    eof = atoi(argv[4]);
+    tape = calloc(n ? n : 1, 1);
+    setvbuf(stdout, NULL, _IOFBF, 1 << 16);
+    fit(0, 0);
+    if (argc > 5)
+        p = load(argv[5]);
+"""
+
+_EPILOGUE = """
+    fflush(stdout);
+    dump(argv[1], p);
+    return 0;
+}
+"""
+
+
+class CSourceGenerator:
+    """
+    Переводит bytecode в единицу трансляции на C.
+    Лента - `unsigned char *`, переполнение ячеек даёт сама арифметика C.
+    Прямолинейные участки сворачиваются так же, как в PySourceGenerator,
+    циклы становятся `while (tape[p])`. Границы проверяются перед каждым
+    участком, лента растёт через realloc.
+    """
+    INDENT = "    "
+
+    def __init__(self, program: Program):
+        self.program = program
+
+    def generate(self) -> str:
+        lines = self._block(0, len(self.program), 1)
+        return _PRELUDE + "\n".join(lines) + _EPILOGUE
+
+    def _block(self, start: int, stop: int, level: int) -> List[str]:
+        program = self.program
+        ops = program.ops
+        lines = []  # type: List[str]
+        segment = []  # type: List[B]
+        pc = start
+        while pc < stop:
+            op = ops[pc]
+            if op in (B.PLUS, B.MOVE, B.NONE, B.SET, B.PRINT, B.READ):
+                segment.append(program[pc])
+                pc += 1
+                continue
+            lines += self._segment(segment, level)
+            segment = []
+            if B.CYCLE_IN == op:
+                out = program.jumps[pc]
+                lines.append(self._at(level, "while (tape[p]) {"))
+                lines += self._block(pc + 1, out, level + 1)
+                lines.append(self._at(level, "}"))
+                pc = out + 1
+            elif B.MUL == op:
+                group = []  # type: List[Tuple[int, int]]
+                while pc < stop and B.MUL == ops[pc]:
+                    group.append((program.offsets[pc], program.args[pc]))
+                    pc += 1
+                lines += self._mul(group, level)
+            elif B.SCAN == op:
+                lines += self._scan(program.args[pc], level)
+                pc += 1
+            else:
+                raise ValueError("Unexpected bytecode {!r}".format(
+                    program[pc]))
+        lines += self._segment(segment, level)
+        return lines
+
+    def _segment(self, segment: List[B], level: int) -> List[str]:
+        """ Прямолинейный участок: виртуальный указатель, свёрнутые прибавки """
+        code = []  # type: List[str]
+        pending = {}  # type: Dict[int, int]
+        touched = set()
+        virtual = 0
+
+        def flush(cell: int):
+            delta = pending.pop(cell, 0) & 255
+            if delta:
+                code.append("{} += {};".format(self._cell(cell), delta))
+
+        for b in segment:
+            if B.MOVE == b.op:
+                virtual += b.arg
+                continue
+            if B.NONE == b.op:
+                continue
+            cell = virtual + b.offset
+            touched.add(cell)
+            if B.PLUS == b.op:
+                pending[cell] = pending.get(cell, 0) + b.arg
+            elif B.SET == b.op:
+                pending.pop(cell, None)
+                code.append("{} = {};".format(self._cell(cell), b.arg & 255))
+            elif B.PRINT == b.op:
+                flush(cell)
+                code.append("putchar({});".format(self._cell(cell)))
+            else:
+                # При EOF_UNCHANGED ячейка может остаться прежней
+                flush(cell)
+                code.append("if ((c = get()) >= 0) {} = c;".format(
+                    self._cell(cell)))
+        for cell in sorted(pending):
+            flush(cell)
+        if virtual:
+            touched.add(virtual)
+            code.append("p += {};".format(virtual))
+        if touched:
+            code.insert(0, self._check(min(touched), max(touched)))
+        return [self._at(level, line) for line in code]
+
+    def _mul(self, group: List[Tuple[int, int]], level: int) -> List[str]:
+        """ Группа MUL выполняется, только если исходная ячейка не 0 """
+        low = min(0, min(o for o, _ in group))
+        high = max(0, max(o for o, _ in group))
+        code = ["if (tape[p]) {",
+                self.INDENT + self._check(low, high),
+                self.INDENT + "v = tape[p];"]
+        for offset, factor in group:
+            code.append(self.INDENT + "{} += v * {};".format(
+                self._cell(offset), factor))
+        code.append("}")
+        return [self._at(level, line) for line in code]
+
+    def _scan(self, stride: int, level: int) -> List[str]:
+        if 1 == stride:
+            code = ["{",
+                    self.INDENT + "unsigned char *z = memchr(tape + p, 0, "
+                                  "n - p);",
+                    self.INDENT + "p = z ? z - tape : n;",
+                    "}"]
+        else:
+            code = ["while (p >= 0 && p < n && tape[p]) p += {};".format(
+                stride)]
+        code.append("if (p < 0 || p >= n) fit(p, p);")
+        return [self._at(level, line) for line in code]
+
+    @staticmethod
+    def _check(low: int, high: int) -> str:
+        return "if (p + {l} < 0 || p + {h} >= n) fit(p + {l}, p + {h});" \
+            .format(l=low, h=high)
+
+    @staticmethod
+    def _cell(offset: int) -> str:
+        if offset > 0:
+            return "tape[p + {}]".format(offset)
+        elif offset < 0:
+            return "tape[p - {}]".format(-offset)
+        return "tape[p]"
+
+    def _at(self, level: int, line: str) -> str:
+        return self.INDENT * level + line
+
+
+def cache_dir() -> str:
+    """ Каталог собранных программ; переопределяется BR_NATIVE_CACHE """
+    path = os.environ.get("BR_NATIVE_CACHE")
+    if not path:
+        path = os.path.join(os.path.expanduser("~"), ".cache",
+                            "brain_rape", "native")
+    return path
+
+
+def build_program(program: Program,
+                  compiler: str or None = None,
+                  flags: Tuple[str, ...] = ("-O2",)
+                  ) -> str:
+    """
+    Собирает программу системным компилятором C и возвращает путь
+    к исполняемому файлу. Сборка кэшируется на диске по хэшу программы
+    """
+    compiler = compiler or os.environ.get("CC") or shutil.which("cc")
+    if not compiler:
+        raise NativeBuildError("cc", "компилятор C не найден")
+    digest = hashlib.sha256(_PRELUDE.encode())
+    digest.update(program_hash(program).encode())
+    digest.update(" ".join((compiler,) + tuple(flags)).encode())
+    key = digest.hexdigest()[:40]
+    directory = cache_dir()
+    path = os.path.join(directory, key)
+    if os.path.exists(path):
+        return path
+
+    os.makedirs(directory, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        source = os.path.join(tmp, "program.c")
+        binary = os.path.join(tmp, "program")
+        with open(source, "wt") as f:
+            f.write(CSourceGenerator(program).generate())
+        result = subprocess.run(
+            [compiler] + list(flags) + ["-o", binary, source],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if result.returncode:
+            raise NativeBuildError(compiler,
+                                   result.stderr.decode(errors="replace"))
+        # Готовый файл появляется атомарно: параллельные сборки не мешают
+        os.replace(binary, path)
+    return path
+
+
+class NativeInterpreter:
+    """
+    Исполнитель, который собирает программу в машинный код через cc.
+    Интерфейс как у executor.Interpreter: memory, output, input, MP и run().
+    Ввод читается заранее целиком, вывод и лента возвращаются после
+    завершения программы; steps в RunResult - None
+    """
+    def __init__(self, bytecode: List[B] or Program,
+                 output=sys.stdout,
+                 inp=sys.stdin,
+                 memory_size: int = 0,
+                 memory_limit: int or None = None,
+                 eof=EOF_UNCHANGED,
+                 preamble: Preamble or None = None
+                 ):
+        """ preamble - как у executor.Interpreter """
+        if not isinstance(bytecode, Program):
+            bytecode = Program.from_bytecode(bytecode)
+        self.bytecode = bytecode  # type: Program
+        self.memory = Memory(memory_size, memory_limit)
+        self.output = output
+        self.input = inp
+        self.out_channel = OutputChannel.of(output)
+        self.in_channel = InputChannel.of(inp, eof)
+        self.MP = 0
+        self.preamble = preamble
+        self.path = build_program(bytecode)
+
+    def _input_bytes(self) -> bytes:
+        if B.READ not in self.bytecode.ops:
+            return b""
+        return self.in_channel.read_all()
+
+    def run(self) -> RunResult:
+        memory = self.memory
+        limit = -1 if memory.limit is None else memory.limit
+        with tempfile.TemporaryDirectory() as tmp:
+            dump = os.path.join(tmp, "memory")
+            args = [self.path, dump, str(len(memory.data)), str(limit),
+                    str(self.in_channel.eof_value)]
+            if self.preamble is not None:
+                # Начальное состояние - в том же формате, что и дамп
+                start = os.path.join(tmp, "preamble")
+                with open(start, "wb") as f:
+                    f.write(b"%d\n" % self.preamble.pointer)
+                    f.write(self.preamble.tape)
+                args.append(start)
+                self.out_channel.write(self.preamble.output)
+            result = subprocess.run(
+                args,
+                input=self._input_bytes(),
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            self.out_channel.write(result.stdout)
+            self.out_channel.flush()
+            if _EXIT_BOUNDS == result.returncode:
+                raise MemoryBoundsError(int(result.stderr), memory.limit)
+            if result.returncode:
+                raise NativeBuildError(self.path, "код возврата {}".format(
+                    result.returncode))
+            with open(dump, "rb") as f:
+                self.MP = int(f.readline())
+                memory.data[:] = f.read()
+        return RunResult(None, RunResult.HALT)
@@ -0,0 +1,97 @@
+from array import array
+from collections import Counter
+from typing import Dict, List, Tuple
+
+from bytecode import Program
+from source_map import SourceMap
+
+
+class Profile:
+    """
+    Счётчики профилирующего запуска Interpreter.profile:
+    hits - сколько раз выполнена каждая инструкция,
+    loops - сколько итераций сделал цикл (по индексу его `[`),
+    cells - сколько раз обращались к каждой ячейке,
+    high_water - наибольший адрес, которого касалась программа
+    """
+    def __init__(self, program: Program):
+        self.program = program
+        self.hits = array('q', bytes(8 * len(program)))
+        self.loops = Counter()  # type: Dict[int, int]
+        self.cells = Counter()  # type: Dict[int, int]
+        self.high_water = 0
+
+    @property
+    def steps(self) -> int:
+        return sum(self.hits)
+
+    def _entries(self, source_map: SourceMap):
+        sources = self.program.sources
+        for pc, hits in enumerate(self.hits):
+            if hits:
+                src = sources[pc]
+                yield (source_map[src] if src >= 0 else None), hits
+
+    def by_line(self, source_map: SourceMap) -> List[Tuple[int, int]]:
+        """ Инструкции, выполненные из каждой строки .br, по убыванию """
+        lines = Counter()
+        for entry, hits in self._entries(source_map):
+            lines[entry.line if entry else -1] += hits
+        return lines.most_common()
+
+    def by_macro(self, source_map: SourceMap) -> List[Tuple[str, int, int]]:
+        """
+        (макрос, собственные, включая вложенные вызовы) по убыванию
+        включающей стоимости. Собственные - инструкции, выданные
+        встроенными функциями прямо в теле макроса
+        """
+        own = Counter()
+        total = Counter()
+        for entry, hits in self._entries(source_map):
+            if entry is None or not entry.chain:
+                name = source_map.file_name
+                own[name] += hits
+                total[name] += hits
+                continue
+            own[entry.chain[-1][0]] += hits
+            # Рекурсивный макрос учитывается в total один раз
+            for name in {name for name, _ in entry.chain}:
+                total[name] += hits
+        return sorted(((name, own[name], cost)
+                       for name, cost in total.items()),
+                      key=lambda item: -item[2])
+
+    def folded(self, source_map: SourceMap) -> List[str]:
+        """ Строки `кадр;кадр;... счётчик` для flamegraph.pl """
+        stacks = Counter()
+        for entry, hits in self._entries(source_map):
+            frames = [source_map.file_name]
+            frames += entry.frames() if entry else ["?"]
+            stacks[";".join(frames)] += hits
+        return ["{} {}".format(stack, hits)
+                for stack, hits in sorted(stacks.items())]
+
+    def report(self, source_map: SourceMap, top: int = 20) -> List[str]:
+        steps = self.steps or 1
+        lines = ["{} steps, memory high-water mark {}".format(
+            self.steps, self.high_water)]
+
+        lines.append("{:>8} {:>12} {:>7}".format("line", "steps", "%"))
+        for line, hits in self.by_line(source_map)[:top]:
+            lines.append("{:>8} {:>12} {:>6.1f}%".format(
+                line, hits, 100 * hits / steps))
+
+        lines.append("{:<20} {:>12} {:>12}".format("macro", "self", "total"))
+        for name, own, total in self.by_macro(source_map)[:top]:
+            lines.append("{:<20} {:>12} {:>12}".format(name, own, total))
+
+        lines.append("{:>8} {:>12}".format("loop", "iterations"))
+        for pc, iterations in self.loops.most_common(top):
+            src = self.program.sources[pc]
+            where = "line {}".format(source_map[src].line) if src >= 0 else ""
+            lines.append("{:>8} {:>12} {}".format(pc, iterations, where))
+
+        lines.append("{:>8} {:>12}".format("cell", "accesses"))
+        for cell, accesses in self.cells.most_common(top):
+            lines.append("{:>8} {:>12}".format(cell, accesses))
+        return lines
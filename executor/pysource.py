@@ -0,0 +1,272 @@
+import sys
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+from bytecode import ByteCode as B, Preamble, Program
+from executor.channels import EOF_UNCHANGED, InputChannel, OutputChannel
+from executor.main import Memory, RunResult
+from optimizer.analysis import tape_size
+
+
+class PySourceGenerator:
+    """
+    Переводит bytecode в исходный код на Python.
+    Прямолинейные участки сворачиваются: указатель сдвигается виртуально,
+    прибавки к одной ячейке складываются, `p` меняется только на границах
+    циклов. Циклы становятся `while tape[p]:`, а слишком глубоко вложенные
+    выносятся в отдельные функции - у CPython ограничена вложенность блоков.
+    Если размер ленты не доказан, перед каждым участком проверяются границы.
+    """
+    MAX_DEPTH = 16
+    INDENT = "    "
+
+    def __init__(self, program: Program, checked: bool = True):
+        self.program = program
+        self.checked = checked
+        self.functions = []  # type: List[List[str]]
+
+    def generate(self) -> str:
+        self._function("_main", 0, len(self.program))
+        lines = []
+        for function in self.functions:
+            lines += function
+            lines.append("")
+        return "\n".join(lines)
+
+    def _function(self, name: str, start: int, stop: int):
+        """ Функция (tape, p, n) -> (p, n) над инструкциями [start, stop) """
+        lines = [
+            "def {}(tape, p, n):".format(name),
+            "    put = _put",
+            "    get = _get",
+            "    fit = _fit",
+        ]
+        self.functions.append(lines)
+        lines += self._block(start, stop, 1)
+        lines.append("    return p, n")
+
+    def _block(self, start: int, stop: int, level: int) -> List[str]:
+        program = self.program
+        ops = program.ops
+        lines = []  # type: List[str]
+        segment = _Segment()
+        pc = start
+        while pc < stop:
+            op = ops[pc]
+            if B.CYCLE_IN == op:
+                lines += self._finish(segment, level)
+                segment = _Segment()
+                out = program.jumps[pc]
+                if level >= self.MAX_DEPTH:
+                    name = "_loop{}".format(pc)
+                    self._function(name, pc, out + 1)
+                    lines.append(self._at(level, "p, n = {}(tape, p, n)".format(
+                        name)))
+                else:
+                    lines.append(self._at(level, "while tape[p]:"))
+                    lines += self._block(pc + 1, out, level + 1) or [
+                        self._at(level + 1, "pass")]
+                pc = out + 1
+                continue
+            if B.SCAN == op:
+                lines += self._finish(segment, level)
+                segment = _Segment()
+                lines += self._scan(program.args[pc], level)
+            elif B.MUL == op:
+                lines += self._finish(segment, level)
+                segment = _Segment()
+                group = []
+                while pc < stop and B.MUL == ops[pc]:
+                    group.append((program.offsets[pc], program.args[pc]))
+                    pc += 1
+                lines += self._mul(group, level)
+                continue
+            else:
+                segment.push(program[pc])
+            pc += 1
+        lines += self._finish(segment, level)
+        return lines
+
+    def _finish(self, segment: '_Segment', level: int) -> List[str]:
+        code = segment.code()
+        if self.checked and segment.touched:
+            low = min(segment.touched)
+            high = max(segment.touched)
+            code.insert(0, "if p < {} or p + {} >= n: n = fit(p + {}, p + {})"
+                        .format(-low, high, low, high))
+        return [self._at(level, line) for line in code]
+
+    def _mul(self, group: List[Tuple[int, int]], level: int) -> List[str]:
+        """
+        Группа MUL выполняется, только если исходная ячейка не 0 - как цикл,
+        который она заменила. Границы проверяются внутри этого условия
+        """
+        code = ["if tape[p]:"]
+        if self.checked:
+            low = min(0, min(o for o, _ in group))
+            high = max(0, max(o for o, _ in group))
+            code.append(self.INDENT + "if p < {} or p + {} >= n: "
+                        "n = fit(p + {}, p + {})".format(-low, high, low, high))
+        code.append(self.INDENT + "v = tape[p]")
+        for offset, factor in group:
+            cell = _Segment._cell(offset)
+            code.append(self.INDENT + "{c} = ({c} + v{f}) & 255".format(
+                c=cell, f="" if 1 == factor else " * {}".format(factor)))
+        return [self._at(level, line) for line in code]
+
+    def _scan(self, stride: int, level: int) -> List[str]:
+        if 1 == stride:
+            code = ["p = tape.find(0, p)",
+                    "if p < 0: p = n"]
+        elif -1 == stride:
+            code = ["p = tape.rfind(0, 0, p + 1)"]
+        else:
+            code = ["while 0 <= p < n and tape[p]: p += {}".format(stride)]
+        code.append("if not 0 <= p < n: n = fit(p, p)")
+        return [self._at(level, line) for line in code]
+
+    def _at(self, level: int, line: str) -> str:
+        return self.INDENT * level + line
+
+
+class _Segment:
+    """ Прямолинейный участок: виртуальный указатель и отложенные прибавки """
+    def __init__(self):
+        self.virtual = 0
+        self.pending = OrderedDict()  # type: Dict[int, int]
+        self.touched = set()
+        self.lines = []  # type: List[str]
+
+    @staticmethod
+    def _cell(offset: int) -> str:
+        if offset > 0:
+            return "tape[p + {}]".format(offset)
+        elif offset < 0:
+            return "tape[p - {}]".format(-offset)
+        return "tape[p]"
+
+    def _flush(self, cell: int):
+        delta = self.pending.pop(cell, 0) & 255
+        if delta:
+            self.lines.append("{c} = ({c} + {d}) & 255".format(
+                c=self._cell(cell), d=delta))
+
+    def push(self, b: B):
+        cell = self.virtual + b.offset
+        if B.MOVE == b.op:
+            self.virtual += b.arg
+            return
+        if B.NONE == b.op:
+            return
+        self.touched.add(cell)
+        if B.PLUS == b.op:
+            self.pending[cell] = self.pending.get(cell, 0) + b.arg
+        elif B.SET == b.op:
+            self.pending.pop(cell, None)
+            self.lines.append("{} = {}".format(self._cell(cell), b.arg & 255))
+        elif B.PRINT == b.op:
+            self._flush(cell)
+            self.lines.append("put({})".format(self._cell(cell)))
+        elif B.READ == b.op:
+            # При EOF_UNCHANGED ячейка может остаться прежней
+            self._flush(cell)
+            self.lines.append("v = get()")
+            self.lines.append("if v >= 0: {} = v".format(self._cell(cell)))
+        else:
+            raise ValueError("Unexpected bytecode {!r}".format(b))
+
+    def code(self) -> List[str]:
+        for cell in list(self.pending):
+            self._flush(cell)
+        if self.virtual:
+            self.touched.add(self.virtual)
+            self.lines.append("p += {}".format(self.virtual))
+            self.virtual = 0
+        return self.lines
+
+
+_code_cache = OrderedDict()  # type: Dict[Tuple[str, bool], object]
+_CODE_CACHE_SIZE = 64
+
+
+def program_hash(program: Program) -> str:
+    return program.digest()
+
+
+def compile_program(program: Program, checked: bool = True):
+    """ Код-объект программы; кэшируется по хэшу программы """
+    key = (program_hash(program), checked)
+    code = _code_cache.get(key)
+    if code is None:
+        source = PySourceGenerator(program, checked).generate()
+        code = compile(source, "<br program {}>".format(key[0][:12]), "exec")
+        _code_cache[key] = code
+        while len(_code_cache) > _CODE_CACHE_SIZE:
+            _code_cache.popitem(last=False)
+    else:
+        _code_cache.move_to_end(key)
+    return code
+
+
+class PyInterpreter:
+    """
+    Исполнитель, который компилирует программу в Python-код и запускает его.
+    Интерфейс как у executor.Interpreter: memory, output, input, MP и run(),
+    но пошагового режима и бюджета инструкций нет, а steps в RunResult - None
+    """
+    def __init__(self, bytecode: List[B] or Program,
+                 output=sys.stdout,
+                 inp=sys.stdin,
+                 memory_size: int = 0,
+                 memory_limit: int or None = None,
+                 eof=EOF_UNCHANGED,
+                 preamble: Preamble or None = None
+                 ):
+        """
+        memory_size - только подсказка: проверки границ убираются, лишь если
+        tape_size самой программы доказан и в memory_size помещается.
+        preamble - как у executor.Interpreter
+        """
+        if not isinstance(bytecode, Program):
+            bytecode = Program.from_bytecode(bytecode)
+        self.bytecode = bytecode  # type: Program
+        self.memory = Memory(memory_size, memory_limit)
+        self.output = output
+        self.input = inp
+        self.out_channel = OutputChannel.of(output)
+        self.in_channel = InputChannel.of(inp, eof)
+        self.MP = 0
+        if preamble is not None:
+            self.MP = preamble.load(self.memory, self.out_channel)
+        size = len(self.memory.data)
+        proven = tape_size(bytecode, self.MP) if size else None
+        self.checked = proven is None or proven > size
+        self.code = compile_program(bytecode, self.checked)
+
+    def run(self) -> RunResult:
+        memory = self.memory
+        channel = self.out_channel
+        read_byte = self.in_channel.read_byte
+
+        def _get():
+            channel.flush()
+            return read_byte()
+
+        def _fit(low: int, high: int) -> int:
+            memory.fit(low, high)
+            return len(memory.data)
+
+        namespace = {
+            "_put": channel.put,
+            "_get": _get,
+            "_fit": _fit,
+        }
+        exec(self.code, namespace)
+        if not memory.data:
+            memory.grow(0)
+        try:
+            self.MP, _ = namespace["_main"](memory.data, self.MP,
+                                            len(memory.data))
+        finally:
+            channel.flush()
+        return RunResult(None, RunResult.HALT)
@@ -0,0 +1,39 @@
+import asyncio
+from typing import Dict, List
+
+from executor.main import Interpreter, RunResult
+
+
+class Scheduler:
+    """
+    Исполняет много интерпретаторов в одном event loop без потоков.
+    Каждый получает по очереди один квант в slice_size инструкций,
+    а ждущие ввода не занимают очередь, пока ввод не придёт.
+    Очередь готовых задач asyncio - FIFO, поэтому кванты раздаются по кругу
+    """
+    def __init__(self, slice_size: int = 10000):
+        self.slice_size = slice_size
+        self._tasks = {}  # type: Dict[Interpreter, asyncio.Task]
+
+    def spawn(self, interpreter: Interpreter) -> asyncio.Task:
+        """ Запускает интерпретатор; вызывать из работающего event loop """
+        task = asyncio.ensure_future(interpreter.run_async(self.slice_size))
+        self._tasks[interpreter] = task
+        return task
+
+    @property
+    def running(self) -> int:
+        return sum(1 for task in self._tasks.values() if not task.done())
+
+    async def join(self) -> List[RunResult]:
+        """
+        Ждёт все запущенные интерпретаторы, результаты - в порядке spawn.
+        Ошибка одного из них отменяет остальные
+        """
+        tasks = list(self._tasks.values())
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
@@ -0,0 +1,100 @@
+import json
+from typing import BinaryIO, Dict, List, Tuple
+
+from br_exceptions.executor import SnapshotError
+
+PAGE = 4096
+_ZERO = bytes(PAGE)
+_MAGIC = b"BRSNAP1\n"
+
+
+class Snapshot:
+    """
+    Состояние исполнителя: лента по страницам, MP, PC и позиция ввода.
+    Страница - неизменяемый bytes, нулевые страницы не хранятся (None).
+    Снимок, сделанный от предыдущего, берёт у него неизменившиеся страницы,
+    так что новых данных в памяти столько, сколько страниц было изменено
+    """
+    def __init__(self, pages: Tuple[bytes or None, ...], size: int,
+                 mp: int, pc: int, input_position: int, program: str):
+        self.pages = pages
+        self.size = size
+        self.MP = mp
+        self.PC = pc
+        self.input_position = input_position
+        # Хэш программы: восстанавливать можно только в ту же программу
+        self.program = program
+
+    @classmethod
+    def take(cls, data: bytearray, mp: int, pc: int, input_position: int,
+             program: str, parent: 'Snapshot' or None = None) -> 'Snapshot':
+        view = memoryview(data)
+        old = parent.pages if parent is not None else ()
+        pages = []  # type: List[bytes or None]
+        for i, start in enumerate(range(0, len(data), PAGE)):
+            page = view[start:start + PAGE]
+            prev = old[i] if i < len(old) else None
+            if prev is not None and page == prev:
+                pages.append(prev)
+            elif page == _ZERO[:len(page)]:
+                pages.append(None)
+            else:
+                pages.append(bytes(page))
+        view.release()
+        return cls(tuple(pages), len(data), mp, pc, input_position, program)
+
+    def tape(self) -> bytes:
+        parts = [page if page is not None else _ZERO for page in self.pages]
+        return b"".join(parts)[:self.size]
+
+    def shared(self, other: 'Snapshot') -> int:
+        """ Сколько страниц снимки делят между собой, не копируя """
+        return sum(1 for a, b in zip(self.pages, other.pages)
+                   if a is not None and a is b)
+
+    def save(self, f: BinaryIO):
+        """
+        Пишет снимок: заголовок JSON и уникальные ненулевые страницы.
+        Одинаковые страницы записываются один раз
+        """
+        unique = {}  # type: Dict[bytes, int]
+        index = []  # type: List[int]
+        for page in self.pages:
+            if page is None:
+                index.append(-1)
+            else:
+                index.append(unique.setdefault(page, len(unique)))
+        header = {
+            "size": self.size,
+            "mp": self.MP,
+            "pc": self.PC,
+            "input": self.input_position,
+            "program": self.program,
+            "pages": index,
+            "lengths": [len(page) for page in unique],
+        }
+        f.write(_MAGIC)
+        f.write(json.dumps(header).encode() + b"\n")
+        for page in unique:
+            f.write(page)
+
+    @classmethod
+    def load(cls, f: BinaryIO) -> 'Snapshot':
+        if f.readline() != _MAGIC:
+            raise SnapshotError("неизвестный формат снимка")
+        try:
+            header = json.loads(f.readline())
+            unique = [f.read(length) for length in header["lengths"]]
+            pages = tuple(None if i < 0 else unique[i]
+                          for i in header["pages"])
+        except (ValueError, KeyError, IndexError) as e:
+            raise SnapshotError("снимок повреждён: {}".format(e))
+        if any(len(page) != length
+               for page, length in zip(unique, header["lengths"])):
+            raise SnapshotError("снимок обрезан")
+        return cls(pages, header["size"], header["mp"], header["pc"],
+                   header["input"], header["program"])
+
+    def __repr__(self):
+        return "Snapshot<PC {self.PC}, MP {self.MP}, {pages} pages>".format(
+            self=self, pages=len(self.pages))
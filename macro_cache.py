@@ -0,0 +1,150 @@
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+from br_lexer import Block
+from bytecode import ByteCode
+
+
+class Recording:
+    """
+    Что тело макроса прочитало из пространств имён вызывающего,
+    пока раскрывалось. Вешается на NameSpace вызова (NameSpace.recording)
+    """
+    __slots__ = ("reads", "vars", "escaped", "busy")
+
+    def __init__(self, busy: int = 0):
+        # Имя -> найденный снаружи символ (None, если не нашёлся)
+        self.reads = {}  # type: Dict[str, 'Symbol']
+        # Тело выбирало свободную ячейку (`reg`): тогда код зависит
+        # от занятых ячеек в месте вызова - они в busy
+        self.vars = False
+        self.busy = busy
+        # Тело добавило символ в пространство имён снаружи вызова
+        self.escaped = False
+
+
+class _Entry:
+    __slots__ = ("reads", "busy", "code", "sources")
+
+    def __init__(self, reads: Dict[str, 'Symbol'],
+                 busy: int or None,
+                 code: Tuple[Tuple[int, object, int, int], ...],
+                 sources: List[tuple]):
+        self.reads = reads
+        self.busy = busy
+        # (op, arg, offset, индекс в sources или -1)
+        self.code = code
+        # (строка, функция, хвост цепочки вызовов после самого вызова)
+        self.sources = sources
+
+    def valid(self, ns: 'NameSpace') -> bool:
+        for name, symbol in self.reads.items():
+            if ns.find(name) is not symbol:
+                return False
+        return self.busy is None or self.busy == ns.registers.busy
+
+
+class MacroCache:
+    """
+    Кэш раскрытий пользовательских макросов.
+    Ключ - функция, блок вызова (для macroblock) и значения аргументов.
+    Запись годится, если всё, что тело прочитало снаружи (символы по имени
+    и, для `reg`, занятые адреса), в месте нового вызова то же самое.
+    Раскрытия, которые добавляют символы наружу, не кэшируются.
+    Хранится не больше size ключей, по VARIANTS записей на ключ
+    """
+    SIZE = 4096
+    VARIANTS = 4
+
+    def __init__(self, size: int = SIZE):
+        self.size = size
+        self._entries = OrderedDict()  # type: Dict[tuple, List[_Entry]]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _key(context: 'Context') -> tuple or None:
+        block = context.expr if isinstance(context.expr, Block) else None
+        key = (context.func, block, tuple(
+            (type(var.value_type), var.value)
+            for var in context.vars.values()))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def get(self, context: 'Context') -> List[ByteCode] or None:
+        """ Готовый код вызова или None, тогда вызов надо раскрыть """
+        key = self._key(context)
+        if key is None:
+            return None
+        for entry in self._entries.get(key, ()):
+            if entry.valid(context.ns):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._build(context, entry)
+        self.misses += 1
+        return None
+
+    def start(self, context: 'Context'):
+        """ Начинает записывать, что читает раскрытие вызова """
+        context.ch_ns.recording = Recording(context.ns.registers.busy)
+
+    def put(self, context: 'Context', bytecode: List[ByteCode]):
+        """ Запоминает код, выданный раскрытием после start """
+        recording = context.ch_ns.recording
+        context.ch_ns.recording = None
+        key = self._key(context)
+        if key is None or recording is None or recording.escaped:
+            return
+        busy = recording.busy if recording.vars else None
+
+        source_map = context.source_map
+        cut = len(source_map.chain(context)) \
+            if source_map is not None else 0
+        index = {}  # type: Dict[int, int]
+        sources = []  # type: List[tuple]
+        code = []
+        for b in bytecode:
+            i = -1
+            if b.src is not None and source_map is not None:
+                i = index.get(b.src)
+                if i is None:
+                    entry = source_map[b.src]
+                    i = index[b.src] = len(sources)
+                    sources.append(
+                        (entry.line, entry.func, entry.chain[cut:]))
+            code.append((b.op, b.arg, b.offset, i))
+
+        variants = self._entries.setdefault(key, [])
+        variants.insert(0, _Entry(recording.reads, busy, tuple(code),
+                                  sources))
+        del variants[self.VARIANTS:]
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    @staticmethod
+    def _build(context: 'Context', entry: _Entry) -> List[ByteCode]:
+        """
+        Новые ByteCode по записи: оптимизатор может менять их на месте,
+        а src указывает на цепочку вызовов именно этого места
+        """
+        source_map = context.source_map
+        srcs = []  # type: List[int or None]
+        if source_map is not None and entry.sources:
+            prefix = source_map.chain(context)
+            srcs = [source_map.add(line, func, prefix + tail)
+                    for line, func, tail in entry.sources]
+        return [ByteCode(op, arg, offset, srcs[i] if i >= 0 else None)
+                for op, arg, offset, i in entry.code]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return "MacroCache<{} keys, {} hits, {} misses>".format(
+            len(self), self.hits, self.misses)
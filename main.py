@@ -1,9 +1,14 @@
+import argparse
+
 from br_compiler import FileCompiler, Lexer
+from bytecode import Program
+from compile_cache import CompileCache, CompiledFile, compile_file
 from executor import Interpreter
+from optimizer import Optimizer
 
-if __name__ == "__main__":
-    file_name = 'test_files/core.br'
-    block = None
+
+def debug_compile(file_name: str) -> CompiledFile:
+    """ Компиляция с выводом строк, блоков и дерева контекстов """
     with open(file_name, 'rt') as f:
         l = Lexer(f.readlines())
 
@@ -33,23 +38,49 @@ if __name__ == "__main__":
             compiler.context.debug_print()
         )
     )
+    return CompiledFile.from_compiler(compiler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Компилирует и выполняет программу .br")
+    parser.add_argument("file", nargs="?", default="test_files/core.br")
+    parser.add_argument("--debug", action="store_true",
+                        help="печатать строки, блоки и дерево контекстов; "
+                             "кэш компиляции не используется")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="компилировать, не читая и не пополняя кэш")
+    parser.add_argument("--clear-cache", action="store_true",
+                        help="очистить кэш компиляции перед запуском")
+    args = parser.parse_args()
+
+    cache = CompileCache()
+    if args.clear_cache:
+        print("Removed {} cached files".format(cache.clear()))
+
+    if args.debug:
+        compiled = debug_compile(args.file)
+    else:
+        compiled = compile_file(args.file,
+                                cache=None if args.no_cache else cache)
+        if compiled.cached:
+            print("==== CACHED ====")
 
     print("==== BRAINFUCK ====")
-    bytecode = compiler.context.full_bytecode()
-    for code in bytecode:
-        print(code.compile(), end="")
-    print()
+    optimizer = Optimizer()
+    program = Program.from_bytecode(
+        optimizer.optimize(compiled.bytecode())
+    )
+    print(program.compile())
 
-    print("==== EXECUTE ====")
-    interpreter = Interpreter(bytecode)
+    print("==== OPTIMIZER ====")
+    print("\n".join(optimizer.report()))
 
-    try:
-        while True:
-            interpreter.step()
-    except EOFError:
-        pass
+    print("==== EXECUTE ====")
+    interpreter = Interpreter(program, memory_size=compiled.tape_size() or 0)
+    result = interpreter.run()
 
     print()
     print("==== MEMORY ====")
     print(interpreter.memory)
-
+    print("{} steps".format(result.steps))
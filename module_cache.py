@@ -0,0 +1,150 @@
+import hashlib
+import os
+import pickle
+import tempfile
+from typing import Dict, Set, Tuple
+
+from br_exceptions import compiler as compiler_e
+from br_parser import Function
+from bytecode import ByteCode
+
+_MAGIC = b"BRMOD1\n"
+
+# Путь -> ((mtime, размер), sha256): неизменившийся файл не перечитывается
+_digests = {}  # type: Dict[str, Tuple[Tuple[int, int], str]]
+
+
+def file_digest(path: str) -> str or None:
+    """ sha256 содержимого файла или None, если его нельзя прочитать """
+    try:
+        stat = os.stat(path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        known = _digests.get(path)
+        if known is not None and known[0] == stamp:
+            return known[1]
+        with open(path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+    _digests[path] = (stamp, digest)
+    return digest
+
+
+class Module:
+    """
+    Скомпилированная библиотека: определённые в ней макросы и все файлы,
+    от которых она зависит (путь -> sha256), включая её саму
+    """
+    def __init__(self, path: str, functions: Tuple[Function, ...],
+                 files: Dict[str, str]):
+        self.path = path
+        self.functions = functions
+        self.files = files
+
+    def fresh(self) -> bool:
+        return all(file_digest(path) == digest
+                   for path, digest in self.files.items())
+
+
+class ModuleCache:
+    """
+    Кэш библиотек для `import`: файл компилируется один раз за процесс,
+    а между процессами - берётся с диска (pickle функций рядом с кэшем
+    компиляции). Запись годна, пока не изменился ни один файл из files
+    """
+    def __init__(self, directory: str or None = None):
+        self._directory = directory
+        self._modules = {}  # type: Dict[str, Module]
+        self._loading = set()  # type: Set[str]
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def directory(self) -> str:
+        if self._directory is None:
+            from compile_cache import cache_dir
+            self._directory = os.path.join(cache_dir(), "modules")
+        return self._directory
+
+    def _path(self, path: str) -> str:
+        from compile_cache import compiler_version
+        digest = hashlib.sha256(compiler_version().encode())
+        digest.update(path.encode())
+        return os.path.join(self.directory, digest.hexdigest()[:40])
+
+    def load(self, path: str, context: 'Context') -> Module:
+        """ Библиотека по абсолютному пути; context - для ошибок """
+        module = self._modules.get(path)
+        if module is None or not module.fresh():
+            module = self._read(path)
+        if module is None or not module.fresh():
+            self.misses += 1
+            module = self._compile(path, context)
+            self._write(module)
+        else:
+            self.hits += 1
+        self._modules[path] = module
+        return module
+
+    def _compile(self, path: str, context: 'Context') -> Module:
+        from br_compiler import FileCompiler, Lexer
+
+        if path in self._loading:
+            raise compiler_e.ImportCycleError(context=context, path=path)
+        digest = file_digest(path)
+        try:
+            with open(path, "rt") as f:
+                lines = f.readlines()
+        except OSError as e:
+            raise compiler_e.ImportFileError(context=context, path=path,
+                                             reason=e.strerror)
+        self._loading.add(path)
+        try:
+            compiler = FileCompiler(path, Lexer(lines).block, release=True)
+            compiler.compile()
+        finally:
+            self._loading.discard(path)
+        if any(ByteCode.NONE != b.op for b in compiler.bytecode()):
+            raise compiler_e.ImportCodeError(context=context, path=path)
+
+        functions = tuple(
+            symbol for symbol in compiler.context.ch_ns.symbols.values()
+            if isinstance(symbol, Function) and not symbol.builtin)
+        files = dict(compiler.context.imports)
+        files[path] = digest
+        return Module(path, functions, files)
+
+    def _read(self, path: str) -> Module or None:
+        try:
+            with open(self._path(path), "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        if not data.startswith(_MAGIC):
+            return None
+        digest, _, payload = data[len(_MAGIC):].partition(b"\n")
+        if hashlib.sha256(payload).hexdigest().encode() != digest:
+            return None
+        try:
+            module = pickle.loads(payload)
+        except Exception:
+            return None
+        return module if isinstance(module, Module) else None
+
+    def _write(self, module: Module):
+        try:
+            payload = pickle.dumps(module, pickle.HIGHEST_PROTOCOL)
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, "wb") as f:
+                f.write(_MAGIC)
+                f.write(hashlib.sha256(payload).hexdigest().encode() + b"\n")
+                f.write(payload)
+            os.replace(tmp, self._path(module.path))
+        except (OSError, pickle.PicklingError):
+            # Без дискового кэша библиотека просто компилируется заново
+            pass
+
+
+# Общий для всех компиляций процесса
+modules = ModuleCache()
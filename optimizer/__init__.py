@@ -0,0 +1,2 @@
+from .main import Optimizer, PassStats, optimize
+from .analysis import tape_size
@@ -0,0 +1,39 @@
+from typing import Iterable, List
+
+from bytecode import ByteCode as B
+
+
+def tape_size(bytecode: Iterable[B], start: int = 0) -> int or None:
+    """
+    Сколько ячеек ленты нужно программе, если это можно доказать статически:
+    все циклы сбалансированы (тело возвращает указатель на место),
+    поиска нуля (SCAN) нет и указатель не уходит левее нуля.
+    Иначе None. start - где указатель в начале (см. Preamble)
+    """
+    pos = start
+    top = start
+    opened = []  # type: List[int]
+    for b in bytecode:
+        if B.MOVE == b.op:
+            pos += b.arg
+            cell = pos
+        elif B.CYCLE_IN == b.op:
+            opened.append(pos)
+            cell = pos
+        elif B.CYCLE_OUT == b.op:
+            if not opened or opened.pop() != pos:
+                return None
+            cell = pos
+        elif B.SCAN == b.op:
+            return None
+        elif B.MUL == b.op:
+            cell = min(pos, pos + b.offset)
+            top = max(top, pos, pos + b.offset)
+        elif B.NONE == b.op:
+            continue
+        else:
+            cell = pos + b.offset
+        if cell < 0:
+            return None
+        top = max(top, cell)
+    return top + 1
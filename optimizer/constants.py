@@ -0,0 +1,234 @@
+from typing import Dict, List, Set
+
+from bytecode import ByteCode as B
+from optimizer.fold import _normalize
+
+# Сколько итераций цикла можно выполнить при компиляции
+ITERATIONS = 1024
+
+
+class _State:
+    """
+    Что известно о ленте: значения ячеек относительно начала отсчёта
+    (None - неизвестно) и положение указателя. Пока zero, ячейки, которых
+    нет в cells, равны нулю - так лента выглядит в начале программы
+    """
+    __slots__ = ("pos", "cells", "zero")
+
+    def __init__(self, zero: bool):
+        self.pos = 0
+        self.cells = {}  # type: Dict[int, int or None]
+        self.zero = zero
+
+    def get(self, offset: int) -> int or None:
+        cell = self.pos + offset
+        if cell in self.cells:
+            return self.cells[cell]
+        return 0 if self.zero else None
+
+    def set(self, offset: int, value: int or None):
+        self.cells[self.pos + offset] = None if value is None else value % 256
+
+    def forget(self):
+        """ Положение указателя потеряно: неизвестно ничего """
+        self.pos = 0
+        self.cells = {}
+        self.zero = False
+
+    def copy(self) -> '_State':
+        state = _State(self.zero)
+        state.pos = self.pos
+        state.cells = dict(self.cells)
+        return state
+
+
+def _jumps(bytecode: List[B]) -> Dict[int, int]:
+    """ Индекс `[` -> индекс парной `]` """
+    jumps = {}
+    opened = []  # type: List[int]
+    for i, b in enumerate(bytecode):
+        if B.CYCLE_IN == b.op:
+            opened.append(i)
+        elif B.CYCLE_OUT == b.op:
+            jumps[opened.pop()] = i
+    return jumps
+
+
+def _writes(body: List[B]) -> Set[int] or None:
+    """
+    Ячейки (относительно указателя), которые может изменить тело цикла.
+    None, если указатель в теле смещается непредсказуемо
+    """
+    writes = set()
+    pos = 0
+    opened = []  # type: List[int]
+    for b in body:
+        if B.MOVE == b.op:
+            pos += b.arg
+        elif b.op in (B.PLUS, B.SET, B.READ, B.MUL):
+            writes.add(pos + b.offset)
+        elif B.CYCLE_IN == b.op:
+            opened.append(pos)
+        elif B.CYCLE_OUT == b.op:
+            if opened.pop() != pos:
+                return None
+        elif B.SCAN == b.op:
+            return None
+    return writes if not pos else None
+
+
+def _fold(body: List[B], state: _State, result: List[B]) -> bool:
+    """
+    Заменяет цикл с известным числом итераций прямой арифметикой.
+    Тело - только PLUS/SET/MOVE и возвращает указатель на место
+    """
+    if any(b.op not in (B.PLUS, B.SET, B.MOVE) for b in body) \
+            or sum(b.arg for b in body if B.MOVE == b.op):
+        return False
+    touched = sorted({pos for pos in _positions(body)})
+
+    # Все ячейки известны - цикл просто выполняется
+    values = {cell: state.get(cell) for cell in touched}
+    if None not in values.values() and 0 in values:
+        current = dict(values)
+        for _ in range(ITERATIONS):
+            if not current[0]:
+                break
+            pos = 0
+            for b in body:
+                if B.MOVE == b.op:
+                    pos += b.arg
+                elif B.PLUS == b.op:
+                    cell = pos + b.offset
+                    current[cell] = (current[cell] + b.arg) % 256
+                else:
+                    current[pos + b.offset] = b.arg % 256
+        else:
+            return False
+        if current[0]:
+            return False
+        for cell in touched:
+            if current[cell] != values[cell]:
+                result.append(B(B.SET, current[cell], offset=cell))
+                state.set(cell, current[cell])
+        return True
+
+    # Известен только счётчик: тело из одних прибавок
+    if any(B.SET == b.op for b in body):
+        return False
+    deltas = {}  # type: Dict[int, int]
+    pos = 0
+    for b in body:
+        if B.MOVE == b.op:
+            pos += b.arg
+        else:
+            cell = pos + b.offset
+            deltas[cell] = deltas.get(cell, 0) + b.arg
+    start = state.get(0)
+    step = deltas.pop(0, 0)
+    trips = next((k for k in range(1, 257) if not (start + k * step) % 256),
+                 None)
+    if trips is None:
+        return False
+    for cell, delta in sorted(deltas.items()):
+        arg = _normalize(B.PLUS, trips * delta)
+        if arg:
+            result.append(B(B.PLUS, arg, offset=cell))
+            value = state.get(cell)
+            state.set(cell, None if value is None else value + arg)
+    result.append(B(B.SET, 0))
+    state.set(0, 0)
+    return True
+
+
+def _positions(body: List[B]):
+    pos = 0
+    for b in body:
+        if B.MOVE == b.op:
+            pos += b.arg
+        else:
+            yield pos + b.offset
+
+
+def _walk(bytecode: List[B], start: int, stop: int, jumps: Dict[int, int],
+          state: _State, result: List[B]):
+    i = start
+    while i < stop:
+        b = bytecode[i]
+        op = b.op
+        if B.MOVE == op:
+            state.pos += b.arg
+        elif B.PLUS == op:
+            value = state.get(b.offset)
+            state.set(b.offset, None if value is None else value + b.arg)
+        elif B.SET == op:
+            if state.get(b.offset) == b.arg % 256:
+                # Ячейка уже такая: обнуление лишнее
+                i += 1
+                continue
+            state.set(b.offset, b.arg)
+        elif B.READ == op:
+            state.set(b.offset, None)
+        elif B.MUL == op:
+            source = state.get(0)
+            target = state.get(b.offset)
+            if source is not None:
+                # Известный множитель - обычная прибавка
+                arg = _normalize(B.PLUS, source * b.arg)
+                if arg:
+                    result.append(B(B.PLUS, arg, offset=b.offset, src=b.src))
+                state.set(b.offset, None if target is None else target + arg)
+                i += 1
+                continue
+            state.set(b.offset, None)
+        elif B.SCAN == op:
+            result.append(b)
+            state.forget()
+            state.set(0, 0)
+            i += 1
+            continue
+        elif B.CYCLE_IN == op:
+            end = jumps[i]
+            if 0 == state.get(0):
+                # В цикл нельзя войти
+                i = end + 1
+                continue
+            body = bytecode[i + 1:end]
+            folded = []  # type: List[B]
+            if state.get(0) is not None and _fold(body, state, folded):
+                for f in folded:
+                    f.src = b.src
+                result += folded
+                i = end + 1
+                continue
+
+            writes = _writes(body)
+            if writes is None:
+                state.forget()
+            else:
+                for cell in writes | {0}:
+                    state.set(cell, None)
+            result.append(b)
+            _walk(bytecode, i + 1, end, jumps, state.copy(), result)
+            result.append(bytecode[end])
+            if writes is None:
+                state.forget()
+            state.set(0, 0)
+            i = end + 1
+            continue
+        result.append(b)
+        i += 1
+
+
+def constants(bytecode: List[B]) -> List[B]:
+    """
+    Распространение констант: проход помнит известные значения ячеек
+    (в начале лента нулевая, после цикла его ячейка - ноль, после `,` -
+    неизвестна) и по ним убирает циклы, в которые нельзя войти, лишние
+    SET, MUL с известным множителем и циклы с известным числом итераций,
+    которые превращаются в прямую арифметику.
+    Ожидает bytecode после fold и loops. Исходные ByteCode не изменяются
+    """
+    result = []  # type: List[B]
+    _walk(bytecode, 0, len(bytecode), _jumps(bytecode), _State(True), result)
+    return result
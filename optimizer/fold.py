@@ -0,0 +1,40 @@
+from typing import Iterable, List
+
+from bytecode import ByteCode as B
+
+
+def _normalize(op: int, arg: int) -> int:
+    """ PLUS берётся по модулю 256 с наименьшим по модулю значением """
+    if B.PLUS == op:
+        arg = B._wrap(arg)
+    return arg
+
+
+def fold(bytecode: Iterable[B]) -> List[B]:
+    """
+    Сворачивает подряд идущие PLUS и MOVE в одну инструкцию,
+    выбрасывает комментарии (NONE) и нулевые операции.
+    Пары `>`/`<` и `+`/`-` взаимно уничтожаются, в том числе каскадно:
+    `> + - <` не оставляет ничего.
+    PLUS сливаются только с одинаковым смещением, так что проход можно
+    запускать и после offsets.
+    Исходные ByteCode не изменяются.
+    """
+    result = []  # type: List[B]
+    for b in bytecode:
+        if B.NONE == b.op:
+            continue
+        if B.PLUS == b.op or B.MOVE == b.op:
+            arg = b.arg
+            src = b.src
+            if result and result[-1].op == b.op \
+                    and result[-1].offset == b.offset:
+                # Свёрнутая инструкция относится к первой из серии
+                src = result[-1].src
+                arg += result.pop().arg
+            arg = _normalize(b.op, arg)
+            if arg:
+                result.append(B(b.op, arg, offset=b.offset, src=src))
+        else:
+            result.append(b)
+    return result
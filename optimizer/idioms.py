@@ -0,0 +1,75 @@
+from typing import Dict, List
+
+from bytecode import ByteCode as B
+from optimizer.fold import _normalize
+
+
+def _rewrite(body: List[B]) -> List[B] or None:
+    """
+    Переписывает тело цикла без ввода-вывода и вложенных циклов в
+    SET/MUL/SCAN. Возвращает None, если тело не подходит ни под один шаблон
+    """
+    pos = 0
+    deltas = {}  # type: Dict[int, int]
+    for b in body:
+        if B.PLUS == b.op:
+            deltas[pos] = deltas.get(pos, 0) + b.arg
+        else:
+            pos += b.arg
+
+    if pos:
+        # `[>]`, `[<<]` - поиск нулевой ячейки
+        if 1 == len(body) and B.MOVE == body[0].op:
+            return [B(B.SCAN, pos)]
+        return None
+
+    step = deltas.pop(0, 0) % 256
+    # При чётном шаге цикл может не завершиться - не трогаем
+    if not step % 2:
+        return None
+    targets = {o: d % 256 for o, d in deltas.items() if d % 256}
+    if not targets:
+        # `[-]`, `[+]`, `[---]`: нечётный шаг всегда доходит до нуля
+        return [B(B.SET, 0)]
+    if step not in (1, 255):
+        return None
+
+    # `[->+<]`: цикл выполняется v раз при шаге -1 и 256 - v раз при +1
+    sign = 1 if 255 == step else -1
+    result = [B(B.MUL, _normalize(B.PLUS, d * sign), offset=o)
+              for o, d in sorted(targets.items())]
+    result.append(B(B.SET, 0))
+    return result
+
+
+def loops(bytecode: List[B]) -> List[B]:
+    """
+    Заменяет внутренние циклы без ввода-вывода на операции оптимизатора:
+    обнуление `[-]` -> SET 0, перенос/умножение `[->+>++<<]` -> MUL... SET 0,
+    поиск нуля `[>]` -> SCAN. Следующий за SET плюс вливается в SET.
+    Ожидает bytecode после fold.
+    """
+    result = []  # type: List[B]
+    opened = []  # type: List[int]
+    for b in bytecode:
+        if B.CYCLE_IN == b.op:
+            opened.append(len(result))
+        elif B.CYCLE_OUT == b.op and opened:
+            start = opened.pop()
+            body = result[start + 1:]
+            if all(B.PLUS == i.op or B.MOVE == i.op for i in body):
+                replacement = _rewrite(body)
+                if replacement is not None:
+                    # Новые операции относятся к строке начала цикла
+                    for i in replacement:
+                        i.src = result[start].src
+                    del result[start:]
+                    result += replacement
+                    continue
+        elif B.PLUS == b.op and result and B.SET == result[-1].op \
+                and result[-1].offset == b.offset:
+            arg = _normalize(B.PLUS, result[-1].arg + b.arg)
+            result[-1] = B(B.SET, arg, offset=b.offset, src=result[-1].src)
+            continue
+        result.append(b)
+    return result
@@ -0,0 +1,191 @@
+from typing import Dict, List, Sequence, Tuple
+
+from bytecode import ByteCode as B
+from optimizer.analysis import tape_size
+
+# Статическая оценка: тело цикла выполняется в LOOP_WEIGHT раз чаще,
+# чем код вокруг него
+LOOP_WEIGHT = 10
+
+# Раунды улучшения перестановки обменами и сколько всего рёбер можно
+# просмотреть: на больших лентах перестановка улучшается не до конца
+ROUNDS = 16
+TRIES = 1000000
+
+_ADDRESSED = (B.PLUS, B.PRINT, B.READ, B.SET)
+
+
+def _visits(bytecode: List[B]) -> List[Tuple[int, int]]:
+    """
+    Ячейки, которых по очереди касается указатель Brainfuck:
+    (индекс инструкции, ячейка). Так же лениво, как в compile_bytecode:
+    операции со смещением идут прямо к своей ячейке
+    """
+    visits = []  # type: List[Tuple[int, int]]
+    pos = 0
+    for i, b in enumerate(bytecode):
+        if B.MOVE == b.op:
+            pos += b.arg
+        elif b.op in _ADDRESSED:
+            visits.append((i, pos + b.offset))
+        elif B.MUL == b.op:
+            visits.append((i, pos))
+            visits.append((i, pos + b.offset))
+            visits.append((i, pos))
+        elif B.NONE != b.op:
+            visits.append((i, pos))
+    return visits
+
+
+def static_hits(bytecode: List[B]) -> List[int]:
+    """ Оценка числа выполнений инструкций по вложенности циклов """
+    hits = []
+    depth = 0
+    for b in bytecode:
+        if B.CYCLE_OUT == b.op:
+            depth -= 1
+        hits.append(LOOP_WEIGHT ** depth)
+        if B.CYCLE_IN == b.op:
+            depth += 1
+    return hits
+
+
+def _edges(bytecode: List[B], hits: Sequence[int]) -> Dict[Tuple[int, int], int]:
+    """ (ячейка, ячейка) -> сколько раз указатель прошёл между ними """
+    edges = {}  # type: Dict[Tuple[int, int], int]
+    visits = _visits(bytecode)
+    for (_, a), (i, b) in zip(visits, visits[1:]):
+        if a != b and hits[i]:
+            key = (a, b) if a < b else (b, a)
+            edges[key] = edges.get(key, 0) + hits[i]
+    return edges
+
+
+def plan(bytecode: List[B], hits: Sequence[int] or None = None) -> List[int] or None:
+    """
+    Перестановка ячеек: cells[i] - новый адрес ячейки i, с которой
+    суммарный путь указателя (взвешенный по hits) не больше исходного.
+    hits - выполнения инструкций (Profile.hits того же bytecode) или
+    статическая оценка. None, если адреса ячеек нельзя доказать статически
+    """
+    size = tape_size(bytecode)
+    if size is None:
+        return None
+    if hits is None:
+        hits = static_hits(bytecode)
+    edges = _edges(bytecode, hits)
+    cells = list(range(size))
+    neighbours = [{} for _ in cells]  # type: List[Dict[int, int]]
+    for (a, b), w in edges.items():
+        neighbours[a][b] = w
+        neighbours[b][a] = w
+
+    def gain(i: int, j: int) -> int:
+        """ На сколько короче путь, если поменять ячейки i и j местами """
+        delta = 0
+        for k, w in neighbours[i].items():
+            if k != j:
+                delta += w * (abs(cells[i] - cells[k])
+                              - abs(cells[j] - cells[k]))
+        for k, w in neighbours[j].items():
+            if k != i:
+                delta += w * (abs(cells[j] - cells[k])
+                              - abs(cells[i] - cells[k]))
+        return delta
+
+    # Пустые ячейки тоже участвуют: в них можно перенести занятую
+    active = [c for c in cells if neighbours[c]]
+    tries = TRIES
+    for _ in range(ROUNDS):
+        improved = False
+        for i in active:
+            for j in cells:
+                if i != j and gain(i, j) > 0:
+                    cells[i], cells[j] = cells[j], cells[i]
+                    improved = True
+            tries -= len(cells) * (1 + len(neighbours[i]))
+            if tries <= 0:
+                return cells
+        if not improved:
+            break
+    return cells
+
+
+def apply(bytecode: List[B], cells: List[int]) -> List[B]:
+    """
+    Выдаёт bytecode заново для ячеек на новых адресах: MOVE и смещения
+    пересчитываются, остальное не меняется. Исходные ByteCode не изменяются
+    """
+    result = []  # type: List[B]
+    if cells[0]:
+        result.append(B(B.MOVE, cells[0]))
+    pos = 0
+    for b in bytecode:
+        if B.MOVE == b.op:
+            arg = cells[pos + b.arg] - cells[pos]
+            pos += b.arg
+            if arg:
+                result.append(B(B.MOVE, arg, src=b.src))
+        elif b.op in _ADDRESSED or B.MUL == b.op:
+            result.append(B(b.op, b.arg,
+                            offset=cells[pos + b.offset] - cells[pos],
+                            src=b.src))
+        else:
+            result.append(b)
+    return result
+
+
+def travel(bytecode: List[B], hits: Sequence[int]) -> Tuple[int, int]:
+    """
+    (выполненные MOVE, пройденные указателем Brainfuck ячейки) -
+    сколько `>`/`<` выполнит программа после compile_bytecode.
+    hits - Profile.hits этого bytecode
+    """
+    moves = sum(hits[i] for i, b in enumerate(bytecode) if B.MOVE == b.op)
+    distance = 0
+    visits = _visits(bytecode)
+    for (_, a), (i, b) in zip([(0, 0)] + visits, visits):
+        distance += hits[i] * abs(a - b)
+    return moves, distance
+
+
+class Layout:
+    """
+    Раскладка ячеек по профилю: часто соседствующие в пути указателя
+    ячейки (регистры) ставятся рядом. Меняет адреса на ленте - дамп памяти
+    после выполнения переставлен так же (cells)
+    """
+    def __init__(self, bytecode: List[B], hits: Sequence[int] or None = None):
+        self.bytecode = list(bytecode)
+        self.hits = hits
+        self.cells = plan(self.bytecode, hits)
+
+    def optimize(self) -> List[B]:
+        if self.cells is None:
+            return self.bytecode
+        return apply(self.bytecode, self.cells)
+
+    def report(self, after_hits: Sequence[int] or None = None) -> List[str]:
+        """
+        MOVE и путь указателя до и после; after_hits - профиль optimize(),
+        без профилей - статическая оценка
+        """
+        optimized = self.optimize()
+        before = travel(self.bytecode, self.hits if self.hits is not None
+                        else static_hits(self.bytecode))
+        after = travel(optimized, after_hits if after_hits is not None
+                       else static_hits(optimized))
+        return ["executed MOVE: {} -> {}".format(before[0], after[0]),
+                "pointer travel: {} -> {}".format(before[1], after[1])]
+
+
+def layout(bytecode: List[B]) -> List[B]:
+    """
+    Проход оптимизатора: переставляет ячейки по статической оценке
+    путей указателя. Программы, где адреса не известны статически
+    (несбалансированные циклы, SCAN), не меняет
+    """
+    cells = plan(bytecode)
+    if cells is None or cells == list(range(len(cells))):
+        return bytecode
+    return apply(bytecode, cells)
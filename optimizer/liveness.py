@@ -0,0 +1,180 @@
+from typing import Dict, Iterable, List
+
+from bytecode import ByteCode as B
+from optimizer.constants import _jumps, _writes
+
+
+class _Live:
+    """
+    Живые ячейки относительно указателя. Пока rest, живы все ячейки,
+    кроме cells (так выглядит лента, которая видна после программы,
+    или лента при неизвестном положении указателя), иначе - только cells
+    """
+    __slots__ = ("rest", "cells")
+
+    def __init__(self, rest: bool, cells: Iterable[int] = ()):
+        self.rest = rest
+        self.cells = frozenset(cells)
+
+    def __contains__(self, cell: int) -> bool:
+        return (cell in self.cells) != self.rest
+
+    def __eq__(self, other: '_Live') -> bool:
+        return self.rest == other.rest and self.cells == other.cells
+
+    def __or__(self, other: '_Live') -> '_Live':
+        if self.rest and other.rest:
+            return _Live(True, self.cells & other.cells)
+        if self.rest or other.rest:
+            rest, cells = (self, other) if self.rest else (other, self)
+            return _Live(True, rest.cells - cells.cells)
+        return _Live(False, self.cells | other.cells)
+
+    def add(self, cell: int) -> '_Live':
+        if self.rest:
+            return _Live(True, self.cells - {cell})
+        return _Live(False, self.cells | {cell})
+
+    def kill(self, cell: int) -> '_Live':
+        if self.rest:
+            return _Live(True, self.cells | {cell})
+        return _Live(False, self.cells - {cell})
+
+    def shift(self, arg: int) -> '_Live':
+        """ Живые ячейки до MOVE arg по живым после него """
+        return _Live(self.rest, (cell + arg for cell in self.cells))
+
+    def __repr__(self):
+        return "_Live<{}{}>".format("all but " if self.rest else "",
+                                    sorted(self.cells))
+
+
+_ALL = _Live(True)
+
+
+def _terminates(body: List[B]) -> bool:
+    """
+    Тело без вложенных циклов и ввода-вывода, которое меняет ячейку
+    счётчика только прибавками с нечётной суммой: цикл всегда завершается
+    """
+    pos = step = 0
+    for b in body:
+        if B.MOVE == b.op:
+            pos += b.arg
+        elif B.PLUS == b.op:
+            if not pos + b.offset:
+                step += b.arg
+        elif B.SET == b.op or B.MUL == b.op:
+            if not pos + b.offset:
+                return False
+        elif B.NONE != b.op:
+            return False
+    return 1 == step % 2
+
+
+def _walk(bytecode: List[B], start: int, stop: int, opens: Dict[int, int],
+          live: _Live, loops: Dict[int, _Live], dead: List[bool] or None
+          ) -> _Live:
+    """
+    Идёт от stop к start и возвращает живые ячейки перед start.
+    loops - живые ячейки на входе в каждый цикл (по индексу `[`)
+    с прошлого прохода, обновляются по ходу.
+    Если dead не None, отмечает в нём инструкции, которые можно убрать
+    """
+    def drop(i: int):
+        if dead is not None:
+            dead[i] = True
+
+    i = stop - 1
+    while i >= start:
+        b = bytecode[i]
+        op = b.op
+        if B.MOVE == op:
+            live = live.shift(b.arg)
+        elif B.PRINT == op:
+            live = live.add(b.offset)
+        elif B.PLUS == op:
+            if b.offset not in live:
+                drop(i)
+        elif B.SET == op:
+            first = i
+            while first > start and B.MUL == bytecode[first - 1].op:
+                first -= 1
+            if first == i:
+                if b.offset not in live:
+                    drop(i)
+                live = live.kill(b.offset)
+            else:
+                # Группа MUL... SET 0: MUL жив, если жива его ячейка, SET
+                # остаётся при любом живом MUL - без него группу не собрать
+                needed = 0 in live
+                live = live.kill(0)
+                used = False
+                for j in range(i - 1, first - 1, -1):
+                    if bytecode[j].offset in live:
+                        used = True
+                    else:
+                        drop(j)
+                if used:
+                    live = live.add(0)
+                elif not needed:
+                    drop(i)
+                i = first
+        elif B.SCAN == op:
+            live = _ALL
+        elif B.CYCLE_OUT == op:
+            first = opens[i]
+            body = bytecode[first + 1:i]
+            writes = _writes(body)
+            if writes is None:
+                # Где окажется указатель после тела, неизвестно
+                _walk(bytecode, first + 1, i, opens, _ALL, loops, dead)
+                live = _ALL
+            elif 0 not in live and not any(cell in live for cell in writes) \
+                    and _terminates(body):
+                # Цикл ничего не оставляет для наблюдения
+                for j in range(first, i + 1):
+                    drop(j)
+            else:
+                # На входе в тело живо то, что нужно после цикла, счётчик
+                # и то, что нужно следующей итерации - ответ для этого
+                # цикла с прошлого прохода
+                inner = live.add(0) | loops.get(first, live)
+                live = inner | _walk(bytecode, first + 1, i, opens, inner,
+                                     loops, dead)
+                loops[first] = live
+            i = first
+        # READ не убирается и не убивает ячейку: при конце ввода `,`
+        # может оставить её как есть
+        i -= 1
+    return live
+
+
+def liveness(bytecode: List[B], keep_tape: bool = True) -> List[B]:
+    """
+    Убирает записи в ячейки, которые потом не читаются: прибавки и SET
+    перед новой записью, MUL в ненужные ячейки и завершающиеся циклы без
+    ввода-вывода, результат которых не нужен. Анализ живости идёт от конца
+    программы; keep_tape - лента в конце тоже наблюдается (проверки
+    `#! test_MEMORY`), иначе значим только вывод.
+    Ожидает bytecode после loops. Исходные ByteCode не изменяются
+    """
+    jumps = _jumps(bytecode)
+    opens = {stop: start for start, stop in jumps.items()}
+    end = _ALL if keep_tape else _Live(False)
+    loops = {}  # type: Dict[int, _Live]
+    # Проходы повторяются, пока живые ячейки циклов растут: каждый проход
+    # линейный, вложенным циклам не нужна своя неподвижная точка
+    while True:
+        known = dict(loops)
+        _walk(bytecode, 0, len(bytecode), opens, end, loops, None)
+        if known == loops:
+            break
+    dead = [False] * len(bytecode)
+    _walk(bytecode, 0, len(bytecode), opens, end, loops, dead)
+    return [b for b, d in zip(bytecode, dead) if not d]
+
+
+def dead_cells(bytecode: List[B]) -> List[B]:
+    """ liveness, когда лента после программы не видна """
+    return liveness(bytecode, keep_tape=False)
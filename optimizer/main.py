@@ -0,0 +1,80 @@
+from typing import Callable, Iterable, List
+
+from bytecode import ByteCode as B, Program
+from optimizer.constants import constants
+from optimizer.fold import fold
+from optimizer.idioms import loops
+from optimizer.layout import layout
+from optimizer.liveness import dead_cells, liveness
+from optimizer.prefix import prefix
+from optimizer.offsets import offsets
+
+Pass = Callable[[List[B]], List[B]]
+
+
+class PassStats:
+    """ Сколько инструкций было до и стало после прохода """
+    def __init__(self, name: str, before: int, after: int):
+        self.name = name
+        self.before = before
+        self.after = after
+
+    @property
+    def removed(self) -> int:
+        return self.before - self.after
+
+    def __repr__(self):
+        return "PassStats<{self.name}: {self.before} -> {self.after}, " \
+               "removed {self.removed}>".format(self=self)
+
+
+class Optimizer:
+    """
+    Цепочка проходов над bytecode между Context.full_bytecode()
+    и исполнителем/эмиттером. Статистика последнего запуска - в self.stats
+    """
+    levels = {
+        0: [],
+        1: [fold],
+        2: [fold, loops],
+        3: [fold, loops, offsets],
+        4: [fold, loops, constants, liveness, fold, offsets],
+        # Выполняет начало программы при компиляции, убирает записи,
+        # которые видны только в дампе памяти, и переставляет ячейки
+        # ленты: дамп памяти уже не совпадает
+        5: [fold, loops, constants, dead_cells, fold, prefix, layout,
+            offsets],
+    }
+
+    def __init__(self, passes: List[Pass] or None = None, level: int = 3):
+        if passes is None:
+            passes = self.levels[level]
+        self.passes = passes
+        self.stats = []  # type: List[PassStats]
+
+    def optimize(self, bytecode: Iterable[B] or Program) -> List[B]:
+        if isinstance(bytecode, Program):
+            bytecode = bytecode.to_bytecode()
+        bytecode = list(bytecode)
+        self.stats = []
+        for _pass in self.passes:
+            before = len(bytecode)
+            bytecode = _pass(bytecode)
+            self.stats.append(PassStats(_pass.__name__, before, len(bytecode)))
+        return bytecode
+
+    @property
+    def removed(self) -> int:
+        return sum(stat.removed for stat in self.stats)
+
+    def report(self) -> List[str]:
+        lines = []
+        for stat in self.stats:
+            lines.append("{stat.name}: {stat.before} -> {stat.after} "
+                         "(-{stat.removed})".format(stat=stat))
+        lines.append("total removed: {}".format(self.removed))
+        return lines
+
+
+def optimize(bytecode: Iterable[B] or Program, level: int = 3) -> List[B]:
+    return Optimizer(level=level).optimize(bytecode)
@@ -0,0 +1,42 @@
+from typing import List
+
+from bytecode import ByteCode as B
+
+# Операции, которые работают с ячейкой по смещению и не двигают указатель
+_ADDRESSED = (B.PLUS, B.PRINT, B.READ, B.SET)
+
+
+def offsets(bytecode: List[B]) -> List[B]:
+    """
+    Убирает MOVE внутри прямолинейных участков: указатель сдвигается
+    виртуально, а операции получают смещение ячейки. Настоящий MOVE
+    выдаётся только на границах циклов - перед `[`, `]`, SCAN и группой
+    MUL, которым нужна ячейка под указателем.
+    Ожидает bytecode после fold и loops.
+    """
+    result = []  # type: List[B]
+    virtual = 0
+    # Отложенный сдвиг относится к последнему вошедшему в него MOVE
+    src = None
+
+    def flush():
+        nonlocal virtual
+        if virtual:
+            result.append(B(B.MOVE, virtual, src=src))
+            virtual = 0
+
+    for b in bytecode:
+        if B.MOVE == b.op:
+            virtual += b.arg
+            src = b.src
+        elif b.op in _ADDRESSED:
+            result.append(B(b.op, b.arg, offset=b.offset + virtual,
+                            src=b.src))
+        elif B.NONE == b.op:
+            result.append(b)
+        else:
+            if not (B.MUL == b.op and result and B.MUL == result[-1].op):
+                flush()
+            result.append(b)
+    flush()
+    return result
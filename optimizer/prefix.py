@@ -0,0 +1,93 @@
+import io
+from typing import List, Tuple
+
+from bytecode import ByteCode as B, Preamble
+
+# Сколько инструкций можно выполнить при компиляции
+STEPS = 10 ** 7
+
+
+def _segments(bytecode: List[B]) -> List[Tuple[int, int]]:
+    """
+    Участки верхнего уровня до первого `,`: каждый внешний цикл отдельно,
+    прямолинейный код между ними - одним участком. Цикл, внутри которого
+    есть `,`, и всё после него в участки не попадает
+    """
+    segments = []  # type: List[Tuple[int, int]]
+    start = depth = 0
+    for i, b in enumerate(bytecode):
+        if B.READ == b.op:
+            break
+        if B.CYCLE_IN == b.op:
+            if not depth:
+                if start < i:
+                    segments.append((start, i))
+                start = i
+            depth += 1
+        elif B.CYCLE_OUT == b.op:
+            depth -= 1
+            if not depth:
+                segments.append((start, i + 1))
+                start = i + 1
+    else:
+        i = len(bytecode)
+    if not depth and start < i:
+        segments.append((start, i))
+    return segments
+
+
+def partial_evaluate(bytecode: List[B], max_steps: int = STEPS
+                     ) -> Tuple[Preamble or None, List[B]]:
+    """
+    Выполняет начало программы, которое не зависит от ввода, и возвращает
+    его итог (Preamble) и остаток программы. Участок, который не уложился
+    в max_steps инструкций или упал с ошибкой, остаётся в остатке -
+    исполнитель повторит его сам. None, если не выполнилось ничего
+    """
+    from executor.channels import OutputChannel
+    from executor.main import Interpreter, Memory, RunResult
+
+    bytecode = list(bytecode)
+    memory = Memory()
+    output = io.BytesIO()
+    channel = OutputChannel(output)
+    pointer = 0
+    done = 0
+    for start, stop in _segments(bytecode):
+        if max_steps <= 0:
+            break
+        saved = bytes(memory.data)
+        written = output.tell()
+        interpreter = Interpreter(bytecode[start:stop], output=channel,
+                                  inp=io.BytesIO())
+        interpreter.memory = memory
+        interpreter.MP = pointer
+        try:
+            result = interpreter.run(max_steps)
+        except Exception:
+            result = None
+        if result is None or not result.halted:
+            memory.data[:] = saved
+            channel.buffer.clear()
+            output.truncate(written)
+            output.seek(written)
+            break
+        channel.flush()
+        max_steps -= result.steps
+        pointer = interpreter.MP
+        done = stop
+    if not done:
+        return None, bytecode
+    return Preamble(bytes(memory.data.rstrip(b"\0")), output.getvalue(),
+                    pointer), bytecode[done:]
+
+
+def prefix(bytecode: List[B]) -> List[B]:
+    """
+    Проход оптимизатора: начало программы без ввода заменяется
+    на Preamble.setup - прямой набор ленты и вывода
+    """
+    preamble, rest = partial_evaluate(bytecode)
+    if preamble is None:
+        return bytecode
+    return preamble.setup() + rest
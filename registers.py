@@ -0,0 +1,36 @@
+from typing import Dict
+
+
+class Registers:
+    """
+    Занятые ячейки ленты одной компиляции. Ячейку держат переменные
+    с адресом (регистры и аргументы макросов), пока жив их NameSpace;
+    одну ячейку могут держать несколько переменных сразу.
+    busy - битовая карта занятых ячеек: первая свободная ячейка - младший
+    нулевой бит, её поиск не зависит от числа регистров
+    """
+    def __init__(self):
+        self.busy = 0
+        self._refs = {}  # type: Dict[int, int]
+
+    def first_free(self) -> int:
+        return (~self.busy & (self.busy + 1)).bit_length() - 1
+
+    def hold(self, address: int):
+        refs = self._refs.get(address, 0)
+        if not refs:
+            self.busy |= 1 << address
+        self._refs[address] = refs + 1
+
+    def release(self, address: int):
+        refs = self._refs.pop(address) - 1
+        if refs:
+            self._refs[address] = refs
+        else:
+            self.busy &= ~(1 << address)
+
+    def __len__(self):
+        return len(self._refs)
+
+    def __repr__(self):
+        return "Registers<{}>".format(sorted(self._refs))
@@ -0,0 +1,71 @@
+from typing import Dict, List, Tuple
+
+# Вызов макроса: (имя функции, номер строки вызова)
+Frame = Tuple[str, int]
+
+
+class SourceEntry:
+    """
+    Откуда взялась инструкция: строка .br, встроенная функция, которая её
+    выдала, и цепочка вызовов макросов от верхнего уровня файла
+    """
+    __slots__ = ("line", "func", "chain")
+
+    def __init__(self, line: int, func: str, chain: Tuple[Frame, ...]):
+        self.line = line
+        self.func = func
+        self.chain = chain
+
+    def frames(self) -> List[str]:
+        """ Кадры для folded stacks: вызовы макросов и сама инструкция """
+        frames = ["{}:{}".format(name, line) for name, line in self.chain]
+        frames.append("{}:{}".format(self.func, self.line))
+        return frames
+
+    def __repr__(self):
+        return "SourceEntry<{}: {}>".format(
+            self.line, ";".join(self.frames()))
+
+
+class SourceMap:
+    """
+    Таблица записей, на которые ссылается ByteCode.src.
+    Одинаковые записи хранятся один раз, поэтому карта компактна
+    даже для программ из миллионов инструкций
+    """
+    def __init__(self, file_name: str = "<main>"):
+        self.file_name = file_name
+        self.entries = []  # type: List[SourceEntry]
+        self._index = {}  # type: Dict[tuple, int]
+
+    def add(self, line: int, func: str, chain: Tuple[Frame, ...]) -> int:
+        key = (line, func, chain)
+        src = self._index.get(key)
+        if src is None:
+            src = len(self.entries)
+            self.entries.append(SourceEntry(line, func, chain))
+            self._index[key] = src
+        return src
+
+    @staticmethod
+    def chain(context: 'Context') -> Tuple[Frame, ...]:
+        """ Вызовы макросов от верхнего уровня файла до context включительно """
+        chain = []  # type: List[Frame]
+        cur = context
+        while cur is not None and cur.parent is not None:
+            if cur.func is not None and not cur.func.builtin:
+                chain.append((cur.func.name, cur.expr.line_n))
+            cur = cur.parent
+        chain.reverse()
+        return tuple(chain)
+
+    def add_context(self, context: 'Context') -> int:
+        """ Запись для встроенной функции, выполняемой в context """
+        return self.add(context.expr.line_n, context.func.name,
+                        self.chain(context.parent))
+
+    def __getitem__(self, src: int) -> SourceEntry:
+        return self.entries[src]
+
+    def __len__(self):
+        return len(self.entries)
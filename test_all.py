@@ -1,41 +1,85 @@
+import asyncio
 import glob
 import io
+import shutil
 
 import pytest
 
+from bf_parser import BfParser, parse_bf
 from br_compiler import FileCompiler, Lexer
-from executor import Interpreter
-from test_utils import BrTests, get_tests
+from bytecode import ByteCode as B, Program
+from compile_cache import CompileCache, compile_file
+from br_exceptions.bytecode import BracketError
+from br_exceptions.executor import MemoryBoundsError, SnapshotError
+from br_exceptions.parser import FunctionNotFoundError
+from executor import Interpreter, NativeInterpreter, PyInterpreter, \
+    RunResult, Scheduler
+from executor.channels import EOF_MAX, EOF_UNCHANGED, EOF_ZERO, \
+    AsyncInputChannel, AsyncOutputChannel, InputChannel, OutputChannel
+from executor.main import Memory
+from executor.snapshot import Snapshot
+from macro_cache import MacroCache
+from optimizer import Optimizer, tape_size
+from test_utils import BrTests, get_tests, compile_source
 
+# Самодостаточная программа на макросах: регистры, копирование, вывод
+MACRO_PROGRAM = """
+macro global _add address to int value
+    __move to :0
+    __plus value
+    __move :0 to
 
-def file_execute(file_name, test: BrTests):
-    print(file_name)
+macroblock global _while address addr
+    __move addr :0
+    __cycle_start
+    __move :0 addr
+    code
+    __move addr :0
+    __cycle_end
+    __move :0 addr
 
-    interpreter = None
-    block = None
+macro global _mov2 address to1 address to2 address from
+    _while from
+        _add from -1
+        _add to1 1
+        _add to2 1
 
-    try:
-        with open(file_name, 'rt') as f:
-            l = Lexer(f.readlines())
+macro global _print address addr
+    __move addr :0
+    __print
+    __move :0 addr
 
-            block = l.block
+reg ZERO
+reg A
+reg B
+reg C
+_add A 72
+_mov2 B C A
+_print B
+_add C 33
+_print C
+_add C -1
+_mov2 A B C
+_print A
+"""
 
-        compiler = FileCompiler(file_name, block)
 
-        compiler.compile()
+def file_execute(file_name, test: BrTests, engine=Interpreter,
+                 cache: CompileCache or None = None):
+    print(file_name)
 
-        bytecode = compiler.context.full_bytecode()
+    interpreter = None
+
+    try:
+        compiled = compile_file(file_name, cache)
 
         program_out = io.StringIO()
-        interpreter = Interpreter(bytecode,
-                                  output=program_out,
-                                  inp=test.inp)
+        interpreter = engine(compiled.program,
+                             output=program_out,
+                             inp=test.inp,
+                             memory_size=compiled.tape_size() or 0)
 
-        try:
-            while True:
-                interpreter.step()
-        except EOFError:
-            pass
+        interpreter.run()
 
     except Exception as e:
         assert e.__class__.__name__ == test.exc_name
@@ -67,9 +111,835 @@ def file_execute(file_name, test: BrTests):
     print(" ====== ")
 
 
-def test_files():
+@pytest.fixture(scope="session")
+def compile_cache(tmp_path_factory) -> CompileCache:
+    """ Общий для движков кэш: каждый файл компилируется один раз """
+    return CompileCache(str(tmp_path_factory.mktemp("compile_cache")))
+
+
+@pytest.mark.parametrize("engine", [
+    Interpreter,
+    PyInterpreter,
+    pytest.param(NativeInterpreter, marks=pytest.mark.skipif(
+        shutil.which("cc") is None, reason="нет компилятора C")),
+])
+def test_files(engine, compile_cache):
     file_names = sorted(glob.glob("./test_files/*/*.br", recursive=True))
 
     for file_name in file_names:
         test = get_tests(file_name)
-        file_execute(file_name, test)
+        file_execute(file_name, test, engine, compile_cache)
+
+
+def test_program_roundtrip():
+    bytecode = [B("+", 3), B(">", 2), B("["), B("-", 1), B("<", 1), B("]"),
+                B("."), B(","), B("#", "comment"), B(B.NONE, None)]
+    program = Program.from_bytecode(bytecode)
+
+    assert program.to_bytecode() == bytecode
+    assert (program.jumps[2], program.jumps[5]) == (5, 2)
+    assert program.compile() == "".join(b.compile() for b in bytecode)
+
+    interpreter = Interpreter(bytecode, output=io.StringIO(),
+                              inp=io.StringIO("a"))
+    try:
+        while True:
+            interpreter.step()
+    except EOFError:
+        pass
+    # Interpreter не должен портить исходный bytecode
+    assert bytecode[2].arg is None and bytecode[5].arg is None
+
+
+def test_run_matches_step():
+    bytecode = [B(c, 1) for c in "++++++[>++++++++<-]>[>++>+<<-]>.>+.,."]
+    stepper = Interpreter(bytecode, output=io.StringIO(),
+                          inp=io.StringIO("x"))
+    steps = 0
+    try:
+        while True:
+            steps += 1
+            stepper.step()
+    except EOFError:
+        pass
+
+    result = Interpreter(bytecode, output=io.StringIO(),
+                         inp=io.StringIO("x")).run()
+    assert (result.steps, result.reason) == (steps, RunResult.HALT)
+
+    # С бюджетом run останавливается и продолжается с того же места
+    runner = Interpreter(bytecode, output=io.StringIO(),
+                         inp=io.StringIO("x"))
+    total = 0
+    while True:
+        result = runner.run(max_steps=5)
+        total += result.steps
+        if result.halted:
+            break
+        assert (result.steps, result.reason) == (5, RunResult.BUDGET)
+
+    assert total == steps
+    assert runner.memory.get_items() == stepper.memory.get_items()
+    assert runner.output.getvalue() == stepper.output.getvalue()
+
+    # Счётный цикл с шагом +3: 5 + 3k = 0 (mod 256) при k = 169
+    counted = Interpreter([B(c, 1) for c in "+++++[>++<+++]"],
+                          output=io.StringIO())
+    assert counted.run().steps == 5 + 1 + 169 * 8
+    assert counted.memory.get_items() == {1: 169 * 2 % 256}
+
+
+def _execute(bytecode, engine=Interpreter):
+    interpreter = engine(bytecode, output=io.StringIO())
+    interpreter.run()
+    return interpreter.memory.get_items(), interpreter.output.getvalue()
+
+
+def test_optimizer_fold():
+    bytecode = compile_source(MACRO_PROGRAM)
+    optimizer = Optimizer(level=1)
+    folded = optimizer.optimize(bytecode)
+
+    assert _execute(folded) == _execute(bytecode)
+    assert _execute(bytecode)[1] == "Hih"
+    assert optimizer.removed == len(bytecode) - len(folded) > 0
+    assert all(B.NONE != b.op for b in folded)
+
+    assert Optimizer(level=1).optimize(
+        [B(">", 5), B("#", "x"), B("+", 1), B("-", 1), B("<", 5), B("+", 3),
+         B("+", 255), B("."), B("<", 2), B(">", 3)]
+    ) == [B("+", 2), B("."), B(">", 1)]
+
+    # После offsets сливаются только плюсы к одной и той же ячейке
+    assert Optimizer(level=1).optimize(
+        [B("+", 1, offset=1), B("+", 2, offset=2), B("+", 3, offset=2)]
+    ) == [B("+", 1, offset=1), B("+", 5, offset=2)]
+
+
+def test_optimizer_loops():
+    def bf(text):
+        return [B(ch, 1) if ch in "+-<>" else B(ch) for ch in text]
+
+    assert Optimizer(level=2).optimize(bf("+++[-]++>[->+>---<<]<[>>]")) == [
+        B("+", 3), B(B.SET, 2), B(">", 1),
+        B(B.MUL, 1, offset=1), B(B.MUL, -3, offset=2), B(B.SET, 0),
+        B("<", 1), B(B.SCAN, 2),
+    ]
+    # Циклы с выводом и вложенные не переписываются
+    assert Optimizer(level=2).optimize(bf("[-.][[-]>]")) == [
+        B("["), B("-", 1), B("."), B("]"),
+        B("["), B(B.SET, 0), B(">", 1), B("]"),
+    ]
+
+    # Отрицательная прибавка после обнуления не раздувает текст
+    for code in (">[-]-<", "[->+<]--"):
+        optimized = Optimizer(level=2).optimize(bf(code))
+        assert Program.from_bytecode(optimized).compile() == code
+    assert Optimizer(level=2).optimize(bf("[-]--")) == [B(B.SET, -2)]
+
+    bytecode = compile_source(MACRO_PROGRAM)
+    optimized = Optimizer(level=2).optimize(bytecode)
+    assert any(B.MUL == b.op for b in optimized)
+    assert _execute(optimized) == _execute(bytecode)
+
+    # Обратно в Brainfuck и исполнение текста даёт тот же результат
+    text = Program.from_bytecode(optimized).compile()
+    assert _execute(bf(text)) == _execute(bytecode)
+
+
+def test_optimizer_offsets():
+    bytecode = [B(ch, 1) if ch in "+-<>" else B(ch) for ch in ">+>-<<.>>>[-<+>]<,"]
+    assert Optimizer(level=3).optimize(bytecode) == [
+        B("+", 1, offset=1), B("-", 1, offset=2), B("."),
+        B(">", 3), B(B.MUL, 1, offset=-1), B(B.SET, 0),
+        B(",", offset=-1), B("<", 1),
+    ]
+
+    bytecode = compile_source(MACRO_PROGRAM)
+    optimized = Optimizer(level=3).optimize(bytecode)
+    assert _execute(optimized) == _execute(bytecode)
+    assert len(optimized) < len(Optimizer(level=2).optimize(bytecode))
+    text = Program.from_bytecode(optimized).compile()
+    assert _execute([B(ch, 1) for ch in text]) == _execute(bytecode)
+
+
+def test_optimizer_constants():
+    from optimizer.constants import constants
+    from optimizer.fold import fold
+    from optimizer.idioms import loops
+    from optimizer.offsets import offsets
+
+    # Без liveness: уровень 4 убрал бы ещё и перезаписанные ячейки
+    optimizer = Optimizer([fold, loops, constants, fold, offsets])
+
+    def bf(text):
+        return [B(ch, 1) if ch in "+-<>" else B(ch) for ch in text]
+
+    # Цикл на заведомо нулевой ячейке и лишнее обнуление исчезают
+    assert optimizer.optimize(bf("[-]>[.<]+[-]<[-]")) == [
+        B("+", 1, offset=1), B(B.SET, 0, offset=1)]
+    # Число итераций известно: цикл становится арифметикой
+    assert optimizer.optimize(bf("++++[>+++<--].")) == [
+        B("+", 4), B(B.SET, 0), B(B.SET, 6, offset=1), B(".")]
+    assert optimizer.optimize(bf(",>++++[<+>--]<.")) == [
+        B(","), B("+", 4, offset=1), B("+", 2), B(B.SET, 0, offset=1),
+        B(".")]
+    # Известный множитель MUL - обычная прибавка
+    assert optimizer.optimize(bf("+++[->++<]>.")) == [
+        B("+", 3), B("+", 6, offset=1), B(B.SET, 0), B(".", offset=1),
+        B(">", 1)]
+    # После `,` значение неизвестно
+    assert optimizer.optimize(bf(",[-]+")) == [B(","), B(B.SET, 1)]
+
+    bytecode = compile_source(MACRO_PROGRAM)
+    optimized = Optimizer(level=4).optimize(bytecode)
+    assert _execute(optimized) == _execute(bytecode)
+    assert len(optimized) < len(Optimizer(level=3).optimize(bytecode))
+
+
+def test_optimizer_liveness():
+    from optimizer.constants import constants
+    from optimizer.fold import fold
+    from optimizer.idioms import loops
+    from optimizer.liveness import dead_cells, liveness
+    from optimizer.offsets import offsets
+
+    def bf(text):
+        return Optimizer([fold, loops]).optimize(
+            [B(ch, 1) if ch in "+-<>" else B(ch) for ch in text])
+
+    # Прибавка и перенос в ячейку, которую потом обнуляют, не нужны
+    # даже с видимой лентой
+    assert liveness(bf(",>+++<[->+<]>[-]<.")) == [
+        B(","), B(">", 1), B("<", 1), B(B.SET, 0), B(">", 1), B(B.SET, 0),
+        B("<", 1), B(".")]
+    # Без ленты не нужны и копия, которую не выводят, и её обнуление
+    assert dead_cells(bf(",[->+>+<<]>>[-<<+>>]<.")) == [
+        B(","), B(B.MUL, 1, offset=1), B(B.SET, 0), B(">", 2), B("<", 1),
+        B(".")]
+    # Цикл, результат которого не нужен, исчезает целиком
+    assert dead_cells(bf(",>,<[->>[-]>+<<<]>.")) == [
+        B(","), B(">", 1), B(","), B("<", 1), B(">", 1), B(".")]
+    # Значение после `,` на конце ввода может остаться прежним
+    assert dead_cells(bf(",[-],.")) == [B(","), B(B.SET, 0), B(","), B(".")]
+
+    bytecode = compile_source(MACRO_PROGRAM)
+    optimized = Optimizer(level=4).optimize(bytecode)
+    assert _execute(optimized) == _execute(bytecode)
+    # Уровень 5 без prefix, который выполнил бы программу целиком
+    optimized = Optimizer([fold, loops, constants, dead_cells, fold,
+                           offsets]).optimize(bytecode)
+    assert _execute(optimized)[1] == _execute(bytecode)[1]
+    assert len(optimized) < len(Optimizer(level=4).optimize(bytecode))
+
+
+def test_optimizer_layout():
+    from optimizer.layout import Layout, layout
+
+    # Горячий цикл ходит между A и D, которые стоят далеко друг от друга
+    source = MACRO_PROGRAM.split("reg ZERO")[0] + """
+reg ZERO
+reg A
+reg B
+reg C
+reg D
+_add A 60
+_add D 33
+_while A
+    _add A -1
+    _print D
+"""
+    bytecode = Optimizer(level=2).optimize(compile_source(source))
+    interpreter = Interpreter(bytecode, output=io.StringIO())
+    profile = interpreter.profile()
+
+    planned = Layout(bytecode, profile.hits)
+    optimized = planned.optimize()
+    moved = Interpreter(optimized, output=io.StringIO())
+    after = moved.profile()
+    assert moved.output.getvalue() == interpreter.output.getvalue() == "!" * 60
+    # Ячейка i переехала на адрес cells[i]
+    assert moved.memory.get_items() == {
+        planned.cells[cell]: value
+        for cell, value in interpreter.memory.get_items().items()}
+    report = planned.report(after.hits)
+    travel = [int(n) for n in report[1].split(": ")[1].split(" -> ")]
+    assert travel[1] < travel[0]
+
+    # Проход оптимизатора не трогает ленту, которую нельзя вычислить
+    scan = [B(B.SCAN, 1), B(B.PLUS, 1)]
+    assert layout(scan) is scan
+    assert _execute(Optimizer(level=5).optimize(compile_source(source)))[1] \
+        == "!" * 60
+
+
+def test_partial_evaluation():
+    from optimizer.prefix import partial_evaluate
+
+    source = MACRO_PROGRAM + """
+__read
+_print ZERO
+"""
+    bytecode = Optimizer(level=3).optimize(compile_source(source))
+    preamble, rest = partial_evaluate(bytecode)
+    assert preamble.output == b"Hih" and len(rest) < len(bytecode)
+    assert B.READ == rest[0].op
+
+    def run(engine, code, preamble=None):
+        interpreter = engine(code, output=io.StringIO(),
+                             inp=io.StringIO("!"), preamble=preamble)
+        interpreter.run()
+        return interpreter.memory.get_items(), interpreter.output.getvalue()
+
+    expected = run(Interpreter, bytecode)
+    assert expected[1] == "Hih!"
+    assert run(Interpreter, rest, preamble) == expected
+    assert run(PyInterpreter, rest, preamble) == expected
+    # Эмиттер: вместо начала программы - прямой набор ленты и вывода
+    assert run(Interpreter, preamble.setup() + rest) == expected
+    assert _execute(Optimizer(level=5).optimize(
+        compile_source(MACRO_PROGRAM)))[1] == "Hih"
+
+    # Бесконечный цикл остаётся на время выполнения
+    looping = [B("+", 1), B("["), B("."), B("]")]
+    preamble, rest = partial_evaluate(looping, max_steps=100)
+    assert preamble.tape == b"\x01" and preamble.output == b""
+    assert rest == looping[1:]
+
+
+def test_memory_tape():
+    bytecode = compile_source(MACRO_PROGRAM)
+    size = tape_size(bytecode)
+    assert size == 4  # ZERO, A, B, C
+
+    interpreter = Interpreter(bytecode, output=io.StringIO(),
+                              memory_size=size, memory_limit=size)
+    data = interpreter.memory.data
+    interpreter.run()
+    assert interpreter.memory.data is data and len(data) == size
+    assert interpreter.memory == {1: 104, 2: 176, 3: 0}
+    assert interpreter.memory.get_items() == {1: 104, 2: 176}
+
+    memory = Memory()
+    memory[3] = 300
+    memory[1000] = -1
+    assert memory.get_items() == {3: 44, 1000: 255}
+    assert memory == {3: 44, 1000: 255, 5000: 0}
+    assert memory != {3: 45}
+
+    assert tape_size([B(">", 2), B("["), B(">", 1), B("]")]) is None
+    for code in ("<+", "+[<]", ">>>>+"):
+        interpreter = Interpreter([B(c, 1) for c in code], memory_limit=3)
+        with pytest.raises(MemoryBoundsError):
+            interpreter.run()
+
+
+def test_pysource_engine():
+    bytecode = compile_source(MACRO_PROGRAM)
+    for level in (0, 3):
+        optimized = Optimizer(level=level).optimize(bytecode)
+        assert _execute(optimized, PyInterpreter) == _execute(bytecode)
+
+    # Вложенность глубже, чем допускает CPython для блоков
+    deep = [B("+", 1)] + [B("["), B(">", 1), B("+", 1)] * 30 \
+        + [B("<", 1), B("-", 1), B("]")] * 30
+    assert _execute(deep, PyInterpreter) == _execute(deep)
+
+    program = Program.from_bytecode(bytecode)
+    assert PyInterpreter(program).code is PyInterpreter(program).code
+
+    # Невыполняемая группа MUL не трогает ячейку левее ленты
+    mul = Optimizer().optimize([B(c, 1) if c in "+-<>" else B(c)
+                                for c in "[<+>-]+."])
+    assert _execute(mul, PyInterpreter) == _execute(mul) == ({0: 1}, "\x01")
+
+    # memory_size без доказанного tape_size проверок не отключает
+    for code in (">+<<+", ">>>>>+"):
+        interpreter = PyInterpreter([B(c, 1) for c in code],
+                                    memory_size=2, memory_limit=4)
+        with pytest.raises(MemoryBoundsError):
+            interpreter.run()
+    size = tape_size(bytecode)
+    assert not PyInterpreter(bytecode, memory_size=size).checked
+
+
+@pytest.mark.skipif(shutil.which("cc") is None, reason="нет компилятора C")
+def test_native_engine(tmp_path, monkeypatch):
+    monkeypatch.setenv("BR_NATIVE_CACHE", str(tmp_path))
+    bytecode = compile_source(MACRO_PROGRAM)
+    for level in (0, 3):
+        optimized = Optimizer(level=level).optimize(bytecode)
+        assert _execute(optimized, NativeInterpreter) == _execute(bytecode)
+
+    # Собранная программа берётся из кэша
+    assert NativeInterpreter(bytecode).path == NativeInterpreter(bytecode).path
+    assert 2 == len(list(tmp_path.iterdir()))
+
+    echo = [B(c, 1) if c in "+-<>" else B(c) for c in ",[.,]"]
+    interpreter = NativeInterpreter(echo, output=io.StringIO(),
+                                    inp=io.StringIO("abc\0"))
+    interpreter.run()
+    assert interpreter.output.getvalue() == "abc"
+
+    for code in ("<+", "+[<]", ">>>>+"):
+        interpreter = NativeInterpreter([B(c, 1) for c in code],
+                                        memory_limit=3)
+        with pytest.raises(MemoryBoundsError):
+            interpreter.run()
+
+
+def test_io_channels(tmp_path):
+    # `,` за концом ввода не падает, а следует политике EOF
+    engines = [Interpreter, PyInterpreter]
+    if shutil.which("cc") is not None:
+        engines.append(NativeInterpreter)
+    read = [B(c, 1) if c in "+-<>" else B(c) for c in "+++,.,."]
+    for engine in engines:
+        for eof, last in ((EOF_UNCHANGED, 97), (EOF_ZERO, 0), (EOF_MAX, 255)):
+            interpreter = engine(read, output=io.BytesIO(),
+                                 inp=io.StringIO("a"), eof=eof)
+            interpreter.run()
+            assert interpreter.output.getvalue() == bytes([97, last])
+
+    # Бинарный ввод через mmap, вывод копится и сбрасывается кусками
+    path = tmp_path / "input.bin"
+    path.write_bytes(bytes(range(255)) * 4)
+    stream = io.BytesIO()
+    echo = [B(c, 1) if c in "+-<>" else B(c) for c in ",+[-.,+]"]
+    channel = OutputChannel(stream, buffer_size=100)
+    interpreter = Interpreter(echo, output=channel,
+                              inp=InputChannel.from_file(str(path), EOF_MAX))
+    interpreter.run()
+    assert stream.getvalue() == bytes(range(255)) * 4
+    assert not channel.buffer
+
+    text = OutputChannel(io.StringIO())
+    text.write(b"\xff!")
+    text.flush()
+    assert text.stream.getvalue() == "\xff!"
+
+
+def test_bf_frontend(tmp_path):
+    bytecode = compile_source(MACRO_PROGRAM)
+    text = "comment\n" + Program.from_bytecode(bytecode).compile()
+    path = tmp_path / "program.bf"
+    path.write_text(text)
+
+    program = parse_bf(str(path), chunk_size=7)
+    assert program == parse_bf(text.encode())
+    assert program == Program.from_bytecode(Optimizer(level=1).optimize(
+        [B(c, 1) if c in "+-<>" else B(c) for c in text if c in "+-<>.,[]"]))
+    for level in (0, 3):
+        optimized = Optimizer(level=level).optimize(program)
+        assert _execute(optimized) == _execute(bytecode)
+
+    # Серия, разрезанная между кусками, сворачивается в одну инструкцию
+    parser = BfParser()
+    for chunk in ("+", "+x", "+", ">", "<-"):
+        parser.feed(chunk)
+    assert parser.finish().to_bytecode() == [B("+", 2)]
+
+    for code, offset in (("+]", 1), ("[+[]", 0), ("[]  ]", 4)):
+        with pytest.raises(BracketError) as e:
+            parse_bf(io.StringIO(code))
+        assert e.value.offset == offset
+
+
+def test_source_map_profile():
+    compiler = FileCompiler("macro.br",
+                            Lexer(MACRO_PROGRAM.splitlines(True)).block)
+    compiler.compile()
+    bytecode = compiler.context.full_bytecode()
+    source_map = compiler.source_map
+    assert all(b.src is not None for b in bytecode)
+    # `__plus value` в теле _add (строка 4), вызванного из _mov2 через _while
+    entry = source_map[bytecode[[str(b) for b in bytecode].index(
+        "(-, 1)")].src]
+    assert (entry.line, entry.func) == (4, "__plus")
+    assert [name for name, _ in entry.chain] == ["_mov2", "_while", "_add"]
+
+    # Оптимизатор сохраняет привязку к исходнику
+    optimized = Optimizer().optimize(bytecode)
+    assert all(b.src is not None for b in optimized)
+
+    for code in (bytecode, optimized):
+        interpreter = Interpreter(code, output=io.StringIO())
+        profile = interpreter.profile()
+        assert (interpreter.memory.get_items(), interpreter.output.getvalue()) \
+            == _execute(bytecode)
+        assert profile.high_water == 3
+        assert profile.steps == sum(h for _, h in profile.by_line(source_map))
+        assert sum(int(line.rsplit(" ", 1)[1])
+                   for line in profile.folded(source_map)) == profile.steps
+        assert profile.by_macro(source_map)[0][0] in ("_mov2", "_while")
+        assert profile.report(source_map)
+
+    profile = Interpreter(bytecode, output=io.StringIO()).profile()
+    assert profile.steps == Interpreter(bytecode, output=io.StringIO()) \
+        .run().steps
+    assert sorted(profile.loops.values()) == [72, 104]
+
+
+def test_checkpoint_restore(tmp_path):
+    # Долгий пролог без ввода, затем `,` и работа с введённым байтом
+    code = [B(c, 1) if c in "+-<>" else B(c) for c in
+            "++++++++[>++++++++<-]>+>" + ">" * 5000 + "+" + "<" * 5000
+            + ",[-<+>]<."]
+    prefix = Interpreter(code, inp=io.StringIO())
+    while B.READ != prefix.bytecode.ops[prefix.PC]:
+        prefix.step()
+    snapshot = prefix.checkpoint()
+    assert prefix.checkpoint().shared(snapshot) == len([
+        page for page in snapshot.pages if page is not None]) == 2
+
+    path = tmp_path / "prefix.snap"
+    with open(str(path), "wb") as f:
+        snapshot.save(f)
+    with open(str(path), "rb") as f:
+        loaded = Snapshot.load(f)
+    assert loaded.tape() == snapshot.tape()
+
+    for text in ("\x01", "\x05"):
+        fresh = Interpreter(code, output=io.StringIO(), inp=io.StringIO(text))
+        fresh.run()
+        resumed = Interpreter(code, output=io.StringIO())
+        resumed.restore(loaded, inp=io.StringIO(text))
+        resumed.run()
+        assert resumed.output.getvalue() == fresh.output.getvalue()
+        assert resumed.memory == fresh.memory
+
+    # Ввод из bytes возвращается к позиции снимка сам
+    replay = Interpreter(code, output=io.StringIO(), inp=b"\x02")
+    replay.restore(snapshot)
+    replay.run()
+    replay.restore(snapshot)
+    replay.run()
+    assert replay.output.getvalue() == chr(67) * 2
+
+    with pytest.raises(SnapshotError):
+        Interpreter(code[1:]).restore(snapshot)
+
+
+def test_batch_engine():
+    pytest.importorskip("numpy")
+    from executor.batch import BatchInterpreter
+
+    # Дорожки расходятся на циклах: у каждой свой ввод и своё число итераций
+    code = parse_bf(b">,[[>]+[<]>-]>[.>]<,[->+<]>.")
+    inputs = ["", "\x01", "\x03\x07", "\x05\x02", "\x02"]
+    for bytecode in (code, Optimizer().optimize(code)):
+        batch = BatchInterpreter(bytecode, inputs, eof=EOF_ZERO)
+        results = batch.run()
+        for lane, text in enumerate(inputs):
+            single = Interpreter(bytecode, output=io.BytesIO(),
+                                 inp=io.StringIO(text), eof=EOF_ZERO)
+            assert results[lane].steps == single.run().steps
+            assert batch.outputs[lane] == single.output.getvalue()
+            assert batch.memory(lane).get_items() \
+                == single.memory.get_items()
+
+    with pytest.raises(MemoryBoundsError):
+        BatchInterpreter(parse_bf(b",[<]"), ["", "\x01"]).run()
+
+
+def test_async_engine():
+    # Эхо до нулевого байта: каждый `,` ждёт, пока ввод подадут из loop
+    echo = parse_bf(b",[.,]")
+
+    async def session(scheduler, n):
+        inp = AsyncInputChannel()
+        out = AsyncOutputChannel()
+        interpreter = Interpreter(echo, output=out, inp=inp)
+        task = scheduler.spawn(interpreter)
+        await asyncio.sleep(0)
+        assert not task.done()
+        for i in range(3):
+            inp.feed(chr(ord("a") + n) * (i + 1))
+            await asyncio.sleep(0)
+        inp.feed(b"\0")
+        return b"".join([chunk async for chunk in out])
+
+    async def main():
+        scheduler = Scheduler(slice_size=7)
+        outputs = await asyncio.gather(*(session(scheduler, n)
+                                         for n in range(20)))
+        results = await scheduler.join()
+        return outputs, results
+
+    outputs, results = asyncio.run(main())
+    assert outputs == [chr(ord("a") + n).encode() * 6 for n in range(20)]
+    assert all(r.halted and r.steps == 6 * 3 + 2 for r in results)
+
+    # Без AsyncInputChannel run_async просто отдаёт управление по квантам
+    code = [B(c, 1) if c in "+-<>" else B(c) for c in "+" * 5 + "[->+<]>."]
+    interpreter = Interpreter(code, output=io.StringIO())
+    result = asyncio.run(interpreter.run_async(slice_size=2))
+    assert result.steps == Interpreter(code, output=io.StringIO()).run().steps
+    assert interpreter.output.getvalue() == chr(5)
+
+    # Закрытый ввод читается по политике EOF
+    inp = AsyncInputChannel(eof=EOF_ZERO)
+    inp.close()
+    interpreter = Interpreter(parse_bf(b"+,"), output=io.StringIO(), inp=inp)
+    assert interpreter.run().halted
+    assert interpreter.memory == {}
+
+
+def test_stream_compile():
+    block = Lexer(MACRO_PROGRAM.splitlines(True)).block
+    compiler = FileCompiler("macro.br", block)
+    compiler.compile()
+    bytecode = compiler.bytecode()
+    assert compiler.bytecode() is bytecode
+
+    streaming = FileCompiler("macro.br", block, release=True)
+    streamed = list(streaming.stream())
+    assert not streaming.context.childs
+    assert len(streamed) == len(bytecode)
+    assert [b for b in streamed if B.NONE != b.op] \
+        == [b for b in bytecode if B.NONE != b.op]
+    assert all(b.arg is None for b in streamed if B.NONE == b.op)
+    assert [b.src for b in streamed] == [b.src for b in bytecode]
+    assert tape_size(streamed) == compiler.tape_size()
+
+    # Цепочка родителей остаётся, и по ней строится отчёт об ошибке
+    broken = FileCompiler("broken.br", Lexer(
+        (MACRO_PROGRAM + "nothing A\n").splitlines(True)).block,
+        release=True)
+    with pytest.raises(FunctionNotFoundError) as info:
+        list(broken.stream())
+    assert "nothing" in info.value.context.error_info()
+
+
+def test_macro_cache():
+    def build(source, size):
+        compiler = FileCompiler("cache.br", Lexer(
+            source.splitlines(True)).block, macro_cache_size=size)
+        compiler.compile()
+        return compiler, compiler.bytecode()
+
+    def sources(compiler, bytecode):
+        return [repr(compiler.source_map[b.src]) for b in bytecode]
+
+    # `reg` внутри макроса: адрес зависит от занятых снаружи регистров
+    source = MACRO_PROGRAM + """
+macro global _tmp address to
+    reg T
+    _add T 1
+    _add to 1
+    _add T -1
+
+_tmp A
+reg D
+_tmp A
+_tmp A
+"""
+    plain, expected = build(source, 0)
+    cached, bytecode = build(source, MacroCache.SIZE)
+    assert plain.macro_cache is None
+    assert bytecode == expected
+    assert sources(cached, bytecode) == sources(plain, expected)
+    assert cached.macro_cache.hits > 0 and cached.macro_cache.misses > 0
+
+    # Раскрытия не делят ByteCode: оптимизатор меняет их на месте
+    assert len({id(b) for b in bytecode}) == len(bytecode)
+
+    # Раскрытие, которое определяет глобальный макрос, не кэшируется
+    source = MACRO_PROGRAM + """
+macro global _define
+    macro global _made address to
+        _add to 2
+
+_define
+_made A
+_define
+_made A
+"""
+    assert build(source, 1)[1] == build(source, 0)[1]
+
+    small = build(MACRO_PROGRAM, 1)[0].macro_cache
+    assert len(small) == 1 and small.evictions > 0
+
+
+def test_compile_cache(tmp_path):
+    path = tmp_path / "macro.br"
+    path.write_text(MACRO_PROGRAM)
+    cache = CompileCache(str(tmp_path / "cache"))
+
+    fresh = compile_file(str(path), cache)
+    assert not fresh.cached and cache.misses == 1
+    loaded = compile_file(str(path), cache)
+    assert loaded.cached and cache.hits == 1
+    assert loaded.program == fresh.program
+    assert list(loaded.program.sources) == list(fresh.program.sources)
+    assert loaded.program.comments == fresh.program.comments
+    assert loaded.source_map.entries[0].chain \
+        == fresh.source_map.entries[0].chain
+    assert loaded.tape_size() == fresh.tape_size() == 4
+    assert compile_file(str(path)).program == fresh.program
+
+    # Другой режим и изменённый исходник - другие ключи
+    assert not compile_file(str(path), cache, release=True).cached
+    path.write_text(MACRO_PROGRAM + "_print A\n")
+    assert not compile_file(str(path), cache).cached
+
+    # Повреждённая запись не загружается и удаляется
+    path.write_text(MACRO_PROGRAM)
+    entry = tmp_path / "cache" / cache.key(MACRO_PROGRAM)
+    data = bytearray(entry.read_bytes())
+    data[-1] ^= 1
+    entry.write_bytes(bytes(data))
+    assert not compile_file(str(path), cache).cached
+    assert compile_file(str(path), cache).cached
+
+    assert cache.clear() == 3
+    assert not compile_file(str(path), cache).cached
+
+
+def test_build_driver(tmp_path, monkeypatch):
+    import build
+
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "src" / "sub").mkdir(parents=True)
+    for name in ("src/a.br", "src/sub/b.br"):
+        (tmp_path / name).write_text(MACRO_PROGRAM)
+    (tmp_path / "src" / "bad.br").write_text("nothing A\n")
+    expected = Program.from_bytecode(Optimizer().optimize(
+        compile_source(MACRO_PROGRAM))).compile()
+
+    for jobs in (1, 2):
+        out = "out{}".format(jobs)
+        results = build.build(["src/a.br", "src/**/*.br"], out, jobs=jobs)
+        assert [r.file_name for r in results] \
+            == ["src/a.br", "src/bad.br", "src/sub/b.br"]
+        assert [r.ok for r in results] == [True, False, True]
+        assert "FunctionNotFoundError" in results[1].error
+        assert (tmp_path / out / "src" / "sub" / "b.bf").read_text() \
+            == expected
+        assert (tmp_path / out / "src" / "a.bc").exists()
+        assert len(build.summary(results, 1.0)) == len(results) + 2
+
+    results = build.build(["src/bad.br", "src/a.br"], "out", jobs=1,
+                          fail_fast=True, formats=[build.BF])
+    assert [r.file_name for r in results] == ["src/bad.br"]
+
+
+def test_import(tmp_path, monkeypatch):
+    import module_cache
+
+    cache = module_cache.ModuleCache(str(tmp_path / "modules"))
+    monkeypatch.setattr(module_cache, "modules", cache)
+    library, program = MACRO_PROGRAM.split("reg ZERO")
+    (tmp_path / "lib").mkdir()
+    (tmp_path / "lib" / "prelude.br").write_text(library)
+    main = tmp_path / "main.br"
+    main.write_text('import "lib/prelude.br"\nreg ZERO' + program)
+
+    def code(bytecode):
+        return [b for b in bytecode if B.NONE != b.op]
+
+    expected = code(compile_source(MACRO_PROGRAM))
+    assert code(compile_file(str(main)).bytecode()) == expected
+    assert (cache.misses, cache.hits) == (1, 0)
+    assert code(compile_file(str(main)).bytecode()) == expected
+    assert (cache.misses, cache.hits) == (1, 1)
+
+    # Новый процесс берёт библиотеку с диска
+    other = module_cache.ModuleCache(cache.directory)
+    monkeypatch.setattr(module_cache, "modules", other)
+    assert code(compile_file(str(main)).bytecode()) == expected
+    assert (other.misses, other.hits) == (0, 1)
+
+    # Запись кэша компиляции устаревает вместе с библиотекой
+    compiled = CompileCache(str(tmp_path / "compiled"))
+    assert not compile_file(str(main), compiled).cached
+    assert compile_file(str(main), compiled).cached
+    (tmp_path / "lib" / "prelude.br").write_text(
+        library.replace("__plus value", "__plus value\n    __plus 1"))
+    changed = compile_file(str(main), compiled)
+    assert not changed.cached and code(changed.bytecode()) != expected
+
+    for text, error in (("__plus 1\n", "ImportCodeError"),
+                        ('import "self.br"\n', "ImportCycleError"),
+                        ('import "missing.br"\n', "ImportFileError")):
+        (tmp_path / "lib" / "self.br").write_text(text)
+        main.write_text('import "lib/prelude.br"\nimport "lib/self.br"\n')
+        with pytest.raises(Exception) as info:
+            compile_file(str(main))
+        assert type(info.value).__name__ == error
+        assert ".br`" in str(info.value)
+
+
+def test_namespace():
+    from br_parser import NameSpace, Variable
+    from br_types import AddressBrType
+    from macro_cache import Recording
+
+    def var(name, value):
+        return Variable(name, AddressBrType(None, value=value))
+
+    root = NameSpace()
+    child = NameSpace(root)
+    child.recording = Recording()
+    inner = NameSpace(child)
+    sibling = NameSpace(root)
+
+    glob_a = var("A", 0)
+    inner.symbol_global_push(glob_a)
+    assert inner.find("A") is glob_a and root.find("A") is glob_a
+    assert child.recording.reads == {"A": glob_a}
+    assert child.recording.escaped
+
+    # Локальный символ перекрывает корневой только у потомков
+    local_a = var("A", 1)
+    child.symbol_push(local_a)
+    assert inner.find("A") is local_a
+    assert sibling.find("A") is glob_a
+    assert inner.find("B", "default") == "default"
+
+    # NameSpace создаётся только у контекстов, которым он нужен
+    compiler = FileCompiler("ns.br", Lexer(
+        (MACRO_PROGRAM + "_add A 1\n").splitlines(True)).block)
+    compiler.compile()
+    contexts, lazy = [compiler.context], 0
+    while contexts:
+        context = contexts.pop()
+        lazy += context._ch_ns is None
+        contexts.extend(context.childs)
+    assert lazy > 0
+
+
+def test_registers():
+    from registers import Registers
+
+    registers = Registers()
+    for address in (0, 1, 1, 3):
+        registers.hold(address)
+    assert registers.first_free() == 2
+    registers.release(1)
+    assert registers.first_free() == 2
+    registers.release(1)
+    registers.release(0)
+    assert registers.first_free() == 0 and len(registers) == 1
+
+    def comments(source):
+        compiler = FileCompiler("reg.br", Lexer(
+            source.splitlines(True)).block, macro_cache_size=0)
+        compiler.compile()
+        return [b.arg for b in compiler.bytecode()
+                if B.NONE == b.op and b.arg and "address" in b.arg]
+
+    # Ячейка регистра макроса свободна после его раскрытия,
+    # ячейка перекрытого регистра - сразу
+    source = """
+macro global _tmp address to
+    reg T
+
+reg A
+_tmp A
+reg B
+reg B
+reg C
+"""
+    assert [c.split("`")[1:4:2] for c in comments(source)] == [
+        ["A", "0"], ["T", "1"], ["B", "1"], ["B", "2"], ["C", "1"]]
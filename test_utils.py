@@ -1,5 +1,8 @@
 import io
+from typing import List
 
+from br_compiler import FileCompiler, Lexer
+from bytecode import ByteCode
 from utils import clear_list, _get_quote
 
 
@@ -60,3 +63,9 @@ def get_tests(file_name) -> BrTests:
                    out,
                    exc_name
                    )
+
+
+def compile_source(source: str, file_name: str = "<test>") -> List[ByteCode]:
+    compiler = FileCompiler(file_name, Lexer(source.splitlines(True)).block)
+    compiler.compile()
+    return compiler.bytecode()